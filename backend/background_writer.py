@@ -0,0 +1,248 @@
+"""
+Write-behind persistence for annotation and prediction JSON files.
+
+Handlers hand a document to the writer and return right away; a background
+thread writes it shortly after. Writes are batched:
+- repeated saves of the same file waiting in the queue are coalesced, so
+  only the latest document is written (the annotation UI saves often)
+- every file is written to a temporary file and renamed into place, so
+  readers never see a partial document
+- the temporary files of a batch are written first and then synced together,
+  and each directory is synced once per batch after the renames, instead of
+  syncing file by file
+
+A caller that needs durability waits on the Future returned by write_json,
+which resolves once the file has been renamed into place (and synced, when
+fsync is enabled). stop() writes everything still queued, so nothing
+acknowledged is lost on a graceful shutdown.
+"""
+
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger("backend")
+
+
+class _PendingWrite:
+    __slots__ = ("data", "indent", "future")
+
+    def __init__(self, data: Any, indent: Optional[int], future: Future):
+        self.data = data
+        self.indent = indent
+        self.future = future
+
+
+class BackgroundWriter:
+    """
+    Background thread that writes JSON files in coalesced, batched writes.
+
+    Args:
+        flush_interval (float): Seconds a batch waits for more writes before it
+            is written; saves repeated within this window are coalesced
+        fsync (bool): Sync files and directories to disk (durable against power loss)
+        max_batch (int): Most files written per batch
+    """
+    def __init__(self, flush_interval: float = 0.02, fsync: bool = True, max_batch: int = 256):
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.max_batch = max_batch
+        self._pending = {}
+        # Writes taken for a batch stay visible to readers until their rename is done
+        self._in_flight = {}
+        self._condition = threading.Condition()
+        # Held while a batch is taken and written (taken before _condition), so batches
+        # are written in the order they were taken and a file never goes back to older data
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self._stopped = False
+        self._flush_requested = False
+        self._counts = {"writes": 0, "coalesced": 0, "batches": 0, "fsyncs": 0, "errors": 0}
+
+    def start(self):
+        """Start (or restart after stop) the writer thread; write_json also starts it on first use"""
+        with self._condition:
+            self._stopped = False
+            self._start_thread()
+
+    def _start_thread(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="background-writer", daemon=True)
+            self._thread.start()
+
+    def write_json(self, filepath: str, data: Any, indent: Optional[int] = 2) -> Future:
+        """
+        Queue data to be written to filepath as JSON.
+
+        data must not be modified afterwards; it is serialized in the writer
+        thread. Returns a Future resolved with filepath once the file is in
+        place, or with the error if the write failed. Earlier queued writes of
+        the same file are replaced and resolve together with this one.
+        """
+        future = Future()
+        with self._condition:
+            previous = self._pending.get(filepath)
+            self._pending[filepath] = _PendingWrite(data, indent, future)
+            if previous is not None:
+                self._counts["coalesced"] += 1
+                future.add_done_callback(lambda done: _copy_result(done, previous.future))
+            stopped = self._stopped
+            if not stopped:
+                self._condition.notify()
+                self._start_thread()
+        if stopped:
+            # Late writes during shutdown are written right away, after any batch still being written
+            self._write_next_batch(None)
+        return future
+
+    def pending_data(self, filepath: str) -> Optional[Any]:
+        """Document queued or being written for filepath but not in place yet, so readers see their own writes"""
+        with self._condition:
+            write = self._pending.get(filepath) or self._in_flight.get(filepath)
+        return write.data if write is not None else None
+
+    def pending(self) -> int:
+        with self._condition:
+            return len(self._pending) + len(self._in_flight)
+
+    def stats(self) -> Dict:
+        with self._condition:
+            return {"pending": len(self._pending) + len(self._in_flight), **self._counts}
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait until every write queued so far is done; False on timeout"""
+        with self._condition:
+            futures = [write.future for write in (*self._in_flight.values(), *self._pending.values())]
+            self._flush_requested = True
+            self._condition.notify()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for future in futures:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                future.exception(timeout=remaining)
+            except FutureTimeoutError:
+                return False
+        return True
+
+    def stop(self):
+        """Write everything still queued and stop the thread"""
+        with self._condition:
+            self._stopped = True
+            thread = self._thread
+            self._thread = None
+            self._condition.notify()
+        if thread is not None:
+            thread.join()
+        # Written here if the thread was never started
+        self._write_next_batch(None)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._stopped:
+                    self._condition.wait()
+                if not self._pending and self._stopped:
+                    return
+                if self.flush_interval > 0:
+                    # Let repeated saves of the same file arrive and coalesce; flush() and stop() cut this short
+                    self._condition.wait_for(lambda: self._stopped or self._flush_requested, self.flush_interval)
+                self._flush_requested = False
+            self._write_next_batch(self.max_batch)
+
+    def _write_next_batch(self, limit: Optional[int]):
+        """Take up to limit queued writes (all if None) and write them"""
+        with self._write_lock:
+            with self._condition:
+                paths = list(self._pending)[:limit]
+                batch = {path: self._pending.pop(path) for path in paths}
+                # Writes stay visible to readers until their rename is done
+                self._in_flight.update(batch)
+            if batch:
+                self._write_batch(batch)
+
+    def _write_batch(self, batch: Dict[str, _PendingWrite]):
+        """Write temporary files, sync them together, rename them into place and sync their directories"""
+        staged = []
+        for filepath, write in batch.items():
+            directory = os.path.dirname(filepath) or "."
+            temp_path = None
+            try:
+                fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-", suffix=".json")
+                with os.fdopen(fd, "w") as out:
+                    json.dump(write.data, out, indent=write.indent)
+                    out.flush()
+                    if self.fsync:
+                        _sync(out.fileno())
+                os.chmod(temp_path, 0o644)
+                staged.append((filepath, temp_path, write))
+            except Exception as e:
+                self._fail(filepath, temp_path, write, e)
+
+        directories = set()
+        for filepath, temp_path, write in staged:
+            try:
+                os.replace(temp_path, filepath)
+                directories.add(os.path.dirname(filepath) or ".")
+            except Exception as e:
+                self._fail(filepath, temp_path, write, e)
+
+        if self.fsync:
+            # The renames are only durable once their directory entries are synced
+            for directory in directories:
+                try:
+                    fd = os.open(directory, os.O_RDONLY)
+                    try:
+                        _sync(fd)
+                    finally:
+                        os.close(fd)
+                except OSError as e:
+                    logger.warning("Failed to sync directory", extra={"fields": {
+                        "directory": directory, "error": str(e)
+                    }})
+
+        written = 0
+        for filepath, temp_path, write in staged:
+            if not write.future.done():
+                write.future.set_result(filepath)
+                written += 1
+        with self._condition:
+            for filepath, write in batch.items():
+                # A newer write of the same file may be in flight by now
+                if self._in_flight.get(filepath) is write:
+                    del self._in_flight[filepath]
+            self._counts["writes"] += written
+            self._counts["batches"] += 1
+            if self.fsync:
+                self._counts["fsyncs"] += len(staged) + len(directories)
+
+    def _fail(self, filepath: str, temp_path: Optional[str], write: _PendingWrite, error: Exception):
+        if temp_path is not None and os.path.exists(temp_path):
+            os.remove(temp_path)
+        with self._condition:
+            self._counts["errors"] += 1
+        logger.error("Background write failed", extra={"fields": {"path": filepath, "error": str(error)}})
+        write.future.set_exception(error)
+
+
+def _sync(fd: int):
+    # fdatasync skips metadata such as mtime that readers do not need
+    if hasattr(os, "fdatasync"):
+        os.fdatasync(fd)
+    else:
+        os.fsync(fd)
+
+
+def _copy_result(source: Future, target: Future):
+    """Resolve a coalesced write's Future with the outcome of the write that replaced it"""
+    if target.done():
+        return
+    error = source.exception()
+    if error is not None:
+        target.set_exception(error)
+    else:
+        target.set_result(source.result())
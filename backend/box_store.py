@@ -0,0 +1,456 @@
+"""
+Embedded SQLite store for annotations and predictions.
+
+Instead of one pretty-printed JSON file per image, boxes for all images live
+in a single database indexed by image filename, image content hash and cache
+key. Each image can hold one annotation set and any number of prediction sets
+(one per model/prompt version). The store has bulk query APIs for the
+evaluator and importers/exporters for the JSON layout used by the
+annotations/ and predictions/ directories.
+"""
+
+import os
+import json
+import sqlite3
+import hashlib
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    filename TEXT NOT NULL UNIQUE,
+    image_hash TEXT,
+    width INTEGER,
+    height INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_images_hash ON images(image_hash);
+
+CREATE TABLE IF NOT EXISTS labels (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS box_sets (
+    id INTEGER PRIMARY KEY,
+    image_id INTEGER NOT NULL REFERENCES images(id),
+    kind TEXT NOT NULL CHECK (kind IN ('annotation', 'prediction')),
+    model TEXT NOT NULL DEFAULT '',
+    prompt_version TEXT NOT NULL DEFAULT '',
+    cache_key TEXT,
+    created_at TEXT NOT NULL,
+    metadata TEXT,
+    UNIQUE (image_id, kind, model, prompt_version)
+);
+CREATE INDEX IF NOT EXISTS idx_box_sets_cache_key ON box_sets(cache_key);
+
+CREATE TABLE IF NOT EXISTS boxes (
+    set_id INTEGER NOT NULL REFERENCES box_sets(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    label_id INTEGER NOT NULL REFERENCES labels(id),
+    x REAL NOT NULL,
+    y REAL NOT NULL,
+    width REAL NOT NULL,
+    height REAL NOT NULL,
+    score REAL,
+    box_id TEXT,
+    PRIMARY KEY (set_id, position)
+) WITHOUT ROWID;
+"""
+
+
+def hash_file(filepath: str) -> Optional[str]:
+    """SHA-256 of a file's bytes, or None if it does not exist"""
+    if not os.path.isfile(filepath):
+        return None
+    hasher = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class BoxStore:
+    """
+    SQLite-backed store of annotation and prediction boxes.
+
+    Boxes are handled in the JSON schemas used by the API:
+    annotations as {"id", "x", "y", "width", "height", "tag"} and predictions
+    as {"type", "coordinates": {"x", "y", "width", "height"}}.
+
+    Args:
+        path (str): Database file (created if missing)
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        with self._conn:
+            self._conn.executescript(SCHEMA)
+            self._conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+        self._label_ids = dict(self._conn.execute("SELECT name, id FROM labels"))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    # Writing
+
+    def _label_id(self, name: str) -> int:
+        label_id = self._label_ids.get(name)
+        if label_id is None:
+            self._conn.execute("INSERT OR IGNORE INTO labels(name) VALUES (?)", (name,))
+            label_id = self._conn.execute("SELECT id FROM labels WHERE name = ?", (name,)).fetchone()[0]
+            self._label_ids[name] = label_id
+        return label_id
+
+    def _write(self, operation):
+        """Run a write in a transaction; on failure reload the label ids it may have cached"""
+        try:
+            with self._conn:
+                return operation()
+        except Exception:
+            self._label_ids = dict(self._conn.execute("SELECT name, id FROM labels"))
+            raise
+
+    def _image_id(self, filename: str, image_hash: Optional[str], image_size: Optional[Dict]) -> int:
+        width = image_size.get("width") if image_size else None
+        height = image_size.get("height") if image_size else None
+        self._conn.execute(
+            """INSERT INTO images(filename, image_hash, width, height) VALUES (?, ?, ?, ?)
+               ON CONFLICT(filename) DO UPDATE SET
+                   image_hash = COALESCE(excluded.image_hash, image_hash),
+                   width = COALESCE(excluded.width, width),
+                   height = COALESCE(excluded.height, height)""",
+            (filename, image_hash, width, height)
+        )
+        return self._conn.execute("SELECT id FROM images WHERE filename = ?", (filename,)).fetchone()[0]
+
+    def _replace_set(self, filename: str, kind: str, rows: List[Tuple], image_hash: Optional[str],
+                     image_size: Optional[Dict], model: str = "", prompt_version: str = "",
+                     cache_key: Optional[str] = None, metadata: Optional[Dict] = None,
+                     created_at: Optional[str] = None) -> int:
+        image_id = self._image_id(filename, image_hash, image_size)
+        self._conn.execute(
+            "DELETE FROM box_sets WHERE image_id = ? AND kind = ? AND model = ? AND prompt_version = ?",
+            (image_id, kind, model, prompt_version)
+        )
+        set_id = self._conn.execute(
+            """INSERT INTO box_sets(image_id, kind, model, prompt_version, cache_key, created_at, metadata)
+               VALUES (?, ?, ?, ?, ?, ?, ?)""",
+            (image_id, kind, model, prompt_version, cache_key,
+             created_at or datetime.now().strftime("%Y%m%d_%H%M%S"),
+             json.dumps(metadata) if metadata else None)
+        ).lastrowid
+        self._conn.executemany(
+            """INSERT INTO boxes(set_id, position, label_id, x, y, width, height, score, box_id)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            [(set_id, position, self._label_id(label), x, y, w, h, score, box_id)
+             for position, (label, x, y, w, h, score, box_id) in enumerate(rows)]
+        )
+        return set_id
+
+    def save_annotations(self, filename: str, annotations: List[Dict], image_size: Optional[Dict] = None,
+                         image_hash: Optional[str] = None, created_at: Optional[str] = None):
+        """Replace the annotation set of an image"""
+        rows = [
+            (ann["tag"], ann["x"], ann["y"], ann["width"], ann["height"], None,
+             str(ann["id"]) if ann.get("id") is not None else None)
+            for ann in annotations
+        ]
+        with self._lock:
+            self._write(lambda: self._replace_set(
+                filename, "annotation", rows, image_hash, image_size, created_at=created_at
+            ))
+
+    def save_predictions(self, filename: str, predictions: List[Dict], image_size: Optional[Dict] = None,
+                         image_hash: Optional[str] = None, model: str = "", prompt_version: str = "",
+                         cache_key: Optional[str] = None, metadata: Optional[Dict] = None,
+                         created_at: Optional[str] = None):
+        """Replace the prediction set of an image for one model/prompt version"""
+        rows = [
+            (pred["type"], pred["coordinates"]["x"], pred["coordinates"]["y"],
+             pred["coordinates"]["width"], pred["coordinates"]["height"], pred.get("score"), None)
+            for pred in predictions
+        ]
+        with self._lock:
+            self._write(lambda: self._replace_set(
+                filename, "prediction", rows, image_hash, image_size, model, prompt_version,
+                cache_key, metadata, created_at
+            ))
+
+    # Reading
+
+    def _set_boxes(self, set_id: int) -> List[Tuple]:
+        return self._conn.execute(
+            """SELECT labels.name, x, y, width, height, score, box_id FROM boxes
+               JOIN labels ON labels.id = boxes.label_id
+               WHERE set_id = ? ORDER BY position""",
+            (set_id,)
+        ).fetchall()
+
+    @staticmethod
+    def _annotation_json(rows: List[Tuple]) -> List[Dict]:
+        return [
+            {"id": box_id, "x": x, "y": y, "width": w, "height": h, "tag": label}
+            for label, x, y, w, h, _, box_id in rows
+        ]
+
+    @staticmethod
+    def _prediction_json(rows: List[Tuple]) -> List[Dict]:
+        predictions = []
+        for label, x, y, w, h, score, _ in rows:
+            prediction = {"type": label, "coordinates": {"x": x, "y": y, "width": w, "height": h}}
+            if score is not None:
+                prediction["score"] = score
+            predictions.append(prediction)
+        return predictions
+
+    def _find_set(self, filename: str, kind: str, model: Optional[str], prompt_version: Optional[str]):
+        query = """SELECT box_sets.id, images.filename, images.width, images.height, box_sets.created_at,
+                          box_sets.cache_key, box_sets.model, box_sets.prompt_version, box_sets.metadata
+                   FROM box_sets JOIN images ON images.id = box_sets.image_id
+                   WHERE images.filename = ? AND kind = ?"""
+        params = [filename, kind]
+        if model is not None:
+            query += " AND model = ?"
+            params.append(model)
+        if prompt_version is not None:
+            # Sets imported from files written before the prompt version was recorded match any version,
+            # as they do in the JSON layout; a newer versioned set still wins on created_at
+            query += " AND prompt_version IN (?, '')"
+            params.append(prompt_version)
+        # created_at has one-second resolution; the id breaks ties between writes in the same second
+        return self._conn.execute(query + " ORDER BY box_sets.created_at DESC, box_sets.id DESC LIMIT 1",
+                                  params).fetchone()
+
+    def get_annotations(self, filename: str) -> Optional[Dict]:
+        """Annotation document of an image in the annotations/*.json layout"""
+        with self._lock:
+            row = self._find_set(filename, "annotation", None, None)
+            if row is None:
+                return None
+            return {
+                "filename": row[1],
+                "annotations": self._annotation_json(self._set_boxes(row[0])),
+                "imageWidth": row[2],
+                "imageHeight": row[3],
+            }
+
+    def get_predictions(self, filename: str, model: Optional[str] = None,
+                        prompt_version: Optional[str] = None) -> Optional[Dict]:
+        """Latest matching prediction document of an image in the predictions/*.json layout"""
+        with self._lock:
+            row = self._find_set(filename, "prediction", model, prompt_version)
+            if row is None:
+                return None
+            return self._prediction_document(row, self._set_boxes(row[0]))
+
+    def _prediction_document(self, row: Tuple, boxes: List[Tuple]) -> Dict:
+        _, filename, width, height, created_at, cache_key, model, prompt_version, metadata = row
+        document = {
+            "filename": filename,
+            "predictions": self._prediction_json(boxes),
+            "timestamp": created_at,
+            "imageSize": {"width": width, "height": height},
+            "cacheKey": cache_key,
+            "model": model,
+            "promptVersion": prompt_version,
+        }
+        if metadata:
+            document.update(json.loads(metadata))
+        return document
+
+    def find_prediction_by_cache_key(self, cache_key: str) -> Optional[Dict]:
+        """Latest prediction document stored under a prediction cache key"""
+        with self._lock:
+            row = self._conn.execute(
+                """SELECT box_sets.id, images.filename, images.width, images.height, box_sets.created_at,
+                          box_sets.cache_key, box_sets.model, box_sets.prompt_version, box_sets.metadata
+                   FROM box_sets JOIN images ON images.id = box_sets.image_id
+                   WHERE cache_key = ? ORDER BY box_sets.created_at DESC, box_sets.id DESC LIMIT 1""",
+                (cache_key,)
+            ).fetchone()
+            if row is None:
+                return None
+            return self._prediction_document(row, self._set_boxes(row[0]))
+
+    def find_images_by_hash(self, image_hash: str) -> List[str]:
+        """Filenames of all images with the given content hash"""
+        with self._lock:
+            return [row[0] for row in self._conn.execute(
+                "SELECT filename FROM images WHERE image_hash = ? ORDER BY filename", (image_hash,)
+            )]
+
+    def prediction_versions(self) -> List[Tuple[str, str, int]]:
+        """(model, prompt version, number of images) for every stored prediction version"""
+        with self._lock:
+            return self._conn.execute(
+                """SELECT model, prompt_version, COUNT(*) FROM box_sets WHERE kind = 'prediction'
+                   GROUP BY model, prompt_version ORDER BY model, prompt_version"""
+            ).fetchall()
+
+    @staticmethod
+    def _version_filter(model: Optional[str], prompt_version: Optional[str]) -> Tuple[str, List]:
+        """SQL condition (starting with AND) and parameters selecting prediction versions"""
+        version_filter = ""
+        params = []
+        if model is not None:
+            version_filter += " AND model = ?"
+            params.append(model)
+        if prompt_version is not None:
+            version_filter += " AND prompt_version = ?"
+            params.append(prompt_version)
+        return version_filter, params
+
+    def count_evaluation_pairs(self, model: Optional[str] = None, prompt_version: Optional[str] = None) -> int:
+        """Number of pairs iter_evaluation_pairs yields, counted without loading any boxes"""
+        version_filter, params = self._version_filter(model, prompt_version)
+        with self._lock:
+            return self._conn.execute(
+                f"""SELECT COUNT(*) FROM box_sets WHERE kind = 'annotation' AND image_id IN (
+                        SELECT image_id FROM box_sets WHERE kind = 'prediction'{version_filter})""",
+                params
+            ).fetchone()[0]
+
+    def iter_evaluation_pairs(self, model: Optional[str] = None,
+                              prompt_version: Optional[str] = None) -> Iterator[Tuple[str, List[Tuple], List[Tuple]]]:
+        """
+        Stream (filename, annotation boxes, prediction boxes) for every image
+        that has both, using one query per box kind.
+
+        Boxes are (label, x, y, width, height, score) tuples. When several
+        prediction versions match, the latest one of each image is used.
+        """
+        version_filter, params = self._version_filter(model, prompt_version)
+
+        with self._lock:
+            prediction_sets = dict(self._conn.execute(
+                f"""SELECT image_id, id FROM (
+                        SELECT image_id, id, ROW_NUMBER() OVER (
+                            PARTITION BY image_id ORDER BY created_at DESC, id DESC) AS rank
+                        FROM box_sets WHERE kind = 'prediction'{version_filter})
+                    WHERE rank = 1""",
+                params
+            ).fetchall())
+            annotation_sets = self._conn.execute(
+                """SELECT box_sets.image_id, box_sets.id, images.filename FROM box_sets
+                   JOIN images ON images.id = box_sets.image_id
+                   WHERE kind = 'annotation' ORDER BY images.filename"""
+            ).fetchall()
+            pairs = [(filename, set_id, prediction_sets[image_id])
+                     for image_id, set_id, filename in annotation_sets if image_id in prediction_sets]
+
+        for filename, annotation_set, prediction_set in pairs:
+            with self._lock:
+                rows = self._conn.execute(
+                    """SELECT set_id, labels.name, x, y, width, height, score FROM boxes
+                       JOIN labels ON labels.id = boxes.label_id
+                       WHERE set_id IN (?, ?) ORDER BY set_id, position""",
+                    (annotation_set, prediction_set)
+                ).fetchall()
+            ground_truth = [row[1:] for row in rows if row[0] == annotation_set]
+            predictions = [row[1:] for row in rows if row[0] == prediction_set]
+            yield filename, ground_truth, predictions
+
+    # JSON import/export
+
+    def import_json_dirs(self, annotations_dir: str, predictions_dir: str,
+                         uploads_dir: Optional[str] = None, default_model: str = "") -> Tuple[int, int]:
+        """
+        Import annotations/*.json and predictions/predictions_*.json files.
+
+        Args:
+            default_model (str): Model recorded for prediction files written
+                before the model was saved; the backend treats those as made
+                by its default Gemini model
+
+        Returns:
+            tuple: (number of annotation files, number of prediction files)
+        """
+        annotation_count = prediction_count = 0
+        for path in sorted(Path(annotations_dir).glob("*.json")):
+            with open(path) as f:
+                data = json.load(f)
+            filename = data.get("filename") or path.stem
+            image_hash = hash_file(os.path.join(uploads_dir, filename)) if uploads_dir else None
+            image_size = {"width": data.get("imageWidth"), "height": data.get("imageHeight")}
+            self.save_annotations(filename, data.get("annotations", []), image_size, image_hash)
+            annotation_count += 1
+
+        for path in sorted(Path(predictions_dir).glob("predictions_*.json")):
+            with open(path) as f:
+                data = json.load(f)
+            filename = data.get("filename") or path.stem[len("predictions_"):]
+            image_hash = hash_file(os.path.join(uploads_dir, filename)) if uploads_dir else None
+            metadata = {key: data[key] for key in ("preprocessing",) if key in data}
+            self.save_predictions(filename, data.get("predictions", []), data.get("imageSize"), image_hash,
+                                  data.get("model") or default_model, data.get("promptVersion", ""), data.get("cacheKey"),
+                                  metadata, data.get("timestamp"))
+            prediction_count += 1
+        return annotation_count, prediction_count
+
+    def export_json_dirs(self, annotations_dir: str, predictions_dir: str) -> Tuple[int, int]:
+        """
+        Write the latest annotation and prediction sets back to the JSON layout.
+
+        Returns:
+            tuple: (number of annotation files, number of prediction files)
+        """
+        os.makedirs(annotations_dir, exist_ok=True)
+        os.makedirs(predictions_dir, exist_ok=True)
+        with self._lock:
+            filenames = [row[0] for row in self._conn.execute("SELECT filename FROM images ORDER BY filename")]
+
+        annotation_count = prediction_count = 0
+        for filename in filenames:
+            base_name = os.path.splitext(filename)[0]
+            annotations = self.get_annotations(filename)
+            if annotations is not None:
+                with open(os.path.join(annotations_dir, f"{base_name}.json"), "w") as f:
+                    json.dump(annotations, f, indent=2)
+                annotation_count += 1
+            predictions = self.get_predictions(filename)
+            if predictions is not None:
+                with open(os.path.join(predictions_dir, f"predictions_{base_name}.json"), "w") as f:
+                    json.dump(predictions, f, indent=2)
+                prediction_count += 1
+        return annotation_count, prediction_count
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Import or export the box store from/to the JSON layout")
+    parser.add_argument("command", choices=["import", "export", "info"])
+    parser.add_argument("--db", default="boxes.db", help="SQLite database file")
+    parser.add_argument("--annotations-dir", default="annotations")
+    parser.add_argument("--predictions-dir", default="predictions")
+    parser.add_argument("--uploads-dir", default="uploads", help="Used to compute image hashes on import")
+    parser.add_argument("--default-model", default=os.getenv("GEMINI_MODEL", "gemini-2.5-flash"),
+                        help="Model recorded for prediction files that do not name one (the backend's default model)")
+    args = parser.parse_args()
+
+    store = BoxStore(args.db)
+    if args.command == "import":
+        annotations, predictions = store.import_json_dirs(args.annotations_dir, args.predictions_dir, args.uploads_dir,
+                                                           args.default_model)
+        print(f"Imported {annotations} annotation files and {predictions} prediction files into {args.db}")
+    elif args.command == "export":
+        annotations, predictions = store.export_json_dirs(args.annotations_dir, args.predictions_dir)
+        print(f"Exported {annotations} annotation files and {predictions} prediction files from {args.db}")
+    else:
+        for model, prompt_version, count in store.prediction_versions():
+            print(f"model={model or '-'} prompt_version={prompt_version or '-'}: {count} images")
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+"""
+Perceptual-hash index for finding duplicate and near-duplicate screenshots.
+
+Screenshot sets often contain many almost identical frames of the same page.
+Each image is reduced to a difference hash (dHash): the grayscale image is
+shrunk to (hash_size + 1) x hash_size pixels and each bit records whether a
+pixel is brighter than its right neighbour. Re-encoding, resizing and small
+rendering differences flip only a few bits, so images whose hashes differ in
+at most max_distance bits (and whose aspect ratios match) are near-duplicates.
+
+Lookups use multi-index hashing: each hash is split into max_distance + 1
+bands, and any hash within max_distance bits of another matches it exactly on
+at least one band (pigeonhole principle). Only entries sharing a band are
+compared bit by bit, instead of the whole index.
+
+Run as a script to report duplicate clusters and the model calls they save:
+    python dedup_index.py report uploads ../Datasets --max-distance 16
+"""
+
+import os
+import json
+import tempfile
+import threading
+from collections import defaultdict
+from typing import Iterable, List, Optional, Tuple
+
+from PIL import Image
+
+SUPPORTED_EXTENSIONS = {".jpg", ".jpeg", ".png"}
+DEFAULT_HASH_SIZE = 16  # 16 x 16 = 256-bit hashes
+DEFAULT_MAX_DISTANCE = 16
+DEFAULT_ASPECT_TOLERANCE = 0.02
+
+
+def dhash(image: Image.Image, hash_size: int = DEFAULT_HASH_SIZE) -> int:
+    """Difference hash of an image as a hash_size * hash_size bit integer"""
+    small = image.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.BILINEAR, reducing_gap=2.0)
+    pixels = small.tobytes()
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for column in range(hash_size):
+            value = (value << 1) | (pixels[offset + column] > pixels[offset + column + 1])
+    return value
+
+
+def hash_file(path: str, hash_size: int = DEFAULT_HASH_SIZE) -> Tuple[int, int, int]:
+    """Return (dhash, width, height) of an image file"""
+    with Image.open(path) as image:
+        width, height = image.size
+        # JPEGs can be decoded at a fraction of their size; the hash only needs a few pixels
+        image.draft("RGB", (max(1, width // 8), max(1, height // 8)))
+        if image.mode in ("RGBA", "LA", "P"):
+            image = image.convert("RGBA")
+            background = Image.new("RGBA", image.size, (255, 255, 255, 255))
+            image = Image.alpha_composite(background, image)
+        return dhash(image, hash_size), width, height
+
+
+class DuplicateIndex:
+    """
+    In-memory index of image hashes with near-duplicate lookup.
+
+    Args:
+        max_distance (int): Largest Hamming distance still counted as a duplicate
+        hash_size (int): dHash grid size (hashes have hash_size ** 2 bits)
+        aspect_tolerance (float): Largest relative difference in aspect ratio
+            between duplicates, so a short page never matches a long one
+
+    Attributes:
+        entries (dict): key -> (hash, width, height) for every indexed image
+    """
+    def __init__(self, max_distance: int = DEFAULT_MAX_DISTANCE, hash_size: int = DEFAULT_HASH_SIZE,
+                 aspect_tolerance: float = DEFAULT_ASPECT_TOLERANCE):
+        bits = hash_size * hash_size
+        if not 0 <= max_distance < bits:
+            raise ValueError(f"max_distance must be between 0 and {bits - 1}")
+        self.max_distance = max_distance
+        self.hash_size = hash_size
+        self.aspect_tolerance = aspect_tolerance
+        self.entries = {}
+        # Band boundaries as (shift, mask); band widths differ by at most one bit
+        bands = max_distance + 1
+        self._bands = []
+        start = 0
+        for band in range(bands):
+            width = bits // bands + (band < bits % bands)
+            self._bands.append((start, (1 << width) - 1))
+            start += width
+        self._tables = [defaultdict(set) for _ in self._bands]
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _band_values(self, image_hash: int) -> List[int]:
+        return [(image_hash >> shift) & mask for shift, mask in self._bands]
+
+    def add(self, key: str, image_hash: int, width: int, height: int):
+        """Index an image, replacing any earlier entry under the same key"""
+        with self._lock:
+            self._remove(key)
+            self.entries[key] = (image_hash, width, height)
+            for table, value in zip(self._tables, self._band_values(image_hash)):
+                table[value].add(key)
+
+    def remove(self, key: str):
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for table, value in zip(self._tables, self._band_values(entry[0])):
+            table[value].discard(key)
+            if not table[value]:
+                del table[value]
+
+    def _same_aspect(self, width: int, height: int, other_width: int, other_height: int) -> bool:
+        aspect = width / max(height, 1)
+        other_aspect = other_width / max(other_height, 1)
+        return abs(aspect - other_aspect) <= self.aspect_tolerance * other_aspect
+
+    def find(self, image_hash: int, width: int, height: int, exclude: Optional[str] = None) -> List[Tuple[int, str]]:
+        """Return (distance, key) of every duplicate, closest first"""
+        with self._lock:
+            candidates = set()
+            for table, value in zip(self._tables, self._band_values(image_hash)):
+                candidates.update(table.get(value, ()))
+            candidates.discard(exclude)
+            matches = []
+            for key in candidates:
+                other_hash, other_width, other_height = self.entries[key]
+                distance = (image_hash ^ other_hash).bit_count()
+                if distance <= self.max_distance and self._same_aspect(width, height, other_width, other_height):
+                    matches.append((distance, key))
+        matches.sort()
+        return matches
+
+    def scan(self, directories: Iterable[str], cache_path: Optional[str] = None, key=os.path.basename) -> int:
+        """
+        Hash and index every supported image in the given directories.
+
+        Hashes are cached in cache_path by file path, size and modification
+        time, so rescanning only hashes new or changed files. key maps a file
+        path to its index key (the file name by default, which is how
+        predictions are named).
+
+        Returns:
+            int: Number of images indexed
+        """
+        cache = {}
+        if cache_path:
+            try:
+                with open(cache_path) as f:
+                    data = json.load(f)
+                if data.get("hash_size") == self.hash_size:
+                    cache = data.get("files", {})
+            except (OSError, ValueError):
+                pass
+
+        files = {}
+        for directory in directories:
+            if not os.path.isdir(directory):
+                continue
+            for name in sorted(os.listdir(directory)):
+                path = os.path.abspath(os.path.join(directory, name))
+                if os.path.splitext(name)[1].lower() not in SUPPORTED_EXTENSIONS:
+                    continue
+                try:
+                    stat = os.stat(path)
+                    cached = cache.get(path)
+                    if cached and cached["size"] == stat.st_size and cached["mtime_ns"] == stat.st_mtime_ns:
+                        image_hash, width, height = int(cached["hash"], 16), cached["width"], cached["height"]
+                    else:
+                        image_hash, width, height = hash_file(path, self.hash_size)
+                except (OSError, ValueError, Image.DecompressionBombError):
+                    continue
+                files[path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "hash": f"{image_hash:x}",
+                               "width": width, "height": height}
+                self.add(key(path), image_hash, width, height)
+
+        if cache_path and files != cache:
+            directory = os.path.dirname(os.path.abspath(cache_path))
+            fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump({"hash_size": self.hash_size, "files": files}, f)
+                os.replace(temp_path, cache_path)
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+        return len(files)
+
+    def clusters(self) -> List[List[str]]:
+        """Group indexed images into clusters of (transitively) near-duplicate images, largest first"""
+        with self._lock:
+            entries = dict(self.entries)
+        parent = {key: key for key in entries}
+
+        def root(key):
+            while parent[key] != key:
+                parent[key] = parent[parent[key]]
+                key = parent[key]
+            return key
+
+        for key, (image_hash, width, height) in entries.items():
+            for _, other in self.find(image_hash, width, height, exclude=key):
+                parent[root(other)] = root(key)
+
+        groups = defaultdict(list)
+        for key in entries:
+            groups[root(key)].append(key)
+        return sorted((sorted(group) for group in groups.values()), key=lambda group: (-len(group), group[0]))
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Report duplicate and near-duplicate screenshots")
+    parser.add_argument("command", choices=["report"])
+    parser.add_argument("directories", nargs="+", help="Image directories to scan")
+    parser.add_argument("--max-distance", type=int, default=DEFAULT_MAX_DISTANCE,
+                        help="Largest Hamming distance (in bits) counted as a duplicate")
+    parser.add_argument("--hash-size", type=int, default=DEFAULT_HASH_SIZE, help="dHash grid size")
+    parser.add_argument("--hash-cache", help="JSON file caching hashes between runs")
+    parser.add_argument("--output-json", help="Write the clusters as JSON to this file")
+    args = parser.parse_args()
+
+    index = DuplicateIndex(args.max_distance, args.hash_size)
+    total = index.scan(args.directories, args.hash_cache, key=os.path.relpath)
+    clusters = index.clusters()
+    duplicates = [cluster for cluster in clusters if len(cluster) > 1]
+
+    for number, cluster in enumerate(duplicates, 1):
+        first_hash, width, height = index.entries[cluster[0]]
+        print(f"Cluster {number} ({len(cluster)} images, {width}x{height}):")
+        for key in cluster:
+            distance = (index.entries[key][0] ^ first_hash).bit_count()
+            print(f"  {key}  distance={distance}")
+
+    saved = total - len(clusters)
+    print(f"\n{total} images, {len(clusters)} distinct, {len(duplicates)} duplicate clusters")
+    print(f"Model calls saved: {saved} ({saved / total:.1%})" if total else "Model calls saved: 0")
+    if args.output_json:
+        with open(args.output_json, "w") as f:
+            json.dump({"images": total, "distinct": len(clusters), "calls_saved": saved, "clusters": duplicates},
+                      f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+"""
+Detector backends for UI element detection.
+
+A detector turns an RGB screenshot into a list of predictions in the schema
+returned by /predict:
+    {"type": "Button", "coordinates": {"x": ..., "y": ..., "width": ..., "height": ...}}
+
+The Gemini backend (defined in main.py) prompts a remote vision model. The
+ONNX backend runs a local object detector on the CPU with ONNX Runtime; it is
+loaded once and warmed up at startup, and needs the optional onnxruntime
+package.
+"""
+
+import os
+import json
+import time
+import asyncio
+import hashlib
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from postprocessing import non_max_suppression
+
+DEFAULT_LABELS = ["Button", "Input", "Dropdown", "Radio"]
+
+
+class Detector(ABC):
+    """
+    Interface implemented by every detector backend; backends missing a
+    method fail when they are instantiated.
+
+    Attributes:
+        name (str): Backend name used in ?backend= and DETECTOR_BACKEND
+        model_name (str): Model identifier stored with the predictions
+        prompt_version (str): Version of the prompt or model settings, stored
+            with the predictions so runs can be compared
+    """
+    name = ""
+    model_name = ""
+    prompt_version = ""
+
+    def warmup(self):
+        """Load the model ahead of the first request (called once at startup)"""
+
+    @abstractmethod
+    def cache_identity(self, preprocess_config) -> Tuple[str, str, Dict]:
+        """Return (prompt, model name, settings) that, with the image, identify a prediction"""
+
+    @abstractmethod
+    async def detect(self, image: Image.Image, preprocess_config, trace,
+                     on_box: Optional[Callable] = None) -> Tuple[List[Dict], Dict]:
+        """
+        Detect UI elements in an RGB image.
+
+        on_box, if given, is called with each prediction as soon as it is
+        available (for progressive responses).
+
+        Returns:
+            tuple: (predictions in original-image pixels, stats dict returned
+                    to the client as "preprocessing")
+        """
+
+
+class OnnxDetector(Detector):
+    """
+    Local object detector run with ONNX Runtime on the CPU.
+
+    Two output layouts are supported:
+    - YOLOv8-style raw output of shape (1, 4 + classes, anchors) or
+      (1, anchors, 4 + classes) with center x, center y, width, height boxes;
+      boxes are filtered by score and class-aware NMS here
+    - models exported with NMS that return (boxes, scores, labels), boxes as
+      x1, y1, x2, y2 in input pixels
+
+    Args:
+        model_path (str): Path to the .onnx file
+        labels (list): Class names in model output order
+        input_size (int): Square model input size in pixels (images are letterboxed)
+        score_threshold (float): Minimum class score for a box
+        iou_threshold (float): IoU above which NMS suppresses a box
+        threads (int): ONNX Runtime intra-op threads (0 = runtime default)
+    """
+    name = "onnx"
+
+    def __init__(self, model_path: str, labels: Optional[List[str]] = None, input_size: int = 640,
+                 score_threshold: float = 0.25, iou_threshold: float = 0.45, threads: int = 0):
+        self.model_path = model_path
+        self.labels = labels or DEFAULT_LABELS
+        self.input_size = input_size
+        self.score_threshold = score_threshold
+        self.iou_threshold = iou_threshold
+        self.threads = threads
+        self.session = None
+        self.input_name = None
+        self.model_name = f"onnx:{os.path.basename(model_path)}"
+        self.prompt_version = hashlib.sha256(json.dumps(self.settings(), sort_keys=True).encode()).hexdigest()[:12]
+
+    @classmethod
+    def from_env(cls) -> "OnnxDetector":
+        labels = os.getenv("ONNX_LABELS")
+        return cls(
+            model_path=os.getenv("ONNX_MODEL_PATH", ""),
+            labels=[label.strip() for label in labels.split(",")] if labels else None,
+            input_size=int(os.getenv("ONNX_INPUT_SIZE", "640")),
+            score_threshold=float(os.getenv("ONNX_SCORE_THRESHOLD", "0.25")),
+            iou_threshold=float(os.getenv("ONNX_IOU_THRESHOLD", "0.45")),
+            threads=int(os.getenv("ONNX_THREADS", "0")),
+        )
+
+    def settings(self) -> Dict:
+        return {
+            "labels": self.labels,
+            "input_size": self.input_size,
+            "score_threshold": self.score_threshold,
+            "iou_threshold": self.iou_threshold,
+        }
+
+    def warmup(self):
+        try:
+            # Imported here so the package is only needed when the ONNX backend is configured
+            import onnxruntime as ort
+        except ImportError:
+            raise RuntimeError("The onnx detector backend needs onnxruntime: pip install onnxruntime")
+        if not os.path.isfile(self.model_path):
+            raise RuntimeError(f"ONNX model not found: {self.model_path!r} (set ONNX_MODEL_PATH)")
+
+        with open(self.model_path, "rb") as f:
+            model_hash = hashlib.sha256(f.read()).hexdigest()[:12]
+        # The file hash tells apart retrained models saved under the same name
+        self.model_name = f"onnx:{os.path.basename(self.model_path)}:{model_hash}"
+
+        options = ort.SessionOptions()
+        if self.threads:
+            options.intra_op_num_threads = self.threads
+        self.session = ort.InferenceSession(self.model_path, sess_options=options,
+                                            providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        # The first run allocates buffers and picks kernels; do it before serving
+        blank = np.zeros((1, 3, self.input_size, self.input_size), dtype=np.float32)
+        self.session.run(None, {self.input_name: blank})
+
+    def cache_identity(self, preprocess_config) -> Tuple[str, str, Dict]:
+        return "", self.model_name, self.settings()
+
+    def letterbox(self, image: Image.Image) -> Tuple["np.ndarray", float, Tuple[int, int]]:
+        """Resize keeping the aspect ratio, pad to a square and return (NCHW tensor, scale, (pad x, pad y))"""
+        scale = min(self.input_size / image.width, self.input_size / image.height)
+        new_size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        pad = ((self.input_size - new_size[0]) // 2, (self.input_size - new_size[1]) // 2)
+        canvas = Image.new("RGB", (self.input_size, self.input_size), (114, 114, 114))
+        canvas.paste(image.resize(new_size, Image.Resampling.BILINEAR), pad)
+        tensor = np.asarray(canvas, dtype=np.float32).transpose(2, 0, 1)[np.newaxis] / 255.0
+        return tensor, scale, pad
+
+    def decode(self, outputs: List["np.ndarray"]) -> Tuple["np.ndarray", "np.ndarray", "np.ndarray"]:
+        """Return (x1, y1, x2, y2 boxes, scores, class indices) in input pixels after filtering and NMS"""
+        if len(outputs) >= 3:
+            boxes, scores, classes = (np.asarray(output) for output in outputs[:3])
+            boxes = boxes.reshape(-1, 4).astype(np.float32)
+            scores = scores.reshape(-1).astype(np.float32)
+            classes = classes.reshape(-1).astype(np.int64)
+            keep = scores >= self.score_threshold
+            return boxes[keep], scores[keep], classes[keep]
+
+        raw = np.asarray(outputs[0])[0]
+        if raw.shape[0] == 4 + len(self.labels) and raw.shape[1] != 4 + len(self.labels):
+            raw = raw.T
+        class_scores = raw[:, 4:]
+        classes = class_scores.argmax(axis=1)
+        scores = class_scores[np.arange(len(raw)), classes]
+        keep = scores >= self.score_threshold
+        centers, sizes, scores, classes = raw[keep, :2], raw[keep, 2:4], scores[keep], classes[keep]
+        boxes = np.concatenate([centers - sizes / 2, centers + sizes / 2], axis=1)
+        if len(boxes) == 0:
+            return boxes, scores, classes
+
+        # Class-aware, so NMS never suppresses across classes
+        keep = non_max_suppression(boxes, scores, self.iou_threshold, classes)
+        return boxes[keep], scores[keep], classes[keep]
+
+    def predict(self, image: Image.Image, trace) -> Tuple[List[Dict], Dict]:
+        """Run the model synchronously (ONNX Runtime sessions are safe to call from several threads)"""
+        with trace.span("preprocess"):
+            preprocess_start = time.perf_counter()
+            tensor, scale, (pad_x, pad_y) = self.letterbox(image)
+            preprocess_ms = (time.perf_counter() - preprocess_start) * 1000
+        with trace.span("model_call"):
+            model_start = time.perf_counter()
+            outputs = self.session.run(None, {self.input_name: tensor})
+            model_ms = (time.perf_counter() - model_start) * 1000
+        with trace.span("parse"):
+            boxes, scores, classes = self.decode(outputs)
+            # Undo the letterbox and clip to the original image
+            boxes = (boxes - [pad_x, pad_y, pad_x, pad_y]) / scale
+            boxes = np.clip(boxes, 0, [image.width, image.height, image.width, image.height])
+
+            predictions = []
+            for (x1, y1, x2, y2), score, class_index in zip(boxes, scores, classes):
+                x_min, y_min, x_max, y_max = int(x1), int(y1), int(x2), int(y2)
+                if x_min >= x_max or y_min >= y_max or not 0 <= class_index < len(self.labels):
+                    continue
+                predictions.append({
+                    "type": self.labels[class_index],
+                    "coordinates": {"x": x_min, "y": y_min, "width": x_max - x_min, "height": y_max - y_min},
+                    "score": round(float(score), 4),
+                })
+
+        stats = {**self.settings(), "preprocess_ms": preprocess_ms, "model_ms": model_ms}
+        return predictions, stats
+
+    async def detect(self, image: Image.Image, preprocess_config, trace,
+                     on_box: Optional[Callable] = None) -> Tuple[List[Dict], Dict]:
+        if self.session is None:
+            await asyncio.to_thread(self.warmup)
+        predictions, stats = await asyncio.to_thread(self.predict, image, trace)
+        if on_box is not None:
+            for prediction in predictions:
+                on_box(prediction)
+        return predictions, stats
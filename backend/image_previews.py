@@ -0,0 +1,134 @@
+"""
+Downscaled previews of uploaded screenshots.
+
+The annotation UI scales the whole page to fit the window, so it never needs
+every pixel of a very tall page. For each upload a JPEG preview (long side at
+most preview_max_side) is generated and drawn at the original size, so
+annotation coordinates always refer to original pixels.
+
+Previews are stored under a version derived from the source file's content,
+so a re-upload under the same name gets a new file and versioned URLs can be
+cached by browsers forever. Several worker processes may share the cache
+directory: every file is written under a temporary name and renamed into place.
+"""
+
+import os
+import shutil
+import hashlib
+import tempfile
+import threading
+from typing import Tuple
+
+from PIL import Image
+
+
+def flatten_rgb(image: Image.Image) -> Image.Image:
+    """Return an RGB copy with transparency composited on white"""
+    if image.mode in ("RGBA", "LA", "P"):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[3])
+        return background
+    return image.convert("RGB")
+
+
+class ImagePreviews:
+    """
+    Lazily generated previews for images in a directory.
+
+    Args:
+        source_dir (str): Directory with the original images (UPLOAD_DIR)
+        cache_dir (str): Directory the previews are written to
+        preview_max_side (int): Long side of the preview in pixels
+        quality (int): JPEG quality of the previews
+    """
+    def __init__(self, source_dir: str, cache_dir: str, preview_max_side: int = 2048, quality: int = 85):
+        self.source_dir = source_dir
+        self.cache_dir = cache_dir
+        self.preview_max_side = preview_max_side
+        self.quality = quality
+        self._versions = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def source_path(self, filename: str) -> str:
+        """Path of an uploaded image; raises FileNotFoundError for unknown or unsafe names"""
+        if os.path.basename(filename) != filename or filename.startswith("."):
+            raise FileNotFoundError(filename)
+        path = os.path.join(self.source_dir, filename)
+        if not os.path.isfile(path):
+            raise FileNotFoundError(filename)
+        return path
+
+    def version(self, filename: str) -> str:
+        """
+        Version of an image's preview: a hash of the source content and the
+        preview settings. Source files are only re-hashed when their size or
+        modification time changes.
+        """
+        stat = os.stat(self.source_path(filename))
+        with self._lock:
+            cached = self._versions.get(filename)
+        if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+            return cached[2]
+        hasher = hashlib.sha256(f"{self.preview_max_side}:{self.quality}:".encode())
+        with open(self.source_path(filename), "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                hasher.update(chunk)
+        version = hasher.hexdigest()[:16]
+        with self._lock:
+            self._versions[filename] = (stat.st_size, stat.st_mtime_ns, version)
+        return version
+
+    def _file_lock(self, filename: str) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(filename, threading.Lock())
+
+    def _version_dir(self, filename: str, version: str) -> str:
+        return os.path.join(self.cache_dir, filename, version)
+
+    def preview(self, filename: str) -> Tuple[str, str]:
+        """
+        Return (path, version) of the preview, generating it on first use.
+        A newly generated preview replaces the files of earlier uploads under
+        the same name.
+        """
+        version = self.version(filename)
+        path = os.path.join(self._version_dir(filename, version), "preview.jpg")
+        if os.path.isfile(path):
+            return path, version
+        with self._file_lock(filename):
+            if not os.path.isfile(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with Image.open(self.source_path(filename)) as image:
+                    image.draft("RGB", (self.preview_max_side, self.preview_max_side))
+                    preview = flatten_rgb(image)
+                preview.thumbnail((self.preview_max_side, self.preview_max_side), Image.Resampling.LANCZOS,
+                                  reducing_gap=3.0)
+                fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-", suffix=".jpg")
+                os.close(fd)
+                try:
+                    preview.save(temp_path, "JPEG", quality=self.quality)
+                    os.chmod(temp_path, 0o644)
+                    os.replace(temp_path, path)
+                except BaseException:
+                    if os.path.exists(temp_path):
+                        os.remove(temp_path)
+                    raise
+                self._remove_other_versions(filename, version)
+        return path, version
+
+    def _remove_other_versions(self, filename: str, version: str):
+        """Delete the previews of earlier uploads under the same name"""
+        # The source may have been re-uploaded while this preview was generated, possibly with
+        # its newer preview already written by another worker; only the current version cleans up
+        try:
+            current = self.version(filename)
+        except FileNotFoundError:
+            return
+        if current != version:
+            return
+        image_dir = os.path.join(self.cache_dir, filename)
+        for name in os.listdir(image_dir):
+            if name != version:
+                shutil.rmtree(os.path.join(image_dir, name), ignore_errors=True)
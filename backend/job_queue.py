@@ -0,0 +1,167 @@
+"""
+In-process job queue for batch predictions.
+
+A batch job is a list of image filenames from UPLOAD_DIR. Every image of every
+job goes through one shared asyncio queue that is drained by a fixed number of
+worker tasks, which bounds the number of concurrent model calls no matter how
+many jobs are submitted. Per-image results are appended to their job as they
+finish so clients can poll the job status or stream the results.
+"""
+
+import asyncio
+import time
+import uuid
+from collections import Counter, OrderedDict
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+
+class BatchJob:
+    """
+    A batch of images submitted together.
+
+    Attributes:
+        job_id (str): Unique identifier returned to the client
+        filenames (list): Image filenames (in UPLOAD_DIR) to predict
+        options (dict): Keyword arguments passed to the worker with every image
+        results (list): Per-image results, in completion order
+        created_at (float): Submission time (epoch seconds)
+        finished_at (float): Completion time, None while the job is running
+    """
+    def __init__(self, filenames: List[str], options: Optional[Dict] = None):
+        self.job_id = uuid.uuid4().hex
+        self.filenames = filenames
+        self.options = options or {}
+        self.results = []
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._changed = asyncio.Condition()
+
+    @property
+    def status(self) -> str:
+        if self.finished_at is not None:
+            return "completed"
+        if self.started_at is not None:
+            return "running"
+        return "queued"
+
+    async def add_result(self, result: Dict):
+        async with self._changed:
+            self.results.append(result)
+            if len(self.results) == len(self.filenames):
+                self.finished_at = time.time()
+            self._changed.notify_all()
+
+    async def fail_remaining(self, message: str):
+        """Record an error result for every image that has no result yet, finishing the job"""
+        async with self._changed:
+            missing = Counter(self.filenames) - Counter(result.get("source") for result in self.results)
+            for filename in missing.elements():
+                self.results.append({"source": filename, "status": "error", "message": message})
+            if self.finished_at is None:
+                self.finished_at = time.time()
+            self._changed.notify_all()
+
+    async def stream_results(self) -> AsyncIterator[Dict]:
+        """Yield every per-image result, waiting for the ones still in flight"""
+        index = 0
+        while index < len(self.filenames):
+            async with self._changed:
+                await self._changed.wait_for(lambda: len(self.results) > index)
+                pending = self.results[index:]
+            for result in pending:
+                yield result
+            index += len(pending)
+
+    def summary(self, include_results: bool = True) -> Dict:
+        succeeded = sum(1 for result in self.results if result.get("status") == "success")
+        summary = {
+            "job_id": self.job_id,
+            "status": self.status,
+            "total": len(self.filenames),
+            "completed": len(self.results),
+            "succeeded": succeeded,
+            "failed": len(self.results) - succeeded,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+        if include_results:
+            summary["results"] = list(self.results)
+        return summary
+
+
+class JobQueue:
+    """
+    Queue of batch jobs processed by a bounded pool of worker tasks.
+
+    Args:
+        worker (callable): Coroutine function taking an image filename (and the
+            job's options as keyword arguments) and returning the prediction
+            response dict
+        max_concurrency (int): Number of images predicted at the same time
+        max_finished_jobs (int): Number of finished jobs kept for status queries
+    """
+    def __init__(self, worker: Callable[..., Awaitable[Dict]], max_concurrency: int = 4,
+                 max_finished_jobs: int = 100):
+        self.worker = worker
+        self.max_concurrency = max_concurrency
+        self.max_finished_jobs = max_finished_jobs
+        self.jobs = OrderedDict()
+        self._queue = None
+        self._tasks = []
+
+    def start(self):
+        """Start the worker tasks (idempotent, must run inside the event loop)"""
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._run_worker()) for _ in range(self.max_concurrency)]
+
+    async def stop(self):
+        """
+        Cancel the worker tasks. Queued and in-flight images of unfinished jobs
+        get an error result, so clients streaming their results are not left waiting.
+        """
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for job in self.jobs.values():
+            if job.finished_at is None:
+                await job.fail_remaining("shutting down")
+
+    def submit(self, filenames: List[str], **options) -> BatchJob:
+        """Create a job for the given filenames and enqueue all of its images"""
+        self.start()
+        job = BatchJob(filenames, options)
+        self.jobs[job.job_id] = job
+        self._evict_finished_jobs()
+        for filename in filenames:
+            self._queue.put_nowait((job, filename))
+        return job
+
+    def get(self, job_id: str) -> Optional[BatchJob]:
+        return self.jobs.get(job_id)
+
+    def pending(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def _evict_finished_jobs(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished_at is not None]
+        for job_id in finished[:max(0, len(finished) - self.max_finished_jobs)]:
+            del self.jobs[job_id]
+
+    async def _run_worker(self):
+        while True:
+            job, filename = await self._queue.get()
+            try:
+                if job.started_at is None:
+                    job.started_at = time.time()
+                try:
+                    result = await self.worker(filename, **job.options)
+                    result = {"source": filename, **result}
+                except Exception as e:
+                    result = {"source": filename, "status": "error", "message": str(e)}
+                await job.add_result(result)
+            finally:
+                self._queue.task_done()
@@ -1,24 +1,66 @@
-from fastapi import FastAPI, UploadFile, File
+from fastapi import BackgroundTasks, FastAPI, UploadFile, File, Form, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
 import os
 import json
+import asyncio
+import hashlib
+import logging
+import time
 from datetime import datetime
-from typing import Optional
-from PIL import Image
+from urllib.parse import quote
+from typing import Callable, List, Optional
+from PIL import Image, UnidentifiedImageError
 import io
+import numpy as np
 import google.generativeai as genai
 from google.generativeai import types
 from dotenv import load_dotenv
+from prediction_cache import PredictionCache, make_cache_key
+from job_queue import JobQueue
+from preprocessing import PreprocessConfig, Tile, preprocess_image
+from postprocessing import PostprocessConfig, postprocess_predictions, weighted_box_fusion
+from box_set import BoxSet, LabelVocabulary
+from storage import FileTooLargeError, atomic_write_stream
+from background_writer import BackgroundWriter
+from box_store import BoxStore
+from detectors import Detector, OnnxDetector
+from response_parser import BoxStreamParser, normalize_label
+from dedup_index import DuplicateIndex, dhash
+from image_previews import ImagePreviews
+from upload_limit import UploadSizeLimit
+from observability import MetricsRegistry, RequestTrace, TraceSampler, configure_logging
 
 # Load environment variables
 load_dotenv()
 
+# Structured logging; LOG_LEVEL=DEBUG also logs raw model responses
+configure_logging()
+logger = logging.getLogger("backend")
+
 # Configure Gemini API
 GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
 genai.configure(api_key=GOOGLE_API_KEY)
 
 app = FastAPI()
+# Set once startup (model warm-up) has finished; cleared when shutting down
+app.state.ready = False
+STARTED_AT = time.time()
+# Number of uvicorn worker processes (see __main__); every worker sees the same value
+WORKERS = int(os.getenv('WORKERS', '1'))
+
+# Largest accepted upload, in bytes, and largest /predict/batch request body
+MAX_UPLOAD_BYTES = int(os.getenv('MAX_UPLOAD_BYTES', str(50 * 1024 * 1024)))
+MAX_BATCH_UPLOAD_BYTES = int(os.getenv('MAX_BATCH_UPLOAD_BYTES', str(500 * 1024 * 1024)))
+# Room for the multipart boundaries and part headers around an uploaded file
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+# Reject oversized upload bodies while they arrive, before Starlette spools them;
+# added before CORS so the 413 still carries the CORS headers
+app.add_middleware(UploadSizeLimit, limits={
+    "/upload": MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES,
+    "/predict/batch": MAX_BATCH_UPLOAD_BYTES,
+})
 
 # Configure CORS
 app.add_middleware(
@@ -29,44 +71,251 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Create directories if they don't exist
-UPLOAD_DIR = "uploads"
-ANNOTATIONS_DIR = "annotations"
-PREDICTIONS_DIR = "predictions"  # New directory for predictions
+# Create directories if they don't exist; with several workers they must be shared by all
+UPLOAD_DIR = os.getenv('UPLOAD_DIR', 'uploads')
+ANNOTATIONS_DIR = os.getenv('ANNOTATIONS_DIR', 'annotations')
+PREDICTIONS_DIR = os.getenv('PREDICTIONS_DIR', 'predictions')  # New directory for predictions
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(ANNOTATIONS_DIR, exist_ok=True)
 os.makedirs(PREDICTIONS_DIR, exist_ok=True)  # Create predictions directory
 
+# Downscaled previews served to the annotation UI instead of the full-size uploads
+PREVIEW_DIR = os.getenv('PREVIEW_DIR', 'previews')
+PREVIEW_PREGENERATE = os.getenv('PREVIEW_PREGENERATE', 'true').lower() in ("1", "true", "yes")
+previews = ImagePreviews(UPLOAD_DIR, PREVIEW_DIR, preview_max_side=int(os.getenv('PREVIEW_MAX_SIDE', '2048')))
+
+# Model settings used for UI element detection; run_experiments.py compares variants
+MODEL_NAME = os.getenv('GEMINI_MODEL', 'gemini-2.5-flash')
+DETECTION_PROMPT = """
+            Detect the 2d bounding boxes of 4 kinds of UI elements: Button, Input, Dropdown, Radio in UI screenshot, with no more than 20 items. Output a json list where each entry contains the 2D bounding box in "box_2d" and a text label in "label".
+            """
+GENERATION_CONFIG = {
+    "temperature": float(os.getenv('MODEL_TEMPERATURE', '0.5')),
+    "candidate_count": 1
+}
+# Gemini returns each box_2d as [y_min, x_min, y_max, x_max] normalized to 0-1000.
+# Saved boxes use image axes: "x"/"width" along the columns, "y"/"height" along the rows
+BOX_2D_ORDER = "y_min,x_min,y_max,x_max"
+# Short identifier of the prompt text, stored with predictions
+PROMPT_VERSION = hashlib.sha256(DETECTION_PROMPT.strip().encode()).hexdigest()[:12]
+
+# Ensemble mode: sample the model ENSEMBLE_SAMPLES times per image and merge the
+# responses with weighted box fusion (costs that many model calls per image)
+ENSEMBLE_SAMPLES = int(os.getenv('ENSEMBLE_SAMPLES', '1'))
+ENSEMBLE_IOU = float(os.getenv('ENSEMBLE_IOU', '0.55'))
+ENSEMBLE_MIN_VOTES = int(os.getenv('ENSEMBLE_MIN_VOTES', '0'))  # 0 = a majority of the samples
+
+# Where annotations and predictions are saved: "json" (one file per image in
+# ANNOTATIONS_DIR/PREDICTIONS_DIR), "sqlite" (the box store) or "both"
+STORAGE_FORMAT = os.getenv('STORAGE_FORMAT', 'json')
+BOX_STORE_PATH = os.getenv('BOX_STORE_PATH', 'boxes.db')
+box_store = BoxStore(BOX_STORE_PATH) if STORAGE_FORMAT in ("sqlite", "both") else None
+
+# Annotation and prediction files are written by a background thread that coalesces
+# repeated saves of the same file and syncs each batch of files together. Saves are
+# acknowledged once queued; SAVE_DURABLE (or ?durable=true) waits until the file is on disk
+WRITE_BATCH_INTERVAL_MS = float(os.getenv('WRITE_BATCH_INTERVAL_MS', '20'))
+WRITE_FSYNC = os.getenv('WRITE_FSYNC', 'true').lower() == 'true'
+SAVE_DURABLE = os.getenv('SAVE_DURABLE', 'false').lower() == 'true'
+writer = BackgroundWriter(flush_interval=WRITE_BATCH_INTERVAL_MS / 1000, fsync=WRITE_FSYNC)
+
+# Limits for calls to the model API
+MODEL_CONCURRENCY = int(os.getenv('MODEL_CONCURRENCY', '8'))  # Model calls in flight at once
+MODEL_TIMEOUT_SECONDS = float(os.getenv('MODEL_TIMEOUT_SECONDS', '120'))
+# Stream model responses so boxes are parsed (and sent over /predict/stream) as they arrive
+MODEL_STREAM = os.getenv('MODEL_STREAM', 'true').lower() in ("1", "true", "yes")
+# Responses of google-generativeai 0.3.x carry no token usage; with MODEL_COUNT_TOKENS the
+# tokens are measured with model.count_tokens instead (two extra API calls per model call)
+MODEL_COUNT_TOKENS = os.getenv('MODEL_COUNT_TOKENS', 'false').lower() in ("1", "true", "yes")
+model_semaphore = asyncio.Semaphore(MODEL_CONCURRENCY)
+
+# Gemini model client, created once at startup
+model = None
+# Clients for other model names, used by experiment variants
+variant_models = {}
+
+def get_model(model_name: Optional[str] = None):
+    """Return the shared Gemini model (or the client of another model name), creating it on first use"""
+    global model
+    if model_name is None or model_name == MODEL_NAME:
+        if model is None:
+            model = genai.GenerativeModel(MODEL_NAME)
+        return model
+    if model_name not in variant_models:
+        variant_models[model_name] = genai.GenerativeModel(model_name)
+    return variant_models[model_name]
+
+# Resizing, re-encoding and tiling applied before images are sent to the model
+PREPROCESS_CONFIG = PreprocessConfig.from_env()
+
+# NMS, size/aspect filtering and snapping applied to every detector's boxes
+POSTPROCESS_CONFIG = PostprocessConfig.from_env()
+
+# Prediction cache (memory LRU in front of the prediction files on disk)
+PREDICTION_CACHE_SIZE = int(os.getenv('PREDICTION_CACHE_SIZE', '256'))
+prediction_cache = PredictionCache(PREDICTIONS_DIR, max_entries=PREDICTION_CACHE_SIZE, store=box_store)
+
+# Near-duplicate screenshots (perceptual hash within DEDUP_MAX_DISTANCE bits) reuse an
+# earlier prediction instead of calling the model; disabled unless DEDUP_MAX_DISTANCE is set
+DEDUP_MAX_DISTANCE = int(os.getenv('DEDUP_MAX_DISTANCE', '-1'))
+DEDUP_DIRS = [d for d in os.getenv('DEDUP_DIRS', f'{UPLOAD_DIR},../Datasets').split(',') if d]
+DEDUP_HASH_CACHE = os.getenv('DEDUP_HASH_CACHE', 'dedup_hashes.json')
+dedup_index = DuplicateIndex(DEDUP_MAX_DISTANCE) if DEDUP_MAX_DISTANCE >= 0 else None
+
+# Number of images from /predict/batch jobs predicted at the same time
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', '4'))
+
+# Metrics exposed at /metrics in the Prometheus text format; each worker only has its own,
+# so with several workers every sample carries the worker's pid
+metrics = MetricsRegistry(prefix="ui_detection_",
+                          const_labels={"worker": str(os.getpid())} if WORKERS > 1 else None)
+REQUEST_SECONDS = metrics.histogram("http_request_duration_seconds", "HTTP request latency",
+                                    ["method", "path", "status"])
+STAGE_SECONDS = metrics.histogram("predict_stage_duration_seconds", "Time spent in each prediction stage",
+                                  ["stage"])
+PREDICTIONS = metrics.counter("predictions", "Predictions served, by backend and cache outcome",
+                              ["backend", "cache"])
+MODEL_ERRORS = metrics.counter("model_errors", "Failed model calls", ["reason"])
+PARSE_FAILURES = metrics.counter("parse_failures", "Model responses that could not be parsed as JSON")
+PARTIAL_RESPONSES = metrics.counter("partial_responses",
+                                    "Model responses that were truncated or had malformed entries (valid boxes kept)")
+DROPPED_BOXES = metrics.counter("dropped_boxes", "Boxes discarded while converting or post-processing model output", ["reason"])
+MODEL_TOKENS = metrics.counter("model_tokens", "Tokens billed for model calls", ["kind"])
+CACHE_ENTRIES = metrics.gauge("prediction_cache_entries", "Prediction cache entries", ["tier"])
+DEDUP_IMAGES = metrics.gauge("dedup_index_images", "Images in the near-duplicate index")
+BATCH_PENDING = metrics.gauge("batch_pending_images", "Images waiting in the batch queue")
+PENDING_WRITES = metrics.gauge("pending_writes", "Annotation and prediction files waiting to be written")
+BACKGROUND_WRITES = metrics.gauge("background_writes", "Background file writes since startup, by outcome",
+                                  ["outcome"])
+
+# Fraction of prediction traces appended to TRACE_FILE (0 disables sampling)
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '0'))
+TRACE_FILE = os.getenv('TRACE_FILE', 'traces.jsonl')
+trace_sampler = TraceSampler(TRACE_FILE, TRACE_SAMPLE_RATE)
+
+def start_trace(name: str) -> RequestTrace:
+    return RequestTrace(name, STAGE_SECONDS, trace_sampler)
+
+# Route templates used as the path label, so IDs in URLs do not create new series
+route_paths = {}
+
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    start_time = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        if not route_paths:
+            route_paths.update({route.endpoint: route.path for route in app.routes if hasattr(route, "endpoint")})
+        path = route_paths.get(request.scope.get("endpoint"), "unmatched")
+        REQUEST_SECONDS.observe(time.perf_counter() - start_time,
+                                method=request.method, path=path, status=status)
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    cache_stats = prediction_cache.stats()
+    CACHE_ENTRIES.set(cache_stats["memory_entries"], tier="memory")
+    if cache_stats["disk_entries"] is not None:
+        CACHE_ENTRIES.set(cache_stats["disk_entries"], tier="disk")
+    if dedup_index is not None:
+        DEDUP_IMAGES.set(len(dedup_index))
+    BATCH_PENDING.set(batch_queue.pending())
+    write_stats = writer.stats()
+    PENDING_WRITES.set(write_stats["pending"])
+    for outcome in ("writes", "coalesced", "errors", "fsyncs"):
+        BACKGROUND_WRITES.set(write_stats[outcome], outcome=outcome)
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+def read_image_size(filepath: str) -> tuple:
+    """Return (width, height, format) from the image header without decoding pixels"""
+    with Image.open(filepath) as image:
+        return image.width, image.height, image.format
+
 @app.post("/upload")
-async def upload_image(file: UploadFile = File(...)):
+async def upload_image(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
     try:
-        # Read image file
-        content = await file.read()
-        image = Image.open(io.BytesIO(content))
-        
-        # Save with original filename and dimensions
-        filename = file.filename
+        # Save with original filename, streaming the body to disk in chunks
+        filename = os.path.basename(file.filename)
         filepath = os.path.join(UPLOAD_DIR, filename)
+        image_info = {}
+
+        def check_image(temp_path):
+            # Only the header is read, pixels are never decoded
+            image_info["size"] = read_image_size(temp_path)
+
+        try:
+            await asyncio.to_thread(atomic_write_stream, file.file, filepath, MAX_UPLOAD_BYTES,
+                                    validate=check_image)
+        except (UnidentifiedImageError, Image.DecompressionBombError):
+            return JSONResponse(
+                status_code=400,
+                content={"message": f"Failed to upload image: {filename} is not a supported image"}
+            )
         
-        # Save the original image
-        image.save(filepath, format=image.format)
-        
+        # The preview is generated after the response is sent; its versioned URL can be cached forever
+        if PREVIEW_PREGENERATE:
+            background_tasks.add_task(generate_preview, filename)
+        preview_version = await asyncio.to_thread(previews.version, filename)
+
         # Return original image dimensions
-        width, height = image.size
+        width, height, _ = image_info["size"]
         return {
             "filename": filename,
             "width": width,
             "height": height,
+            "previewUrl": f"/images/{quote(filename)}/preview?v={preview_version}",
             "status": "success"
         }
+    except FileTooLargeError as e:
+        return JSONResponse(
+            status_code=413,
+            content={"message": f"Failed to upload image: {str(e)}"}
+        )
     except Exception as e:
         return JSONResponse(
             status_code=500,
             content={"message": f"Failed to upload image: {str(e)}"}
         )
 
+def generate_preview(filename: str):
+    """Background task: generate an upload's preview"""
+    try:
+        previews.preview(filename)
+    except Exception:
+        logger.exception("Preview generation failed", extra={"fields": {"image": filename}})
+
+def cached_image_response(request: Request, path: str, etag: str, immutable: bool) -> Response:
+    """
+    Serve a generated JPEG with an ETag. Requests that name the current
+    version (?v=) may be cached forever; others must be revalidated.
+    """
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "public, max-age=31536000, immutable" if immutable else "no-cache"
+    }
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type="image/jpeg", headers=headers)
+
+@app.get("/images/{filename}/preview")
+async def image_preview(request: Request, filename: str, v: Optional[str] = Query(None)):
+    try:
+        path, version = await asyncio.to_thread(previews.preview, filename)
+    except FileNotFoundError:
+        return JSONResponse(status_code=404, content={"message": f"Image not found: {filename}"})
+    return cached_image_response(request, path, f'"{version}"', v == version)
+
 @app.post("/save-annotations")
-async def save_annotations(data: dict):
+async def save_annotations(data: dict, durable: bool = Query(SAVE_DURABLE)):
+    """
+    Save the annotations of an image.
+
+    The JSON file is written in the background; with durable=true the response
+    is only sent once it is on disk.
+    """
     try:
         # Get the original image filename from the request
         image_filename = data.get('filename')
@@ -88,30 +337,90 @@ async def save_annotations(data: dict):
         }
         
         # Save annotations
-        with open(filepath, "w") as f:
-            json.dump(data_to_save, f, indent=2)
+        if STORAGE_FORMAT in ("json", "both"):
+            written = writer.write_json(filepath, data_to_save)
+            if durable:
+                await asyncio.wrap_future(written)
+        if box_store is not None:
+            await asyncio.to_thread(
+                box_store.save_annotations,
+                image_filename or os.path.splitext(filename)[0],
+                data.get("annotations", []),
+                {"width": data.get("imageWidth"), "height": data.get("imageHeight")}
+            )
         
-        return {"filename": filename, "status": "success"}
+        return {"filename": filename, "status": "success", "durable": durable}
     except Exception as e:
         return JSONResponse(
             status_code=500,
             content={"message": f"Failed to save annotations: {str(e)}"}
         )
 
-@app.post("/predict")
-async def predict_ui_elements(file: UploadFile = File(...)):
-    try:
-        # Check if API key is configured
-        if not GOOGLE_API_KEY:
-            return JSONResponse(
-                status_code=500,
-                content={"message": "Google API key not configured. Please add your API key to the .env file."}
-            )
+def predictions_dir_for(detector: Detector) -> str:
+    """Gemini predictions stay in PREDICTIONS_DIR; other backends get a subdirectory each"""
+    if detector.name == "gemini":
+        return PREDICTIONS_DIR
+    directory = os.path.join(PREDICTIONS_DIR, detector.name)
+    os.makedirs(directory, exist_ok=True)
+    return directory
 
-        # Read image file
-        content = await file.read()
+def save_predictions(image_filename: str, annotations: list, image_size: dict, cache_key: Optional[str] = None,
+                     preprocessing: Optional[dict] = None, image_hash: Optional[str] = None,
+                     detector: Optional[Detector] = None) -> tuple:
+    """
+    Save predictions for an image to PREDICTIONS_DIR and/or the box store.
+
+    Returns (filename, filepath); filepath is None when no JSON file is written.
+    """
+    detector = detector or detectors[DETECTOR_BACKEND]
+    # Save predictions with timestamp
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    # Get the input image name without extension
+    base_image_name = os.path.splitext(image_filename)[0]
+    filename = f"predictions_{base_image_name}.json"
+    filepath = os.path.join(predictions_dir_for(detector), filename)
+
+    data = {
+        "filename": image_filename,
+        "predictions": annotations,
+        "timestamp": timestamp,
+        "imageSize": image_size,
+        "cacheKey": cache_key,
+        "model": detector.model_name
+    }
+    if preprocessing is not None:
+        # Recorded so evaluation runs can be compared across preprocessing settings
+        data["preprocessing"] = preprocessing
+
+    if box_store is not None:
+        box_store.save_predictions(
+            image_filename, annotations, image_size, image_hash, detector.model_name, detector.prompt_version,
+            cache_key,
+            {"preprocessing": preprocessing} if preprocessing is not None else None, timestamp
+        )
+    if STORAGE_FORMAT not in ("json", "both"):
+        return filename, None
+
+    # Written in the background by atomic rename, so another worker writing the same file cannot tear it
+    writer.write_json(filepath, data)
+
+    return filename, filepath
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return prediction_cache.stats()
+
+class PredictionError(Exception):
+    """Raised when a prediction cannot be produced; the message is returned to the client"""
+
+def load_image(content: bytes, detector: Detector, preprocess_config: PreprocessConfig,
+               postprocess_config: PostprocessConfig, trace: RequestTrace) -> tuple:
+    """Decode an image, flatten it to RGB and return (image, cache_key)"""
+    with trace.span("decode"):
         original_image = Image.open(io.BytesIO(content))
-        
+        original_image.load()
+    
+    with trace.span("flatten"):
         # Convert RGBA to RGB if needed
         if original_image.mode == 'RGBA':
             # Create a white background image
@@ -121,127 +430,807 @@ async def predict_ui_elements(file: UploadFile = File(...)):
             original_image = background
         elif original_image.mode != 'RGB':
             original_image = original_image.convert('RGB')
-            
-        original_width, original_height = original_image.size
-            
+
+    with trace.span("cache_key"):
+        prompt, model_name, settings = detector.cache_identity(preprocess_config)
+        settings = {**settings, "postprocess": postprocess_config.as_dict()}
+        cache_key = make_cache_key(original_image, prompt, model_name, settings)
+    return original_image, cache_key
+
+def load_saved_prediction(image_filename: str, detector: Detector) -> Optional[dict]:
+    """Latest saved prediction document of an image made by this detector's model, if any"""
+    if box_store is not None:
+        return box_store.get_predictions(image_filename, detector.model_name, detector.prompt_version)
+    base_image_name = os.path.splitext(image_filename)[0]
+    filepath = os.path.join(predictions_dir_for(detector), f"predictions_{base_image_name}.json")
+    # A prediction saved moments ago may still be waiting in the writer
+    data = writer.pending_data(filepath)
+    if data is None:
         try:
-            # Create Gemini model
-            model = genai.GenerativeModel('gemini-2.5-flash')
-            
-            # Prepare prompt for UI element detection
-            prompt = """
-            Detect the 2d bounding boxes of 4 kinds of UI elements: Button, Input, Dropdown, Radio in UI screenshot, with no more than 20 items. Output a json list where each entry contains the 2D bounding box in "box_2d" and a text label in "label".
-            """
-            
-            print("Sending request to Gemini API...")
-            response = model.generate_content(
-                contents=[prompt, original_image],
-                generation_config=genai.types.GenerationConfig(
-                    temperature=0.5,
-                    candidate_count=1
+            with open(filepath) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+    # Files written before the model was recorded come from the default Gemini model
+    if data.get("model", MODEL_NAME) != detector.model_name:
+        return None
+    return data
+
+def find_duplicate_prediction(image: Image.Image, image_filename: str, detector: Detector) -> tuple:
+    """
+    Look up a near-duplicate of an image that already has a prediction.
+
+    Returns:
+        tuple: (perceptual hash of the image, (source filename, Hamming
+               distance, prediction document) or None)
+    """
+    image_hash = dhash(image, dedup_index.hash_size)
+    for distance, key in dedup_index.find(image_hash, image.width, image.height, exclude=image_filename):
+        document = load_saved_prediction(key, detector)
+        # Only reuse predictions that came from the model, never ones reused themselves
+        if document is None or (document.get("preprocessing") or {}).get("duplicate_of"):
+            continue
+        return image_hash, (key, distance, document)
+    return image_hash, None
+
+def scale_predictions(predictions: list, from_size: dict, to_size: dict) -> list:
+    """Rescale boxes predicted on an image of from_size to an image of to_size"""
+    scale_x = to_size["width"] / from_size["width"]
+    scale_y = to_size["height"] / from_size["height"]
+    if scale_x == 1 and scale_y == 1:
+        return predictions
+    return [
+        {
+            **prediction,
+            "coordinates": {
+                "x": round(prediction["coordinates"]["x"] * scale_x),
+                "y": round(prediction["coordinates"]["y"] * scale_y),
+                "width": round(prediction["coordinates"]["width"] * scale_x),
+                "height": round(prediction["coordinates"]["height"] * scale_y)
+            }
+        }
+        for prediction in predictions
+    ]
+
+def response_text(response) -> str:
+    """Text of a response or streamed chunk; empty when it has no text parts (e.g. blocked)"""
+    try:
+        return response.text
+    except ValueError:
+        return ""
+
+def response_usage(response) -> Optional[tuple]:
+    """
+    (prompt tokens, output tokens) reported with a response or streamed chunk, if any.
+
+    Only newer SDK versions return usage_metadata; see count_usage.
+    """
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None or not getattr(usage, "prompt_token_count", 0):
+        return None
+    return usage.prompt_token_count, getattr(usage, "candidates_token_count", 0) or 0
+
+async def call_model(tile: Tile, trace: RequestTrace, on_object: Optional[Callable] = None,
+                     prompt: str = DETECTION_PROMPT, model_name: Optional[str] = None,
+                     generation_config: Optional[dict] = None) -> dict:
+    """
+    Send one preprocessed image to Gemini and parse its boxes as the response arrives.
+
+    on_object is called with each box object ({"box_2d", "label"}) as soon as
+    it is complete. Returns the parser statistics and the token usage; the
+    token counts are None (and the response text is returned as
+    "response_text") when the response does not report usage.
+    """
+    parser = BoxStreamParser()
+    chunks = []
+    usage = [None]
+
+    def receive(response):
+        # Streamed chunks repeat the running usage; the last one is the total
+        usage[0] = response_usage(response) or usage[0]
+        text = response_text(response)
+        chunks.append(text)
+        for obj in parser.feed(text):
+            if on_object is not None:
+                on_object(obj)
+
+    async def read_response():
+        response = await get_model(model_name).generate_content_async(
+            contents=[prompt, tile.as_part()],
+            generation_config=genai.types.GenerationConfig(**(generation_config or GENERATION_CONFIG)),
+            stream=MODEL_STREAM
+        )
+        if not MODEL_STREAM:
+            receive(response)
+            return
+        async for chunk in response:
+            receive(chunk)
+
+    async with model_semaphore:
+        try:
+            with trace.span("model_call"):
+                await asyncio.wait_for(read_response(), timeout=MODEL_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            MODEL_ERRORS.inc(reason="timeout")
+            raise PredictionError(f"Gemini API did not respond within {MODEL_TIMEOUT_SECONDS:g} seconds. Please try again.")
+        except Exception:
+            MODEL_ERRORS.inc(reason="api_error")
+            raise
+    text = "".join(chunks)
+    stats = parser.close()
+    stats["prompt_tokens"], stats["output_tokens"] = usage[0] or (None, None)
+    if usage[0] is not None:
+        MODEL_TOKENS.inc(stats["prompt_tokens"], kind="prompt")
+        MODEL_TOKENS.inc(stats["output_tokens"], kind="output")
+    logger.debug("Received response from Gemini API", extra={"fields": {"response_text": text, **stats}})
+
+    # Check if response has text
+    if not text:
+        MODEL_ERRORS.inc(reason="empty_response")
+        raise PredictionError("No response from Gemini API. Please try again.")
+    if parser.found_nothing():
+        PARSE_FAILURES.inc()
+        logger.warning("Failed to parse model response", extra={"fields": stats})
+        raise PredictionError("Failed to parse API response as JSON. The model might not have returned valid JSON.")
+    if stats["malformed"] or stats["truncated"]:
+        # Boxes that did parse are kept instead of failing the whole request
+        PARTIAL_RESPONSES.inc()
+        logger.warning("Recovered boxes from a partial model response", extra={"fields": stats})
+    if usage[0] is None:
+        stats["response_text"] = text
+    return stats
+
+async def count_usage(tile: Tile, prompt: str, model_name: Optional[str], response_text: str) -> Optional[tuple]:
+    """(prompt tokens, output tokens) of a model call measured with count_tokens; None if counting fails"""
+    model = get_model(model_name)
+    try:
+        prompt_count, output_count = await asyncio.gather(
+            model.count_tokens_async([prompt, tile.as_part()]),
+            model.count_tokens_async(response_text)
+        )
+    except Exception as e:
+        logger.warning("Failed to count tokens", extra={"fields": {"error": str(e)}})
+        return None
+    MODEL_TOKENS.inc(prompt_count.total_tokens, kind="prompt")
+    MODEL_TOKENS.inc(output_count.total_tokens, kind="output")
+    return prompt_count.total_tokens, output_count.total_tokens
+
+def convert_box(pred: dict, tile: Tile, original_width: int, original_height: int) -> Optional[dict]:
+    """Convert one model box on a tile to original-image pixels; None if it is discarded"""
+    # Convert normalized coordinates to actual pixels
+    box = pred["box_2d"]
+
+    # Map label variants such as "Drop" to the canonical element types
+    element_type = normalize_label(pred["label"])
+
+    # Boxes come in 1000x1000 space (BOX_2D_ORDER) relative to the tile the model saw;
+    # the tile spans the full width and covers original rows [tile.top, tile.top + tile.height)
+    tile_bottom = tile.top + tile.height
+    # Convert from 1000x1000 space to actual image dimensions
+    y_min = int(max(tile.top, min(tile.top + (box[0] * tile.height) / 1000, tile_bottom)))
+    x_min = int(max(0, min((box[1] * original_width) / 1000, original_width)))
+    y_max = int(max(tile.top, min(tile.top + (box[2] * tile.height) / 1000, tile_bottom)))
+    x_max = int(max(0, min((box[3] * original_width) / 1000, original_width)))
+
+    # Additional validation
+    if x_min >= x_max or y_min >= y_max:
+        DROPPED_BOXES.inc(reason="invalid_dimensions")
+        logger.debug("Invalid box dimensions", extra={"fields": {
+            "x_min": x_min, "x_max": x_max, "y_min": y_min, "y_max": y_max
+        }})
+        return None
+
+    # Elements in the overlap of two tiles are kept by one tile only
+    if not tile.owns(y_min, y_max):
+        DROPPED_BOXES.inc(reason="tile_overlap")
+        return None
+
+    return {
+        "type": element_type,
+        "coordinates": {
+            "x": x_min,
+            "y": y_min,
+            "width": x_max - x_min,
+            "height": y_max - y_min
+        }
+    }
+
+def fuse_samples(sample_annotations: list, iou_threshold: float, min_votes: int) -> list:
+    """Merge the predictions of several model samples of one image with weighted box fusion"""
+    vocabulary = LabelVocabulary()
+    sample_sets = [BoxSet.from_predictions(annotations, vocabulary) for annotations in sample_annotations]
+    boxes = BoxSet.concatenate(sample_sets, vocabulary)
+    if not len(boxes):
+        return []
+    sample_ids = np.repeat(np.arange(len(sample_sets)), [len(sample_set) for sample_set in sample_sets])
+    fused, scores, labels, _ = weighted_box_fusion(
+        boxes.coords, boxes.score_array(), boxes.labels, sample_ids, len(sample_sets), iou_threshold, min_votes
+    )
+    # Fused boxes are averages; round them back to whole pixels
+    return BoxSet(np.round(fused), labels, np.round(scores, 4), vocabulary).to_predictions()
+
+class GeminiDetector(Detector):
+    """
+    Gemini vision model prompted for boxes, one remote call per image tile.
+
+    The default instance uses the module settings; experiment variants pass
+    their own prompt, model and generation settings. With samples > 1 every
+    tile is sent that many times and the responses are merged with weighted
+    box fusion, so boxes get a score (the share of samples that found them).
+
+    Args:
+        model_name (str): Gemini model name
+        prompt (str): Detection prompt
+        generation_config (dict): Generation parameters (temperature, ...)
+        samples (int): Model calls per tile whose boxes are fused
+        ensemble_iou (float): IoU above which boxes of different samples are fused
+        min_votes (int): Fused boxes found by fewer samples are dropped (0 = majority)
+        count_tokens (bool): Measure tokens with count_tokens when responses do not report usage
+    """
+    name = "gemini"
+
+    def __init__(self, model_name: str = MODEL_NAME, prompt: str = DETECTION_PROMPT,
+                 generation_config: Optional[dict] = None, samples: int = 1, ensemble_iou: float = 0.55,
+                 min_votes: int = 0, count_tokens: bool = MODEL_COUNT_TOKENS):
+        if samples < 1:
+            raise ValueError("samples must be at least 1")
+        self.model_name = model_name
+        self.prompt = prompt
+        self.generation_config = dict(generation_config or GENERATION_CONFIG)
+        self.samples = samples
+        self.ensemble_iou = ensemble_iou
+        self.min_votes = min_votes or samples // 2 + 1
+        self.count_tokens = count_tokens
+        self.prompt_version = hashlib.sha256(prompt.strip().encode()).hexdigest()[:12]
+
+    def settings(self) -> dict:
+        """Generation settings that change the predictions (the ensemble ones only when enabled)"""
+        settings = dict(self.generation_config)
+        if self.samples > 1:
+            settings["ensemble"] = {"samples": self.samples, "iou": self.ensemble_iou, "min_votes": self.min_votes}
+        return settings
+
+    def warmup(self):
+        get_model(self.model_name)
+
+    async def total_usage(self, parse_stats: list, tiles: list, trace: RequestTrace) -> dict:
+        """
+        Token usage of all model calls of an image, counted after model_ms is measured.
+
+        Calls whose response did not report usage are counted with count_tokens
+        when enabled; otherwise the token totals are None (unknown).
+        """
+        source = "response"
+        count_ms = None
+        # parse_stats is ordered by sample, then tile
+        missing = [(index, stats) for index, stats in enumerate(parse_stats) if stats["prompt_tokens"] is None]
+        if missing and self.count_tokens:
+            start = time.perf_counter()
+            with trace.span("count_tokens"):
+                counts = await asyncio.gather(*(
+                    count_usage(tiles[index % len(tiles)], self.prompt, self.model_name, stats["response_text"])
+                    for index, stats in missing
+                ))
+            for (_, stats), count in zip(missing, counts):
+                if count is not None:
+                    stats["prompt_tokens"], stats["output_tokens"] = count
+            source = "count_tokens"
+            count_ms = (time.perf_counter() - start) * 1000
+        for stats in parse_stats:
+            stats.pop("response_text", None)
+        known = all(stats["prompt_tokens"] is not None for stats in parse_stats)
+        usage = {"model_calls": len(parse_stats)}
+        for field in ("prompt_tokens", "output_tokens"):
+            usage[field] = sum(stats[field] for stats in parse_stats) if known else None
+        usage["source"] = source if known else None
+        if count_ms is not None:
+            usage["count_ms"] = count_ms
+        return usage
+
+    def cache_identity(self, preprocess_config: PreprocessConfig) -> tuple:
+        # The model sees the preprocessed image, so its settings are part of the key; the box
+        # order keeps entries cached before boxes were mapped to image axes from being reused
+        return self.prompt, self.model_name, {
+            **self.settings(), "preprocess": preprocess_config.as_dict(), "box_2d": BOX_2D_ORDER
+        }
+
+    async def detect(self, image: Image.Image, preprocess_config: PreprocessConfig,
+                     trace: RequestTrace, on_box: Optional[Callable] = None) -> tuple:
+        # Check if API key is configured
+        if not GOOGLE_API_KEY:
+            raise PredictionError("Google API key not configured. Please add your API key to the .env file.")
+
+        # Tile, downscale and re-encode before sending to the model
+        with trace.span("preprocess"):
+            tiles, preprocess_stats = await asyncio.to_thread(preprocess_image, image, preprocess_config)
+        original_width, original_height = image.size
+
+        # Boxes are converted to original pixels as each one is parsed from the stream.
+        # Ensembles only know their boxes after fusion, so they are not streamed.
+        tile_annotations = [[[] for _ in tiles] for _ in range(self.samples)]
+        stream_boxes = on_box if self.samples == 1 else None
+        model_start = time.perf_counter()
+
+        def collect(sample, index, tile):
+            def on_object(obj):
+                annotation = convert_box(obj, tile, original_width, original_height)
+                if annotation is None:
+                    return
+                if "first_box_ms" not in preprocess_stats:
+                    preprocess_stats["first_box_ms"] = (time.perf_counter() - model_start) * 1000
+                tile_annotations[sample][index].append(annotation)
+                if stream_boxes is not None:
+                    stream_boxes(annotation)
+            return on_object
+
+        try:
+            logger.debug("Sending request to Gemini API", extra={"fields": {
+                "tiles": len(tiles), "samples": self.samples
+            }})
+            with trace.span("model"):
+                parse_stats = await asyncio.gather(*(
+                    call_model(tile, trace, collect(sample, index, tile), self.prompt, self.model_name,
+                               self.generation_config)
+                    for sample in range(self.samples) for index, tile in enumerate(tiles)
+                ))
+                preprocess_stats["model_ms"] = (time.perf_counter() - model_start) * 1000
+            preprocess_stats["parser"] = {
+                "boxes": sum(stats["boxes"] for stats in parse_stats),
+                "malformed": sum(stats["malformed"] for stats in parse_stats),
+                "truncated": any(stats["truncated"] for stats in parse_stats),
+            }
+            preprocess_stats["usage"] = await self.total_usage(parse_stats, tiles, trace)
+            sample_annotations = [
+                [annotation for group in groups for annotation in group] for groups in tile_annotations
+            ]
+            if self.samples == 1:
+                annotations = sample_annotations[0]
+            else:
+                annotations = fuse_samples(sample_annotations, self.ensemble_iou, self.min_votes)
+                preprocess_stats["ensemble"] = {
+                    **self.settings()["ensemble"],
+                    "candidates": sum(len(group) for group in sample_annotations),
+                    "fused": len(annotations),
+                }
+                if on_box is not None:
+                    for annotation in annotations:
+                        on_box(annotation)
+
+        except PredictionError:
+            raise
+        except Exception as api_error:
+            logger.error("Gemini API error", extra={"fields": {"error": str(api_error)}})
+            raise PredictionError(f"Gemini API error: {str(api_error)}. Please check your API key and billing status.")
+
+        return annotations, {**preprocess_config.as_dict(), **preprocess_stats}
+
+# Detector backends by name; DETECTOR_BACKEND is used when a request does not pick one.
+# The local ONNX backend is available when ONNX_MODEL_PATH points to a model file.
+DETECTOR_BACKEND = os.getenv('DETECTOR_BACKEND', 'gemini')
+detectors = {"gemini": GeminiDetector(samples=ENSEMBLE_SAMPLES, ensemble_iou=ENSEMBLE_IOU,
+                                      min_votes=ENSEMBLE_MIN_VOTES)}
+if os.getenv('ONNX_MODEL_PATH'):
+    detectors["onnx"] = OnnxDetector.from_env()
+if DETECTOR_BACKEND not in detectors:
+    raise RuntimeError(f"DETECTOR_BACKEND={DETECTOR_BACKEND!r} is not available. Expected one of {sorted(detectors)}")
+
+def get_detector(name: Optional[str]) -> Detector:
+    """Return the named detector backend (the default one for None)"""
+    if name is None:
+        return detectors[DETECTOR_BACKEND]
+    if name not in detectors:
+        raise ValueError(f"Unknown detector backend: {name}. Available: {sorted(detectors)}")
+    return detectors[name]
+
+async def predict_image(content: bytes, image_filename: str, use_cache: bool = True,
+                        preprocess_config: Optional[PreprocessConfig] = None,
+                        trace: Optional[RequestTrace] = None, detector: Optional[Detector] = None,
+                        on_box: Optional[Callable] = None,
+                        postprocess_config: Optional[PostprocessConfig] = None) -> dict:
+    """
+    Run UI element detection on raw image bytes and save the predictions.
+
+    Returns the /predict response body. Raises PredictionError for failures
+    that should be reported to the client. Stage timings are recorded on trace,
+    and on_box is called with every detected box as soon as it is available
+    (before post-processing).
+    """
+    preprocess_config = preprocess_config or PREPROCESS_CONFIG
+    postprocess_config = postprocess_config or POSTPROCESS_CONFIG
+    detector = detector or get_detector(None)
+    trace = trace or start_trace("predict")
+    image_hash = hashlib.sha256(content).hexdigest()
+
+    # Decoding and hashing are CPU-bound, keep them off the event loop
+    original_image, cache_key = await asyncio.to_thread(
+        load_image, content, detector, preprocess_config, postprocess_config, trace
+    )
+    original_width, original_height = original_image.size
+    image_size = {
+        "width": original_width,
+        "height": original_height
+    }
+    perceptual_hash = None
+
+    # Serve repeated screenshots from the prediction cache
+    if use_cache:
+        with trace.span("cache_lookup"):
+            cached = await asyncio.to_thread(prediction_cache.get, cache_key)
+        if cached is not None:
+            logger.info("Prediction cache hit", extra={"fields": {"image": image_filename}})
+            with trace.span("save"):
+                filename, _ = await asyncio.to_thread(
+                    save_predictions, image_filename, cached["predictions"], cached["imageSize"], cache_key,
+                    None, image_hash, detector
                 )
-            )
-            print("Received response from Gemini API")
-            print("Raw response:", response.text)
-            
-            # Check if response has text
-            if not response.text:
-                return JSONResponse(
-                    status_code=500,
-                    content={"message": "No response from Gemini API. Please try again."}
+            PREDICTIONS.inc(backend=detector.name, cache="hit")
+            if on_box is not None:
+                for annotation in cached["predictions"]:
+                    on_box(annotation)
+            return {
+                "filename": filename,
+                "predictions": cached["predictions"],
+                "status": "success",
+                "imageSize": cached["imageSize"],
+                "cache": "hit",
+                "backend": detector.name,
+                "model": detector.model_name
+            }
+
+        # Near-identical frames of the same page reuse the earlier prediction
+        if dedup_index is not None:
+            with trace.span("dedup_lookup"):
+                perceptual_hash, duplicate = await asyncio.to_thread(
+                    find_duplicate_prediction, original_image, image_filename, detector
                 )
-            
-            # Parse the response and convert coordinates to actual pixels
-            try:
-                # Clean the response text - remove any markdown formatting if present
-                clean_text = response.text
-                if "```json" in clean_text:
-                    clean_text = clean_text.split("```json")[1].split("```")[0]
-                elif "```" in clean_text:
-                    clean_text = clean_text.split("```")[1]
-                
-                print("Cleaned response text:", clean_text)
-                predictions = json.loads(clean_text)
-                annotations = []
-                
-                for pred in predictions:
-                    # Convert normalized coordinates to actual pixels
-                    box = pred["box_2d"]              
-                    
-                    # Map "Drop" to "Dropdown" if needed
-                    element_type = "Dropdown" if pred["label"] == "Drop" else pred["label"]
-                    
-                    # Convert from 1000x1000 space to actual image dimensions
-                    x_min = int(max(0, min((box[0] * original_height) / 1000, original_height)))
-                    y_min = int(max(0, min((box[1] * original_width) / 1000, original_width)))
-                    x_max = int(max(0, min((box[2] * original_height) / 1000, original_height)))
-                    y_max = int(max(0, min((box[3] * original_width) / 1000, original_width)))
-                    
-                    # Additional validation
-                    if x_min >= x_max or y_min >= y_max:
-                        print(f"Invalid box dimensions: x_min={x_min}, x_max={x_max}, y_min={y_min}, y_max={y_max}")
-                        continue
-                    
-                    annotation = {
-                        "type": element_type,
-                        "coordinates": {
-                            "x": x_min,
-                            "y": y_min,
-                            "width": x_max - x_min,
-                            "height": y_max - y_min
-                        }
-                    }
-                    annotations.append(annotation)
-                
-                # Save predictions with timestamp
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                # Get the input image name without extension
-                base_image_name = os.path.splitext(file.filename)[0]
-                filename = f"predictions_{base_image_name}.json"
-                filepath = os.path.join(PREDICTIONS_DIR, filename)
-                
-                with open(filepath, "w") as f:
-                    json.dump({
-                        "filename": file.filename,
-                        "predictions": annotations,
-                        "timestamp": timestamp,
-                        "imageSize": {
-                            "width": original_width,
-                            "height": original_height
-                        }
-                    }, f, indent=2)
-                
+            if duplicate is not None:
+                source, distance, document = duplicate
+                annotations = scale_predictions(document["predictions"], document["imageSize"], image_size)
+                annotations, _ = postprocess_predictions(annotations, postprocess_config, image_size)
+                logger.info("Near-duplicate prediction reused", extra={"fields": {
+                    "image": image_filename, "duplicate_of": source, "distance": distance
+                }})
+                with trace.span("save"):
+                    filename, filepath = await asyncio.to_thread(
+                        save_predictions, image_filename, annotations, image_size, cache_key,
+                        {"duplicate_of": source, "hamming_distance": distance}, image_hash, detector
+                    )
+                prediction_cache.put(cache_key, {"predictions": annotations, "imageSize": image_size}, filepath)
+                PREDICTIONS.inc(backend=detector.name, cache="near_duplicate")
+                if on_box is not None:
+                    for annotation in annotations:
+                        on_box(annotation)
                 return {
                     "filename": filename,
                     "predictions": annotations,
                     "status": "success",
-                    "imageSize": {
-                        "width": original_width,
-                        "height": original_height
-                    }
+                    "imageSize": image_size,
+                    "cache": "near_duplicate",
+                    "duplicateOf": source,
+                    "hammingDistance": distance,
+                    "backend": detector.name,
+                    "model": detector.model_name
                 }
-                
-            except json.JSONDecodeError:
-                print("Raw API response:", response.text)  # Log the raw response
+    else:
+        prediction_cache.record_bypass()
+
+    annotations, stats = await detector.detect(original_image, preprocess_config, trace, on_box)
+    stats["original_bytes"] = len(content)
+
+    with trace.span("postprocess"):
+        annotations, postprocess_stats = postprocess_predictions(annotations, postprocess_config, image_size)
+    DROPPED_BOXES.inc(postprocess_stats["filtered"], reason="filtered")
+    DROPPED_BOXES.inc(postprocess_stats["suppressed"], reason="nms")
+    stats["postprocess"] = {**postprocess_config.as_dict(), **postprocess_stats}
+
+    with trace.span("save"):
+        filename, filepath = await asyncio.to_thread(
+            save_predictions, image_filename, annotations, image_size, cache_key, stats, image_hash, detector
+        )
+    prediction_cache.put(cache_key, {"predictions": annotations, "imageSize": image_size}, filepath)
+    if perceptual_hash is not None:
+        dedup_index.add(image_filename, perceptual_hash, original_width, original_height)
+    PREDICTIONS.inc(backend=detector.name, cache="miss" if use_cache else "bypass")
+    logger.info("Prediction complete", extra={"fields": {
+        "image": image_filename, "backend": detector.name, "boxes": len(annotations), **stats
+    }})
+
+    return {
+        "filename": filename,
+        "predictions": annotations,
+        "status": "success",
+        "imageSize": image_size,
+        "cache": "miss" if use_cache else "bypass",
+        "backend": detector.name,
+        "model": detector.model_name,
+        "preprocessing": stats
+    }
+
+@app.post("/predict")
+async def predict_ui_elements(
+    file: UploadFile = File(...),
+    use_cache: bool = Query(True, description="Set to false to force a fresh model call"),
+    max_side: Optional[int] = Query(None, ge=0, description="Max long side sent to the model (0 = original size)"),
+    image_format: Optional[str] = Query(None, description="Encoding sent to the model: JPEG, WEBP or PNG"),
+    quality: Optional[int] = Query(None, ge=1, le=100, description="JPEG/WebP quality"),
+    tile_aspect: Optional[float] = Query(None, ge=0, description="Tile pages taller than tile_aspect x width (0 = no tiling)"),
+    backend: Optional[str] = Query(None, description="Detector backend (defaults to DETECTOR_BACKEND)"),
+    nms_iou: Optional[float] = Query(None, ge=0, le=1, description="Per-type NMS IoU threshold (0 = off)"),
+    cross_class_iou: Optional[float] = Query(None, ge=0, le=1, description="Cross-type NMS IoU threshold (0 = off)"),
+    min_area: Optional[float] = Query(None, ge=0, description="Drop boxes smaller than this many square pixels"),
+    min_aspect: Optional[float] = Query(None, ge=0, description="Drop boxes with width / height below this"),
+    max_aspect: Optional[float] = Query(None, ge=0, description="Drop boxes with width / height above this (0 = no limit)")
+):
+    trace = start_trace("predict")
+    outcome = "error"
+    try:
+        try:
+            preprocess_config = PREPROCESS_CONFIG.override(max_side, image_format, quality, tile_aspect)
+            postprocess_config = POSTPROCESS_CONFIG.override(nms_iou, cross_class_iou, min_area, min_aspect, max_aspect)
+            detector = get_detector(backend)
+        except ValueError as e:
+            return JSONResponse(status_code=400, content={"message": str(e)})
+
+        # Read image file
+        with trace.span("read_upload"):
+            content = await file.read()
+        result = await predict_image(content, file.filename, use_cache, preprocess_config, trace, detector,
+                                     postprocess_config=postprocess_config)
+        outcome = result["cache"]
+        return result
+    except PredictionError as e:
+        return JSONResponse(
+            status_code=500,
+            content={"message": str(e)}
+        )
+    except Exception as e:
+        logger.exception("Prediction failed", extra={"fields": {"image": file.filename, "backend": backend}})
+        return JSONResponse(
+            status_code=500,
+            content={"message": f"Failed to predict UI elements: {str(e)}"}
+        )
+    finally:
+        trace.finish(image=file.filename, outcome=outcome)
+
+@app.post("/predict/stream")
+async def predict_ui_elements_stream(
+    file: UploadFile = File(...),
+    use_cache: bool = Query(True, description="Set to false to force a fresh model call"),
+    max_side: Optional[int] = Query(None, ge=0, description="Max long side sent to the model (0 = original size)"),
+    image_format: Optional[str] = Query(None, description="Encoding sent to the model: JPEG, WEBP or PNG"),
+    quality: Optional[int] = Query(None, ge=1, le=100, description="JPEG/WebP quality"),
+    tile_aspect: Optional[float] = Query(None, ge=0, description="Tile pages taller than tile_aspect x width (0 = no tiling)"),
+    backend: Optional[str] = Query(None, description="Detector backend (defaults to DETECTOR_BACKEND)"),
+    nms_iou: Optional[float] = Query(None, ge=0, le=1, description="Per-type NMS IoU threshold (0 = off)"),
+    cross_class_iou: Optional[float] = Query(None, ge=0, le=1, description="Cross-type NMS IoU threshold (0 = off)"),
+    min_area: Optional[float] = Query(None, ge=0, description="Drop boxes smaller than this many square pixels"),
+    min_aspect: Optional[float] = Query(None, ge=0, description="Drop boxes with width / height below this"),
+    max_aspect: Optional[float] = Query(None, ge=0, description="Drop boxes with width / height above this (0 = no limit)")
+):
+    """
+    Same as /predict, but streams server-sent events while the model responds:
+    a "box" event per detected box as soon as it is parsed, then one "result"
+    event with the full /predict response, or an "error" event with a message.
+    Box events come before post-processing; the result holds the final boxes.
+    """
+    try:
+        preprocess_config = PREPROCESS_CONFIG.override(max_side, image_format, quality, tile_aspect)
+        postprocess_config = POSTPROCESS_CONFIG.override(nms_iou, cross_class_iou, min_area, min_aspect, max_aspect)
+        detector = get_detector(backend)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"message": str(e)})
+
+    trace = start_trace("predict_stream")
+    with trace.span("read_upload"):
+        content = await file.read()
+    events = asyncio.Queue()
+
+    async def run_prediction():
+        try:
+            result = await predict_image(content, file.filename, use_cache, preprocess_config, trace, detector,
+                                         on_box=lambda box: events.put_nowait(("box", box)),
+                                         postprocess_config=postprocess_config)
+            events.put_nowait(("result", result))
+        except PredictionError as e:
+            events.put_nowait(("error", {"message": str(e)}))
+        except Exception as e:
+            logger.exception("Prediction failed", extra={"fields": {"image": file.filename, "backend": backend}})
+            events.put_nowait(("error", {"message": f"Failed to predict UI elements: {str(e)}"}))
+
+    async def event_stream():
+        task = asyncio.create_task(run_prediction())
+        outcome = "error"
+        try:
+            while True:
+                event, data = await events.get()
+                if event == "result":
+                    outcome = data["cache"]
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+                if event != "box":
+                    break
+        finally:
+            # The client went away before the prediction finished
+            if not task.done():
+                task.cancel()
+            trace.finish(image=file.filename, outcome=outcome)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+async def predict_uploaded_file(filename: str, backend: Optional[str] = None) -> dict:
+    """Batch worker: predict an image previously stored in UPLOAD_DIR"""
+    trace = start_trace("batch_predict")
+    outcome = "error"
+    try:
+        with trace.span("read_upload"):
+            with open(os.path.join(UPLOAD_DIR, filename), "rb") as f:
+                content = f.read()
+        result = await predict_image(content, filename, trace=trace, detector=get_detector(backend))
+        outcome = result["cache"]
+        return result
+    except PredictionError as e:
+        return {"status": "error", "message": str(e)}
+    finally:
+        trace.finish(image=filename, outcome=outcome)
+
+batch_queue = JobQueue(predict_uploaded_file, max_concurrency=BATCH_CONCURRENCY)
+
+def batch_jobs_unavailable() -> Optional[JSONResponse]:
+    """
+    Batch jobs live in the memory of the worker that created them, so a job's
+    status and results requests could reach a worker that does not know it.
+    """
+    if WORKERS > 1:
+        return JSONResponse(
+            status_code=501,
+            content={"message": "Batch jobs are only available with a single worker (WORKERS=1)"}
+        )
+    return None
+
+@app.on_event("startup")
+async def startup():
+    start = time.perf_counter()
+    # Load and warm every configured backend before serving requests
+    for detector in detectors.values():
+        await asyncio.to_thread(detector.warmup)
+    # Index the prediction files now rather than on the first request
+    await asyncio.to_thread(prediction_cache.refresh)
+    if WORKERS == 1:
+        batch_queue.start()
+    writer.start()
+    if dedup_index is not None:
+        # Hashing existing screenshots can take a while; requests are served meanwhile
+        app.state.dedup_scan = asyncio.create_task(build_dedup_index())
+    app.state.ready = True
+    logger.info("Worker ready", extra={"fields": {
+        "pid": os.getpid(), "backends": sorted(detectors), "seconds": round(time.perf_counter() - start, 2)
+    }})
+
+async def build_dedup_index():
+    start = time.perf_counter()
+    count = await asyncio.to_thread(dedup_index.scan, DEDUP_DIRS, DEDUP_HASH_CACHE)
+    logger.info("Near-duplicate index built", extra={"fields": {
+        "images": count, "dirs": DEDUP_DIRS, "seconds": round(time.perf_counter() - start, 2)
+    }})
+
+@app.on_event("shutdown")
+async def shutdown():
+    app.state.ready = False
+    await batch_queue.stop()
+    # Saves were acknowledged before reaching disk; write them all before exiting
+    pending = writer.pending()
+    await asyncio.to_thread(writer.stop)
+    logger.info("Pending writes flushed", extra={"fields": {"files": pending}})
+
+@app.get("/health/live")
+async def liveness():
+    """The process is up and serving requests"""
+    return {"status": "alive", "pid": os.getpid(), "uptime_seconds": round(time.time() - STARTED_AT, 1)}
+
+@app.get("/health/ready")
+async def readiness():
+    """The worker has finished warming up and can write to the shared storage"""
+    checks = {
+        "started": app.state.ready,
+        "storage": all(os.access(directory, os.W_OK) for directory in (UPLOAD_DIR, ANNOTATIONS_DIR, PREDICTIONS_DIR)),
+    }
+    ready = all(checks.values())
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={"status": "ready" if ready else "not_ready", "pid": os.getpid(), "checks": checks}
+    )
+
+@app.post("/predict/batch")
+async def predict_batch(
+    files: List[UploadFile] = File([]),
+    filenames: List[str] = Form([]),
+    backend: Optional[str] = Form(None)
+):
+    """
+    Enqueue many images for prediction and return a job ID right away.
+
+    Images can be sent as multipart files (they are stored in UPLOAD_DIR like
+    /upload does) and/or referenced by the filenames of earlier uploads.
+    backend picks the detector for the whole job.
+    """
+    unavailable = batch_jobs_unavailable()
+    if unavailable is not None:
+        return unavailable
+    try:
+        try:
+            get_detector(backend)
+        except ValueError as e:
+            return JSONResponse(status_code=400, content={"message": str(e)})
+
+        queued = []
+        for upload in files:
+            filename = os.path.basename(upload.filename)
+            await asyncio.to_thread(atomic_write_stream, upload.file, os.path.join(UPLOAD_DIR, filename), MAX_UPLOAD_BYTES)
+            queued.append(filename)
+
+        for name in filenames:
+            filename = os.path.basename(name)
+            if not os.path.isfile(os.path.join(UPLOAD_DIR, filename)):
                 return JSONResponse(
-                    status_code=500,
-                    content={"message": "Failed to parse API response as JSON. The model might not have returned valid JSON."}
+                    status_code=404,
+                    content={"message": f"Uploaded file not found: {filename}"}
                 )
-                
-        except Exception as api_error:
-            print("Gemini API error:", str(api_error))  # Log API-specific error
+            queued.append(filename)
+
+        if not queued:
             return JSONResponse(
-                status_code=500,
-                content={"message": f"Gemini API error: {str(api_error)}. Please check your API key and billing status."}
+                status_code=400,
+                content={"message": "No images provided. Send files or filenames of uploaded images."}
             )
-            
+
+        job = batch_queue.submit(queued, backend=backend)
+        return {
+            "job_id": job.job_id,
+            "status": job.status,
+            "total": len(queued),
+            "status_url": f"/predict/batch/{job.job_id}",
+            "results_url": f"/predict/batch/{job.job_id}/results"
+        }
+    except FileTooLargeError as e:
+        return JSONResponse(
+            status_code=413,
+            content={"message": f"Failed to create batch job: {str(e)}"}
+        )
     except Exception as e:
-        print("General error:", str(e))  # Log general error
         return JSONResponse(
             status_code=500,
-            content={"message": f"Failed to predict UI elements: {str(e)}"}
+            content={"message": f"Failed to create batch job: {str(e)}"}
         )
 
+@app.get("/predict/batch/{job_id}")
+async def batch_status(job_id: str, include_results: bool = True):
+    unavailable = batch_jobs_unavailable()
+    if unavailable is not None:
+        return unavailable
+    job = batch_queue.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"message": f"Unknown job: {job_id}"})
+    return job.summary(include_results)
+
+@app.get("/predict/batch/{job_id}/results")
+async def batch_results(job_id: str):
+    """Stream per-image results as newline-delimited JSON as they complete"""
+    unavailable = batch_jobs_unavailable()
+    if unavailable is not None:
+        return unavailable
+    job = batch_queue.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"message": f"Unknown job: {job_id}"})
+
+    async def result_lines():
+        async for result in job.stream_results():
+            yield json.dumps(result) + "\n"
+
+    return StreamingResponse(result_lines(), media_type="application/x-ndjson")
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000) 
\ No newline at end of file
+    # Several worker processes share the directories above and the box store;
+    # uvicorn needs the import string to start them
+    uvicorn.run("main:app" if WORKERS > 1 else app, host=os.getenv('HOST', '0.0.0.0'),
+                port=int(os.getenv('PORT', '8000')), workers=WORKERS,
+                timeout_graceful_shutdown=int(os.getenv('GRACEFUL_SHUTDOWN_SECONDS', '30')))
\ No newline at end of file
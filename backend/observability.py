@@ -0,0 +1,307 @@
+"""
+Metrics, request tracing and logging setup for the backend.
+
+Metrics are kept in process and rendered in the Prometheus text exposition
+format by the /metrics endpoint:
+- Counter: monotonically increasing count (model errors, dropped boxes, ...)
+- Gauge: value sampled when metrics are rendered (cache size, queue length)
+- Histogram: latency distribution with cumulative buckets
+
+A RequestTrace times the stages of one request. Every stage duration feeds a
+histogram, and a sampled fraction of complete traces is appended to a local
+JSON-lines file for offline inspection.
+"""
+
+import os
+import json
+import time
+import random
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Bucket upper bounds in seconds; the top buckets cover slow model calls
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(labelnames: Sequence[str], labelvalues: Sequence[str], extra: Optional[Tuple] = None,
+                   const_labels: Sequence[Tuple[str, str]] = ()) -> str:
+    pairs = list(const_labels) + list(zip(labelnames, labelvalues))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class _Metric:
+    """Base class holding one value (or bucket set) per label combination"""
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 const_labels: Optional[Dict[str, str]] = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # Labels added to every sample, e.g. the worker process
+        self.const_labels = tuple((const_labels or {}).items())
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key: Tuple[str, ...], extra: Optional[Tuple] = None) -> str:
+        return _format_labels(self.labelnames, key, extra, self.const_labels)
+
+    def _samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _samples(self) -> Iterator[str]:
+        if not self.labelnames and not self._values:
+            yield f"{self.name}_total{self._labels(())} 0"
+        for key, value in sorted(self._values.items()):
+            yield f"{self.name}_total{self._labels(key)} {_format_value(value)}"
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def _samples(self) -> Iterator[str]:
+        for key, value in sorted(self._values.items()):
+            yield f"{self.name}{self._labels(key)} {_format_value(value)}"
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS, const_labels: Optional[Dict[str, str]] = None):
+        super().__init__(name, documentation, labelnames, const_labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [per-bucket counts, sum]; buckets are made cumulative on render
+                state = self._values[key] = [[0] * len(self.buckets), 0.0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][index] += 1
+                    break
+            state[1] += value
+
+    def _samples(self) -> Iterator[str]:
+        for key, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = self._labels(key, ("le", _format_value(bound)))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = self._labels(key)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class MetricsRegistry:
+    """
+    Creates metrics and renders all of them for the /metrics endpoint.
+
+    Args:
+        prefix (str): Prepended to every metric name
+        const_labels (dict): Labels added to every sample of every metric
+    """
+    def __init__(self, prefix: str = "", const_labels: Optional[Dict[str, str]] = None):
+        self.prefix = prefix
+        self.const_labels = const_labels
+        self._metrics = []
+
+    def _register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(self.prefix + name, documentation, labelnames, self.const_labels))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(self.prefix + name, documentation, labelnames, self.const_labels))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(self.prefix + name, documentation, labelnames, buckets, self.const_labels))
+
+    def render(self) -> str:
+        """Return every metric in the Prometheus text exposition format (version 0.0.4)"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class TraceSampler:
+    """
+    Appends a random sample of request traces to a JSON-lines file.
+
+    Attributes:
+        path (str): File the sampled traces are appended to
+        rate (float): Fraction of traces written (0 disables sampling)
+    """
+    def __init__(self, path: str, rate: float = 0.0):
+        if not 0 <= rate <= 1:
+            raise ValueError("trace sample rate must be between 0 and 1")
+        self.path = path
+        self.rate = rate
+        self._lock = threading.Lock()
+
+    def should_sample(self) -> bool:
+        return self.rate > 0 and random.random() < self.rate
+
+    def write(self, record: Dict):
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(line)
+
+
+class RequestTrace:
+    """
+    Timing spans of one request.
+
+    Each span is recorded into stage_histogram under its stage name; when the
+    trace is finished it is written to the sampler if it was picked.
+
+    Attributes:
+        name (str): Operation being traced, e.g. "predict"
+        attributes (dict): Extra fields written with a sampled trace
+        spans (list): (stage, start offset in seconds, duration in seconds)
+    """
+    def __init__(self, name: str, stage_histogram: Histogram, sampler: Optional[TraceSampler] = None):
+        self.name = name
+        self.stage_histogram = stage_histogram
+        self.sampler = sampler
+        self.sampled = sampler is not None and sampler.should_sample()
+        self.attributes = {}
+        self.spans = []
+        self._start = time.perf_counter()
+        self._started_at = datetime.now(timezone.utc).isoformat()
+
+    @contextmanager
+    def span(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, start, time.perf_counter() - start)
+
+    def record(self, stage: str, start: float, duration: float):
+        """Record a span measured elsewhere (start is a time.perf_counter value)"""
+        self.stage_histogram.observe(duration, stage=stage)
+        self.spans.append((stage, start - self._start, duration))
+
+    def stage_ms(self) -> Dict[str, float]:
+        """Total milliseconds per stage (stages that ran several times are summed)"""
+        totals = {}
+        for stage, _, duration in self.spans:
+            totals[stage] = totals.get(stage, 0.0) + duration * 1000
+        return totals
+
+    def finish(self, **attributes) -> float:
+        """Close the trace, write it if sampled and return its duration in seconds"""
+        duration = time.perf_counter() - self._start
+        self.attributes.update(attributes)
+        if self.sampled:
+            self.sampler.write({
+                "name": self.name,
+                "started_at": self._started_at,
+                "duration_ms": duration * 1000,
+                **self.attributes,
+                "spans": [
+                    {"stage": stage, "offset_ms": offset * 1000, "duration_ms": span_duration * 1000}
+                    for stage, offset, span_duration in self.spans
+                ],
+            })
+        return duration
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with the fields passed as extra={"fields": {...}}"""
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            **getattr(record, "fields", {}),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class KeyValueFormatter(logging.Formatter):
+    """Human readable lines ending in key=value pairs from extra={"fields": {...}}"""
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + " ".join(f"{key}={json.dumps(value, default=str)}" for key, value in fields.items())
+        return line
+
+
+def configure_logging(level: Optional[str] = None, log_format: Optional[str] = None):
+    """
+    Configure the root logger from LOG_LEVEL (default INFO) and LOG_FORMAT
+    ("text" or "json", default "text").
+    """
+    level = (level or os.getenv("LOG_LEVEL", "INFO")).upper()
+    log_format = (log_format or os.getenv("LOG_FORMAT", "text")).lower()
+    if log_format not in ("text", "json"):
+        raise ValueError(f"Unsupported log format: {log_format}. Expected text or json")
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if log_format == "json" else KeyValueFormatter())
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
@@ -0,0 +1,268 @@
+"""
+Box post-processing applied to detector output.
+
+The model often returns overlapping or duplicated boxes for the same element.
+All boxes of an image are processed at once as NumPy arrays (a BoxSet):
+- boxes are snapped to the image bounds
+- boxes below a minimum area or outside an aspect-ratio range are dropped
+- non-maximum suppression (NMS) removes boxes overlapping a higher-scored box
+  of the same type and, optionally, of any type
+
+Boxes without a score (Gemini) count as equally confident, so the earlier
+box wins. The evaluator uses the same functions to measure the effect on
+precision and recall.
+
+weighted_box_fusion merges the boxes of several sampled model responses for
+the same image (ensemble mode): overlapping boxes of the same type are
+averaged instead of suppressed, and each fused box is scored by how many
+samples agree on it.
+"""
+
+import os
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from box_set import BoxSet
+
+
+class PostprocessConfig:
+    """
+    Settings for the post-processing stage.
+
+    Attributes:
+        nms_iou (float): IoU above which a box is suppressed by a higher-scored
+            box of the same type (0 disables per-type NMS)
+        cross_class_iou (float): IoU above which a box is suppressed by a
+            higher-scored box of any type (0 disables cross-type NMS)
+        min_area (float): Drop boxes smaller than this many square pixels
+        min_aspect (float): Drop boxes whose width / height is below this (0 = no limit)
+        max_aspect (float): Drop boxes whose width / height is above this (0 = no limit)
+        clip (bool): Snap boxes to the image bounds
+    """
+    def __init__(self, nms_iou: float = 0.6, cross_class_iou: float = 0.0, min_area: float = 0.0,
+                 min_aspect: float = 0.0, max_aspect: float = 0.0, clip: bool = True):
+        for name, value in (("nms_iou", nms_iou), ("cross_class_iou", cross_class_iou)):
+            if not 0 <= value <= 1:
+                raise ValueError(f"{name} must be between 0 and 1")
+        if min_area < 0 or min_aspect < 0 or max_aspect < 0:
+            raise ValueError("min_area, min_aspect and max_aspect must not be negative")
+        if max_aspect and min_aspect > max_aspect:
+            raise ValueError("min_aspect must not exceed max_aspect")
+        self.nms_iou = nms_iou
+        self.cross_class_iou = cross_class_iou
+        self.min_area = min_area
+        self.min_aspect = min_aspect
+        self.max_aspect = max_aspect
+        self.clip = clip
+
+    @classmethod
+    def from_env(cls) -> "PostprocessConfig":
+        return cls(
+            nms_iou=float(os.getenv("POSTPROCESS_NMS_IOU", "0.6")),
+            cross_class_iou=float(os.getenv("POSTPROCESS_CROSS_CLASS_IOU", "0")),
+            min_area=float(os.getenv("POSTPROCESS_MIN_AREA", "0")),
+            min_aspect=float(os.getenv("POSTPROCESS_MIN_ASPECT", "0")),
+            max_aspect=float(os.getenv("POSTPROCESS_MAX_ASPECT", "0")),
+            clip=os.getenv("POSTPROCESS_CLIP", "true").lower() in ("1", "true", "yes"),
+        )
+
+    def override(self, nms_iou: Optional[float] = None, cross_class_iou: Optional[float] = None,
+                 min_area: Optional[float] = None, min_aspect: Optional[float] = None,
+                 max_aspect: Optional[float] = None) -> "PostprocessConfig":
+        """Return a copy with the given per-request settings replaced"""
+        return PostprocessConfig(
+            nms_iou=self.nms_iou if nms_iou is None else nms_iou,
+            cross_class_iou=self.cross_class_iou if cross_class_iou is None else cross_class_iou,
+            min_area=self.min_area if min_area is None else min_area,
+            min_aspect=self.min_aspect if min_aspect is None else min_aspect,
+            max_aspect=self.max_aspect if max_aspect is None else max_aspect,
+            clip=self.clip,
+        )
+
+    def as_dict(self) -> Dict:
+        return {
+            "nms_iou": self.nms_iou,
+            "cross_class_iou": self.cross_class_iou,
+            "min_area": self.min_area,
+            "min_aspect": self.min_aspect,
+            "max_aspect": self.max_aspect,
+            "clip": self.clip,
+        }
+
+
+def non_max_suppression(boxes: np.ndarray, scores: np.ndarray, iou_threshold: float,
+                        classes: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Greedy NMS over (N, 4) x1, y1, x2, y2 boxes.
+
+    Each step compares the best remaining box with all others at once. With
+    classes given, boxes are offset per class so they only suppress boxes of
+    the same class. Ties in score keep the earlier box.
+
+    Returns:
+        np.ndarray: Kept indices by descending score
+    """
+    if len(boxes) == 0:
+        return np.zeros(0, dtype=np.int64)
+    if classes is not None:
+        boxes = boxes + classes[:, None].astype(boxes.dtype) * (boxes.max() - boxes.min() + 1)
+    order = np.argsort(-scores, kind="stable")
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    keep = []
+    while order.size:
+        best = order[0]
+        keep.append(best)
+        rest = order[1:]
+        width = np.clip(np.minimum(boxes[best, 2], boxes[rest, 2]) - np.maximum(boxes[best, 0], boxes[rest, 0]), 0, None)
+        height = np.clip(np.minimum(boxes[best, 3], boxes[rest, 3]) - np.maximum(boxes[best, 1], boxes[rest, 1]), 0, None)
+        intersection = width * height
+        iou = intersection / np.maximum(areas[best] + areas[rest] - intersection, 1e-9)
+        order = rest[iou <= iou_threshold]
+    return np.array(keep, dtype=np.int64)
+
+
+def postprocess_boxes(boxes: np.ndarray, scores: np.ndarray, classes: np.ndarray, config: PostprocessConfig,
+                      image_size: Optional[Tuple[int, int]] = None) -> Tuple[np.ndarray, np.ndarray, Dict]:
+    """
+    Post-process all boxes of one image.
+
+    Args:
+        boxes (np.ndarray): (N, 4) x1, y1, x2, y2 boxes, x along the image width (columns)
+            and y along its height (rows), like the "x"/"y" of saved predictions
+        scores (np.ndarray): (N,) confidences
+        classes (np.ndarray): (N,) integer class ids
+        config (PostprocessConfig): Stage settings
+        image_size (tuple): (width, height) used for snapping; None skips it
+
+    Returns:
+        tuple: (kept indices in input order, (N, 4) possibly snapped boxes,
+                {"input", "filtered", "suppressed", "output"} counts)
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    if config.clip and image_size is not None:
+        width, height = image_size
+        # x1 and x2 are bounded by the width, y1 and y2 by the height
+        boxes = np.clip(boxes, 0, [width, height, width, height])
+
+    box_widths = boxes[:, 2] - boxes[:, 0]
+    box_heights = boxes[:, 3] - boxes[:, 1]
+    valid = (box_widths > 0) & (box_heights > 0) & (box_widths * box_heights >= config.min_area)
+    aspects = box_widths / np.maximum(box_heights, 1e-9)
+    if config.min_aspect:
+        valid &= aspects >= config.min_aspect
+    if config.max_aspect:
+        valid &= aspects <= config.max_aspect
+    candidates = np.flatnonzero(valid)
+
+    kept = candidates
+    if config.nms_iou and len(kept) > 1:
+        kept = kept[non_max_suppression(boxes[kept], scores[kept], config.nms_iou, classes[kept])]
+    if config.cross_class_iou and len(kept) > 1:
+        kept = kept[non_max_suppression(boxes[kept], scores[kept], config.cross_class_iou)]
+    kept = np.sort(kept)
+
+    stats = {
+        "input": len(boxes),
+        "filtered": len(boxes) - len(candidates),
+        "suppressed": len(candidates) - len(kept),
+        "output": len(kept),
+    }
+    return kept, boxes, stats
+
+
+def postprocess_box_set(box_set: BoxSet, config: PostprocessConfig,
+                        image_size: Optional[Tuple[int, int]] = None) -> Tuple[BoxSet, Dict]:
+    """
+    Post-process the boxes of one image.
+
+    Returns:
+        tuple: (kept boxes in their original order, snapped if enabled, counts from postprocess_boxes)
+    """
+    kept, snapped, stats = postprocess_boxes(box_set.coords, box_set.score_array(), box_set.labels, config,
+                                             image_size)
+    return box_set.with_coords(snapped).select(kept), stats
+
+
+def postprocess_predictions(predictions: List[Dict], config: PostprocessConfig,
+                            image_size: Optional[Dict] = None) -> Tuple[List[Dict], Dict]:
+    """
+    Post-process predictions in the /predict schema
+    ({"type", "coordinates": {"x", "y", "width", "height"}, optional "score"}).
+
+    Returns:
+        tuple: (kept predictions in their original order, counts from postprocess_boxes)
+    """
+    if not predictions:
+        return predictions, {"input": 0, "filtered": 0, "suppressed": 0, "output": 0}
+    size = (image_size["width"], image_size["height"]) if image_size else None
+    box_set, stats = postprocess_box_set(BoxSet.from_predictions(predictions), config, size)
+    return box_set.to_predictions(), stats
+
+
+def weighted_box_fusion(boxes: np.ndarray, scores: np.ndarray, classes: np.ndarray, samples: np.ndarray,
+                        num_samples: int, iou_threshold: float = 0.55,
+                        min_votes: int = 1) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Weighted box fusion (WBF) of the boxes from several samples of one image.
+
+    Boxes are visited by descending score and join the cluster of the same
+    class whose fused box overlaps them most, if by more than iou_threshold;
+    otherwise they start a new cluster. A cluster's box is the score-weighted
+    mean of its members and its score is the mean member score scaled by the
+    fraction of samples that contributed to it.
+
+    Args:
+        boxes (np.ndarray): (N, 4) x1, y1, x2, y2 boxes of all samples
+        scores (np.ndarray): (N,) confidences (1 for models without scores)
+        classes (np.ndarray): (N,) integer class ids
+        samples (np.ndarray): (N,) index of the sample each box came from
+        num_samples (int): Number of samples, including ones without boxes
+        iou_threshold (float): Overlap above which boxes are fused
+        min_votes (int): Drop fused boxes found in fewer samples than this
+
+    Returns:
+        tuple: (fused (M, 4) boxes, (M,) scores, (M,) classes, (M,) number of samples per box)
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    scores = np.asarray(scores, dtype=np.float64)
+    order = np.argsort(-scores, kind="stable")
+    # Running sums per cluster: score-weighted coordinates, scores and member count
+    weighted = np.zeros((len(boxes), 4))
+    totals = np.zeros(len(boxes))
+    counts = np.zeros(len(boxes), dtype=np.int64)
+    fused = np.zeros((len(boxes), 4))
+    cluster_classes = np.zeros(len(boxes), dtype=np.int64)
+    cluster_samples = []
+    clusters = 0
+    for index in order:
+        box = boxes[index]
+        cluster = -1
+        if clusters:
+            candidates = fused[:clusters]
+            width = np.clip(np.minimum(box[2], candidates[:, 2]) - np.maximum(box[0], candidates[:, 0]), 0, None)
+            height = np.clip(np.minimum(box[3], candidates[:, 3]) - np.maximum(box[1], candidates[:, 1]), 0, None)
+            intersection = width * height
+            areas = (candidates[:, 2] - candidates[:, 0]) * (candidates[:, 3] - candidates[:, 1])
+            union = (box[2] - box[0]) * (box[3] - box[1]) + areas - intersection
+            iou = intersection / np.maximum(union, 1e-9)
+            iou[cluster_classes[:clusters] != classes[index]] = 0
+            best = int(np.argmax(iou))
+            if iou[best] > iou_threshold:
+                cluster = best
+        if cluster < 0:
+            cluster = clusters
+            clusters += 1
+            cluster_classes[cluster] = classes[index]
+            cluster_samples.append(set())
+        weight = max(scores[index], 1e-9)
+        weighted[cluster] += box * weight
+        totals[cluster] += weight
+        counts[cluster] += 1
+        fused[cluster] = weighted[cluster] / totals[cluster]
+        cluster_samples[cluster].add(int(samples[index]))
+
+    votes = np.array([len(members) for members in cluster_samples], dtype=np.int64)
+    fused_scores = totals[:clusters] / np.maximum(counts[:clusters], 1) * votes / max(num_samples, 1)
+    keep = votes >= min_votes
+    return fused[:clusters][keep], fused_scores[keep], cluster_classes[:clusters][keep], votes[keep]
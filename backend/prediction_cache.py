@@ -0,0 +1,209 @@
+"""
+Content-addressed cache for UI element predictions.
+
+Predictions are keyed by a hash of the normalized (RGB) image pixels together
+with the prompt, model name and generation config, so re-running the same
+screenshot through /predict does not trigger another Gemini call.
+
+The cache has two tiers:
+- an in-memory LRU tier bounded by a number of entries
+- an on-disk tier backed by the prediction JSON files in PREDICTIONS_DIR,
+  which carry the key in their "cacheKey" field, or by the box store when
+  predictions are kept in SQLite
+
+Several server processes can share PREDICTIONS_DIR: when the directory
+changes, files written by other processes are added to the disk index.
+"""
+
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from PIL import Image
+
+
+def make_cache_key(image: Image.Image, prompt: str, model_name: str, generation_config: Dict) -> str:
+    """
+    Build the cache key for a prediction request.
+
+    Args:
+        image (Image.Image): Normalized RGB image sent to the model
+        prompt (str): Prompt text sent along with the image
+        model_name (str): Name of the model used for the prediction
+        generation_config (dict): Generation parameters (temperature, ...)
+
+    Returns:
+        str: Hex digest identifying the request
+    """
+    hasher = hashlib.sha256()
+    hasher.update(f"{image.mode}:{image.width}x{image.height}".encode())
+    hasher.update(image.tobytes())
+    hasher.update(prompt.strip().encode())
+    hasher.update(model_name.encode())
+    hasher.update(json.dumps(generation_config, sort_keys=True).encode())
+    return hasher.hexdigest()
+
+
+class PredictionCache:
+    """
+    Two-tier (memory LRU + prediction files on disk) prediction cache.
+
+    Attributes:
+        predictions_dir (str): Directory holding the prediction JSON files
+        max_entries (int): Maximum number of entries kept in memory
+        store (BoxStore): Box store searched by cache key, if predictions are kept there
+        hits (int): Number of lookups answered from either tier
+        disk_hits (int): Number of lookups answered from the disk tier
+        misses (int): Number of lookups that required a model call
+        bypassed (int): Number of requests that skipped the cache
+    """
+    def __init__(self, predictions_dir: str, max_entries: int = 256, store=None):
+        self.predictions_dir = predictions_dir
+        self.max_entries = max_entries
+        self.store = store
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self._memory = OrderedDict()
+        self._disk_index = None
+        self._dir_mtime = None
+        self._file_mtimes = {}
+        self._lock = threading.Lock()
+
+    def _refresh_disk_index(self):
+        """
+        Index prediction files that are new or changed since the last scan.
+
+        Only runs when the directory itself changed (files are written by
+        atomic rename, which updates the directory), so it costs one stat call
+        otherwise.
+        """
+        if self._disk_index is None:
+            self._disk_index = {}
+        try:
+            dir_mtime = os.stat(self.predictions_dir).st_mtime_ns
+        except OSError:
+            return
+        if dir_mtime == self._dir_mtime:
+            return
+        self._dir_mtime = dir_mtime
+
+        file_mtimes = {}
+        with os.scandir(self.predictions_dir) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".json") or entry.name.startswith(".") or not entry.is_file():
+                    continue
+                mtime = entry.stat().st_mtime_ns
+                file_mtimes[entry.path] = mtime
+                if self._file_mtimes.get(entry.path) == mtime:
+                    continue
+                try:
+                    with open(entry.path) as f:
+                        data = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                key = data.get("cacheKey") if isinstance(data, dict) else None
+                if key:
+                    self._disk_index[key] = entry.path
+        self._file_mtimes = file_mtimes
+
+    def refresh(self):
+        """Scan the predictions directory now (e.g. at startup) instead of on the first lookup"""
+        with self._lock:
+            self._refresh_disk_index()
+
+    def _load_from_disk(self, key: str) -> Optional[Dict]:
+        """Load an entry from its prediction file, if it still matches the key"""
+        if self.store is not None:
+            document = self.store.find_prediction_by_cache_key(key)
+            if document is not None:
+                return {"predictions": document["predictions"], "imageSize": document["imageSize"]}
+        # Picks up predictions written by other server processes
+        self._refresh_disk_index()
+        filepath = self._disk_index.get(key)
+        if filepath is None:
+            return None
+        try:
+            with open(filepath) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = None
+        # The file may have been overwritten by a prediction for another image
+        if not data or data.get("cacheKey") != key:
+            self._disk_index.pop(key, None)
+            return None
+        return {
+            "predictions": data["predictions"],
+            "imageSize": data["imageSize"],
+        }
+
+    def _remember(self, key: str, entry: Dict):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, key: str) -> Optional[Dict]:
+        """
+        Look up a cached prediction.
+
+        Returns:
+            dict: {"predictions": [...], "imageSize": {...}} or None on a miss
+        """
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return entry
+
+            entry = self._load_from_disk(key)
+            if entry is not None:
+                self._remember(key, entry)
+                self.hits += 1
+                self.disk_hits += 1
+                return entry
+
+            self.misses += 1
+            return None
+
+    def put(self, key: str, entry: Dict, filepath: Optional[str] = None):
+        """
+        Store a prediction in memory and record the file it was written to.
+
+        Args:
+            key (str): Cache key from make_cache_key
+            entry (dict): {"predictions": [...], "imageSize": {...}}
+            filepath (str): Prediction JSON file containing the same entry
+        """
+        with self._lock:
+            self._remember(key, entry)
+            if filepath is not None:
+                self._refresh_disk_index()
+                # A file only ever holds one key; drop stale mappings to it
+                for stale_key in [k for k, path in self._disk_index.items() if path == filepath]:
+                    del self._disk_index[stale_key]
+                self._disk_index[key] = filepath
+
+    def record_bypass(self):
+        with self._lock:
+            self.bypassed += 1
+
+    def stats(self) -> Dict:
+        """Return hit/miss counters and tier sizes"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "bypassed": self.bypassed,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+                "memory_entries": len(self._memory),
+                "max_entries": self.max_entries,
+                "disk_entries": len(self._disk_index) if self._disk_index is not None else None,
+            }
@@ -0,0 +1,178 @@
+"""
+Image preprocessing applied before model inference.
+
+Large screenshots are split into tiles (optional, for very tall pages),
+downscaled so their long side fits a limit and re-encoded as JPEG or WebP.
+The model returns boxes in a 1000x1000 space relative to the image it was
+shown, so each tile records where it sits in the original image and boxes can
+be mapped back to exact original-pixel coordinates.
+"""
+
+import io
+import os
+import time
+from typing import Dict, List, Optional
+
+from PIL import Image
+
+SUPPORTED_FORMATS = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+
+
+class PreprocessConfig:
+    """
+    Settings for the preprocessing stage.
+
+    Attributes:
+        max_long_side (int): Downscale so the longer side is at most this many
+            pixels (0 disables resizing)
+        image_format (str): Encoding sent to the model: JPEG, WEBP or PNG
+        quality (int): Encoder quality for JPEG/WebP (1-100)
+        tile_aspect (float): Split pages taller than tile_aspect x width into
+            tiles of that aspect ratio (0 disables tiling)
+        tile_overlap (float): Fraction of a tile's height shared with the next tile
+    """
+    def __init__(self, max_long_side: int = 1920, image_format: str = "JPEG", quality: int = 75,
+                 tile_aspect: float = 0.0, tile_overlap: float = 0.1):
+        image_format = image_format.upper()
+        if image_format not in SUPPORTED_FORMATS:
+            raise ValueError(f"Unsupported image format: {image_format}. Expected one of {sorted(SUPPORTED_FORMATS)}")
+        if not 1 <= quality <= 100:
+            raise ValueError("quality must be between 1 and 100")
+        if not 0 <= tile_overlap < 1:
+            raise ValueError("tile_overlap must be in [0, 1)")
+        self.max_long_side = max_long_side
+        self.image_format = image_format
+        self.quality = quality
+        self.tile_aspect = tile_aspect
+        self.tile_overlap = tile_overlap
+
+    @classmethod
+    def from_env(cls) -> "PreprocessConfig":
+        return cls(
+            max_long_side=int(os.getenv("PREPROCESS_MAX_LONG_SIDE", "1920")),
+            image_format=os.getenv("PREPROCESS_FORMAT", "JPEG"),
+            quality=int(os.getenv("PREPROCESS_QUALITY", "75")),
+            tile_aspect=float(os.getenv("PREPROCESS_TILE_ASPECT", "0")),
+            tile_overlap=float(os.getenv("PREPROCESS_TILE_OVERLAP", "0.1")),
+        )
+
+    def override(self, max_long_side: Optional[int] = None, image_format: Optional[str] = None,
+                 quality: Optional[int] = None, tile_aspect: Optional[float] = None) -> "PreprocessConfig":
+        """Return a copy with the given per-request settings replaced"""
+        return PreprocessConfig(
+            max_long_side=self.max_long_side if max_long_side is None else max_long_side,
+            image_format=self.image_format if image_format is None else image_format,
+            quality=self.quality if quality is None else quality,
+            tile_aspect=self.tile_aspect if tile_aspect is None else tile_aspect,
+            tile_overlap=self.tile_overlap,
+        )
+
+    def as_dict(self) -> Dict:
+        return {
+            "max_long_side": self.max_long_side,
+            "image_format": self.image_format,
+            "quality": self.quality,
+            "tile_aspect": self.tile_aspect,
+            "tile_overlap": self.tile_overlap,
+        }
+
+
+class Tile:
+    """
+    A full-width band of rows of the original image, encoded for the model.
+
+    Tiles only split the rows, so box rows are offset by top and columns are not.
+
+    Attributes:
+        top (int): First original row covered by the tile
+        height (int): Number of original rows covered by the tile
+        core_top (int): First row whose boxes this tile is responsible for
+        core_bottom (int): Row after the last one this tile is responsible for
+        data (bytes): Encoded image bytes sent to the model
+        mime_type (str): MIME type of data
+        size (tuple): (width, height) of the encoded image
+    """
+    def __init__(self, top: int, height: int, core_top: int, core_bottom: int,
+                 data: bytes, mime_type: str, size: tuple):
+        self.top = top
+        self.height = height
+        self.core_top = core_top
+        self.core_bottom = core_bottom
+        self.data = data
+        self.mime_type = mime_type
+        self.size = size
+
+    def as_part(self) -> Dict:
+        """Inline image part accepted by generate_content"""
+        return {"mime_type": self.mime_type, "data": self.data}
+
+    def owns(self, original_top: float, original_bottom: float) -> bool:
+        """Whether a box (in original rows) belongs to this tile rather than its neighbour"""
+        center = (original_top + original_bottom) / 2
+        return self.core_top <= center < self.core_bottom
+
+
+def tile_bounds(width: int, height: int, config: PreprocessConfig) -> List[tuple]:
+    """
+    Split the image height into (top, height, core_top, core_bottom) tiles.
+
+    Consecutive tiles overlap so elements on a seam are fully visible in at
+    least one tile; the core ranges partition the image without overlap.
+    """
+    if config.tile_aspect <= 0 or height <= width * config.tile_aspect:
+        return [(0, height, 0, height)]
+
+    tile_height = max(1, int(width * config.tile_aspect))
+    step = max(1, int(tile_height * (1 - config.tile_overlap)))
+    tops = list(range(0, max(1, height - tile_height), step)) + [max(0, height - tile_height)]
+    tops = sorted(set(tops))
+
+    bounds = []
+    for index, top in enumerate(tops):
+        bottom = min(height, top + tile_height)
+        # The seam between two tiles is the middle of their overlap
+        core_top = 0 if index == 0 else (top + min(height, tops[index - 1] + tile_height)) // 2
+        core_bottom = height if index == len(tops) - 1 else (tops[index + 1] + bottom) // 2
+        bounds.append((top, bottom - top, core_top, core_bottom))
+    return bounds
+
+
+def encode_image(image: Image.Image, config: PreprocessConfig) -> tuple:
+    """Downscale an RGB image to max_long_side and encode it; returns (bytes, mime type, size)"""
+    long_side = max(image.size)
+    if config.max_long_side and long_side > config.max_long_side:
+        scale = config.max_long_side / long_side
+        new_size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        image = image.resize(new_size, Image.Resampling.LANCZOS)
+
+    buffer = io.BytesIO()
+    if config.image_format == "PNG":
+        image.save(buffer, format="PNG", optimize=False)
+    else:
+        image.save(buffer, format=config.image_format, quality=config.quality)
+    return buffer.getvalue(), SUPPORTED_FORMATS[config.image_format], image.size
+
+
+def preprocess_image(image: Image.Image, config: PreprocessConfig) -> tuple:
+    """
+    Tile, resize and encode an RGB image for the model.
+
+    Returns:
+        tuple: (list of Tile, stats dict with bytes_sent, tiles, sent sizes
+                and preprocess_ms)
+    """
+    start_time = time.perf_counter()
+    width, height = image.size
+    tiles = []
+    for top, tile_height, core_top, core_bottom in tile_bounds(width, height, config):
+        region = image if tile_height == height else image.crop((0, top, width, top + tile_height))
+        data, mime_type, size = encode_image(region, config)
+        tiles.append(Tile(top, tile_height, core_top, core_bottom, data, mime_type, size))
+
+    stats = {
+        "tiles": len(tiles),
+        "bytes_sent": sum(len(tile.data) for tile in tiles),
+        "sent_sizes": [list(tile.size) for tile in tiles],
+        "preprocess_ms": (time.perf_counter() - start_time) * 1000,
+    }
+    return tiles, stats
@@ -0,0 +1,157 @@
+"""
+Tolerant, incremental parser for the model's box output.
+
+The model is asked for a JSON list of {"box_2d": [...], "label": "..."}
+objects but may wrap it in markdown fences, add prose around it, leave
+trailing commas or stop mid-array when the response is truncated. Instead of
+parsing the whole text at once, BoxStreamParser scans the text as it streams
+in and emits every complete top-level object as soon as its closing brace
+arrives; text outside objects is ignored, an unfinished trailing object is
+dropped and a malformed object only loses that one box.
+"""
+
+import re
+import json
+from typing import Dict, List, Optional
+
+# Canonical UI element types and the spellings the model uses for them
+LABEL_ALIASES = {
+    "Button": ["button", "btn", "icon button", "submit button", "link button"],
+    "Input": ["input", "text input", "input field", "text field", "textfield", "textbox", "text box",
+              "search", "search box", "search input", "textarea"],
+    "Dropdown": ["dropdown", "drop", "drop down", "drop-down", "select", "combobox", "combo box",
+                 "dropdown menu", "picker"],
+    "Radio": ["radio", "radio button", "radiobutton", "radio input", "option button"],
+}
+_LABEL_LOOKUP = {alias: label for label, aliases in LABEL_ALIASES.items() for alias in aliases}
+_TRAILING_COMMA = re.compile(r",\s*([}\]])")
+
+
+def normalize_label(label: str) -> str:
+    """Map a model label to its canonical element type; unknown labels are returned stripped"""
+    key = re.sub(r"[\s_]+", " ", str(label)).strip()
+    canonical = _LABEL_LOOKUP.get(key.lower())
+    if canonical is None and key.lower().endswith("s"):
+        # Plurals such as "Buttons"
+        canonical = _LABEL_LOOKUP.get(key.lower()[:-1])
+    return canonical or key
+
+
+def _load_object(text: str) -> Optional[Dict]:
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+    try:
+        return json.loads(_TRAILING_COMMA.sub(r"\1", text))
+    except ValueError:
+        return None
+
+
+def _find_boxes(value) -> List[Dict]:
+    """Box objects in a parsed value, including lists nested in a wrapper object"""
+    if isinstance(value, dict):
+        if "box_2d" in value:
+            return [value]
+        return [box for child in value.values() for box in _find_boxes(child)]
+    if isinstance(value, list):
+        return [box for child in value for box in _find_boxes(child)]
+    return []
+
+
+def is_valid_box(obj: Dict) -> bool:
+    box = obj.get("box_2d")
+    return (
+        isinstance(box, list) and len(box) == 4
+        and all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in box)
+        and isinstance(obj.get("label"), str)
+    )
+
+
+class BoxStreamParser:
+    """
+    Incremental parser emitting box objects as soon as they are complete.
+
+    Attributes:
+        boxes (int): Valid box objects emitted so far
+        malformed (int): Complete objects that were not valid JSON boxes
+        truncated (bool): Whether the text ended inside an object or an open
+            array (set by close)
+    """
+    def __init__(self):
+        self.boxes = 0
+        self.malformed = 0
+        self.truncated = False
+        self.empty_array = False
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._current = []
+        self._objects_at_array_start = None
+        self._array_open = False
+
+    def feed(self, text: str) -> List[Dict]:
+        """Consume the next piece of text and return the box objects it completed"""
+        completed = []
+        start = 0 if self._depth > 0 else None
+        for index, char in enumerate(text):
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                continue
+            if char == '"' and self._depth > 0:
+                self._in_string = True
+            elif char == "[" and self._depth == 0:
+                self._objects_at_array_start = self.boxes + self.malformed
+                self._array_open = True
+            elif char == "]" and self._depth == 0:
+                self._array_open = False
+                # "[]" (possibly fenced) is a valid answer with no elements
+                if self._objects_at_array_start == self.boxes + self.malformed:
+                    self.empty_array = True
+            elif char == "{":
+                if self._depth == 0:
+                    start = index
+                self._depth += 1
+            elif char == "}" and self._depth > 0:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._current.append(text[start:index + 1])
+                    completed.extend(self._finish_object("".join(self._current)))
+                    self._current = []
+                    start = None
+        if self._depth > 0 and start is not None:
+            self._current.append(text[start:])
+        return completed
+
+    def _finish_object(self, text: str) -> List[Dict]:
+        value = _load_object(text)
+        boxes = [box for box in _find_boxes(value) if is_valid_box(box)] if value is not None else []
+        if not boxes:
+            self.malformed += 1
+        self.boxes += len(boxes)
+        return boxes
+
+    def close(self) -> Dict:
+        """Finish the stream and return parser statistics"""
+        self.truncated = self._depth > 0 or self._array_open
+        self._current = []
+        return self.stats()
+
+    def stats(self) -> Dict:
+        return {"boxes": self.boxes, "malformed": self.malformed, "truncated": self.truncated}
+
+    def found_nothing(self) -> bool:
+        """True when the text had no boxes and was not recognisably an empty result"""
+        return self.boxes == 0 and not self.empty_array
+
+
+def parse_boxes(text: str) -> tuple:
+    """Parse a complete response; returns (box objects, parser statistics)"""
+    parser = BoxStreamParser()
+    boxes = parser.feed(text)
+    return boxes, parser.close()
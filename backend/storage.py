@@ -0,0 +1,79 @@
+"""
+File storage helpers for the backend directories.
+
+Writes go to a temporary file in the destination directory and are renamed
+into place with os.replace, so readers never see a partially written file.
+"""
+
+import os
+import json
+import tempfile
+from typing import Any, BinaryIO, Callable, Optional
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class FileTooLargeError(Exception):
+    """Raised when a streamed file exceeds the configured size limit"""
+
+
+def atomic_write_stream(source: BinaryIO, filepath: str, max_bytes: Optional[int] = None,
+                        chunk_size: int = COPY_CHUNK_SIZE,
+                        validate: Optional[Callable[[str], None]] = None) -> int:
+    """
+    Copy a file-like object to filepath in fixed-size chunks.
+
+    Args:
+        source (BinaryIO): Readable binary stream
+        filepath (str): Destination path
+        max_bytes (int): Abort with FileTooLargeError beyond this many bytes
+        chunk_size (int): Number of bytes held in memory at a time
+        validate (callable): Called with the temporary path before it replaces
+            filepath; raising from it leaves any existing file untouched
+
+    Returns:
+        int: Number of bytes written
+    """
+    directory = os.path.dirname(filepath) or "."
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    written = 0
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                chunk = source.read(chunk_size)
+                if not chunk:
+                    break
+                written += len(chunk)
+                if max_bytes is not None and written > max_bytes:
+                    raise FileTooLargeError(f"File exceeds the {max_bytes} byte limit")
+                out.write(chunk)
+        if validate is not None:
+            validate(temp_path)
+        # mkstemp creates owner-only files; use regular file permissions
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, filepath)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return written
+
+
+def atomic_write_json(filepath: str, data: Any, indent: Optional[int] = 2):
+    """
+    Write data as JSON to filepath through a temporary file.
+
+    Concurrent writers (e.g. several server processes saving the same
+    prediction file) never interleave: the last complete write wins.
+    """
+    directory = os.path.dirname(filepath) or "."
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-", suffix=".json")
+    try:
+        with os.fdopen(fd, "w") as out:
+            json.dump(data, out, indent=indent)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, filepath)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
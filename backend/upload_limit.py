@@ -0,0 +1,83 @@
+"""
+Request body size limits for upload routes.
+
+Starlette spools a multipart body to a temporary file before the endpoint
+runs, so a size check in the endpoint only happens once the whole upload has
+been received. UploadSizeLimit checks the body while it arrives instead:
+- a request whose Content-Length is over the limit is answered with 413
+  before any of its body is read
+- otherwise the received bytes are counted, and the request is answered with
+  413 as soon as they pass the limit (chunked bodies, or a wrong Content-Length)
+"""
+
+import json
+from typing import Dict
+
+
+class _BodyTooLarge(Exception):
+    """Raised to the application from receive once the body passes the limit"""
+
+
+class UploadSizeLimit:
+    """
+    ASGI middleware that rejects oversized request bodies of some paths.
+
+    Args:
+        app: ASGI application
+        limits (dict): Largest accepted body in bytes, by request path
+    """
+    def __init__(self, app, limits: Dict[str, int]):
+        self.app = app
+        self.limits = limits
+
+    async def __call__(self, scope, receive, send):
+        limit = self.limits.get(scope["path"]) if scope["type"] == "http" else None
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+
+        content_length = dict(scope["headers"]).get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > limit:
+            await _send_too_large(send, limit)
+            return
+
+        received = 0
+        exceeded = False
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received, exceeded
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    exceeded = True
+                    raise _BodyTooLarge()
+            return message
+
+        async def guarded_send(message):
+            nonlocal response_started
+            # Whatever the application answers to a cut-off body is replaced by the 413
+            if exceeded and not response_started:
+                return
+            response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            if not exceeded:
+                raise
+        if exceeded and not response_started:
+            await _send_too_large(send, limit)
+
+
+async def _send_too_large(send, limit: int):
+    body = json.dumps({"message": f"Request body exceeds the {limit} byte limit"}).encode()
+    await send({
+        "type": "http.response.start",
+        "status": 413,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()),
+                    (b"connection", b"close")],
+    })
+    await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,279 @@
+"""
+Load test for the backend API with a local fake Gemini model.
+
+Starts the FastAPI app in-process on a local port with
+genai.GenerativeModel replaced by FakeGenerativeModel, then drives /upload,
+/predict and /save-annotations with a concurrent load generator using the
+images in Datasets/ as payloads. For each endpoint it reports requests per
+second, latency percentiles, errors and the server process memory.
+
+The server runs in a temporary working directory, so benchmark uploads and
+predictions never touch backend/uploads or backend/predictions.
+
+Before the load test, known model boxes are mapped back to original pixels
+on an untiled and a tiled page; the script exits with status 1 if any of
+them lands somewhere else.
+
+Usage:
+    python benchmarks/bench_api.py [--requests 200] [--concurrency 16]
+        [--model-latency 0.5] [--error-rate 0.0] [--endpoints upload predict]
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import threading
+from pathlib import Path
+
+import httpx
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+sys.path.insert(0, str(ROOT_DIR / "backend"))
+
+from process_datasets import percentile
+from fake_gemini import FakeGenerativeModel, make_canned_response
+
+ENDPOINTS = ["upload", "predict", "save-annotations"]
+
+# (page width, height, tile_aspect, index of the tile the model saw, box_2d as
+# [y_min, x_min, y_max, x_max] in 0-1000 tile space, expected original-pixel
+# (x, y, width, height) or None if the tile does not own the box). The tiled
+# page is cut into 400x800 tiles with tops 0, 720, 1440, 2160 and 2200.
+BOX_MAPPING_CASES = [
+    (400, 300, 0.0, 0, [100, 250, 500, 750], (100, 30, 200, 120)),
+    (400, 3000, 2.0, 0, [100, 250, 500, 750], (100, 80, 200, 320)),
+    (400, 3000, 2.0, 1, [500, 250, 600, 750], (100, 1120, 200, 80)),
+    # Rows 770-790 are in the overlap of the first two tiles and belong to the second
+    (400, 3000, 2.0, 0, [962, 0, 988, 500], None),
+]
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg"}
+
+def read_rss_mb() -> float:
+    """Current resident set size of this process in MB"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    # Peak rather than current RSS where /proc is not available (macOS reports bytes)
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage / (1024 * 1024) if sys.platform == "darwin" else usage / 1024
+
+class MemorySampler:
+    """Samples RSS in a background thread to record the peak during a scenario"""
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.peak = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, read_rss_mb())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, read_rss_mb())
+
+def load_payloads(dataset_dir: Path, annotations_dir: Path) -> list:
+    """Read every dataset image (and its annotation file, if any) into memory"""
+    payloads = []
+    for image_path in sorted(dataset_dir.iterdir()):
+        if image_path.suffix.lower() not in IMAGE_EXTENSIONS:
+            continue
+        annotation_path = annotations_dir / f"{image_path.stem}.json"
+        annotations = []
+        if annotation_path.exists():
+            with open(annotation_path) as f:
+                annotations = json.load(f).get("annotations", [])
+        payloads.append({"filename": image_path.name, "content": image_path.read_bytes(),
+                         "annotations": annotations})
+    return payloads
+
+def find_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_server(args):
+    """Import the backend with the fake model and serve it from a background thread"""
+    workdir = tempfile.mkdtemp(prefix="bench-api-")
+    os.chdir(workdir)
+    os.environ["GOOGLE_API_KEY"] = "benchmark"
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+    import uvicorn
+    import google.generativeai as genai
+
+    response_text = Path(args.response_file).read_text() if args.response_file else make_canned_response(args.boxes)
+    fake_model = FakeGenerativeModel(latency=args.model_latency, jitter=args.latency_jitter,
+                                     error_rate=args.error_rate, response_text=response_text, seed=args.seed)
+    genai.GenerativeModel = lambda model_name, **kwargs: fake_model
+
+    import main as backend
+
+    port = find_free_port()
+    server = uvicorn.Server(uvicorn.Config(backend.app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise RuntimeError("Benchmark server failed to start")
+        time.sleep(0.05)
+    return server, thread, f"http://127.0.0.1:{port}", workdir, fake_model
+
+def check_box_mapping() -> bool:
+    """Map each BOX_MAPPING_CASES box through the backend's tiling and convert_box"""
+    import main as backend
+    from PIL import Image
+    from preprocessing import PreprocessConfig, preprocess_image
+
+    identical = True
+    for width, height, tile_aspect, tile_index, box_2d, expected in BOX_MAPPING_CASES:
+        tiles, _ = preprocess_image(Image.new("RGB", (width, height), "white"),
+                                    PreprocessConfig(tile_aspect=tile_aspect))
+        converted = backend.convert_box({"box_2d": box_2d, "label": "button"}, tiles[tile_index], width, height)
+        coordinates = converted["coordinates"] if converted is not None else None
+        actual = (coordinates["x"], coordinates["y"], coordinates["width"], coordinates["height"]) \
+            if coordinates is not None else None
+        if actual != expected:
+            identical = False
+            print(f"box_2d {box_2d} on tile {tile_index} of a {width}x{height} page mapped to {actual}, "
+                  f"expected {expected}")
+    return identical
+
+def build_request(endpoint: str, payload: dict, use_cache: bool) -> dict:
+    """httpx request arguments for one call to an endpoint"""
+    if endpoint == "upload":
+        return {"method": "POST", "url": "/upload",
+                "files": {"file": (payload["filename"], payload["content"], "application/octet-stream")}}
+    if endpoint == "predict":
+        return {"method": "POST", "url": "/predict", "params": {"use_cache": str(use_cache).lower()},
+                "files": {"file": (payload["filename"], payload["content"], "application/octet-stream")}}
+    return {"method": "POST", "url": "/save-annotations",
+            "json": {"filename": payload["filename"], "annotations": payload["annotations"]}}
+
+async def run_scenario(base_url: str, endpoint: str, payloads: list, total_requests: int,
+                       concurrency: int, use_cache: bool, timeout: float) -> dict:
+    """Send total_requests to one endpoint from `concurrency` concurrent clients"""
+    latencies = []
+    errors = 0
+    next_index = 0
+
+    async def client(http):
+        nonlocal next_index, errors
+        while next_index < total_requests:
+            payload = payloads[next_index % len(payloads)]
+            next_index += 1
+            start_time = time.perf_counter()
+            try:
+                response = await http.request(**build_request(endpoint, payload, use_cache))
+                ok = response.status_code == 200
+            except httpx.HTTPError:
+                ok = False
+            latencies.append(time.perf_counter() - start_time)
+            if not ok:
+                errors += 1
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    with MemorySampler() as memory:
+        rss_before = read_rss_mb()
+        start_time = time.perf_counter()
+        async with httpx.AsyncClient(base_url=base_url, timeout=timeout, limits=limits) as http:
+            await asyncio.gather(*(client(http) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start_time
+
+    latencies.sort()
+    return {
+        "endpoint": endpoint,
+        "requests": len(latencies),
+        "errors": errors,
+        "concurrency": concurrency,
+        "elapsed_seconds": elapsed,
+        "requests_per_second": len(latencies) / elapsed if elapsed > 0 else 0.0,
+        "latency_ms": {f"p{pct}": percentile(latencies, pct) * 1000 for pct in (50, 95, 99)},
+        "rss_mb": {"before": rss_before, "after": read_rss_mb(), "peak": memory.peak},
+    }
+
+def print_results(results: list):
+    print(f"\n{'endpoint':<18} {'requests':>8} {'errors':>7} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} "
+          f"{'p99 ms':>9} {'RSS MB':>8} {'peak MB':>8}")
+    for result in results:
+        latency = result["latency_ms"]
+        print(f"{result['endpoint']:<18} {result['requests']:>8} {result['errors']:>7} "
+              f"{result['requests_per_second']:>8.1f} {latency['p50']:>9.1f} {latency['p95']:>9.1f} "
+              f"{latency['p99']:>9.1f} {result['rss_mb']['after']:>8.1f} {result['rss_mb']['peak']:>8.1f}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load test the backend API against a fake Gemini model")
+    parser.add_argument("--endpoints", nargs="+", choices=ENDPOINTS, default=ENDPOINTS)
+    parser.add_argument("--requests", type=int, default=200, help="Requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=16, help="Concurrent clients")
+    parser.add_argument("--dataset-dir", type=Path, default=ROOT_DIR / "Datasets")
+    parser.add_argument("--annotations-dir", type=Path, default=ROOT_DIR / "backend" / "annotations",
+                        help="Annotation files used as /save-annotations payloads")
+    parser.add_argument("--use-cache", action="store_true",
+                        help="Let /predict answer repeated images from the prediction cache")
+    parser.add_argument("--model-latency", type=float, default=0.5, help="Mean fake model latency in seconds")
+    parser.add_argument("--latency-jitter", type=float, default=0.1, help="Uniform +/- jitter in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Probability that a model call fails")
+    parser.add_argument("--boxes", type=int, default=12, help="Boxes in the canned model response")
+    parser.add_argument("--response-file", help="Use this file's contents as the model response text")
+    parser.add_argument("--timeout", type=float, default=300.0, help="Client timeout per request in seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output-json", type=Path, help="Write the results to this file")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    output_json = args.output_json.resolve() if args.output_json else None
+    payloads = load_payloads(args.dataset_dir.resolve(), args.annotations_dir.resolve())
+    if not payloads:
+        print(f"No images found in {args.dataset_dir}")
+        sys.exit(1)
+
+    server, thread, base_url, workdir, fake_model = start_server(args)
+    print(f"Serving the backend from {workdir} at {base_url} "
+          f"(fake model latency {args.model_latency:g}s +/- {args.latency_jitter:g}s, "
+          f"error rate {args.error_rate:g})")
+    mapping_correct = check_box_mapping()
+    print(f"Model boxes mapped to original pixels: {mapping_correct}")
+
+    results = []
+    try:
+        for endpoint in args.endpoints:
+            print(f"Running {args.requests} {endpoint} requests with {args.concurrency} clients...")
+            results.append(asyncio.run(run_scenario(base_url, endpoint, payloads, args.requests,
+                                                    args.concurrency, args.use_cache, args.timeout)))
+    finally:
+        server.should_exit = True
+        thread.join()
+
+    print_results(results)
+    print(f"\nFake model calls: {fake_model.calls}")
+    if output_json:
+        with open(output_json, "w") as f:
+            json.dump({"config": {key: str(value) if isinstance(value, Path) else value
+                                  for key, value in vars(args).items()},
+                       "results": results}, f, indent=2)
+        print(f"Results written to {output_json}")
+    if not mapping_correct:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+Micro-benchmark for evaluate_model.calculate_metrics
+
+Compares the vectorized IoU/matching engine (calculate_metrics) against the
+pure Python reference (calculate_metrics_scalar) on synthetic images with an
+increasing number of boxes, and checks that both return identical metrics.
+Boxes whose IoU sits exactly on the threshold are also scored through the
+saved-file loaders, which must not round them across it.
+
+Timings can be saved with --output-json and compared against an earlier run
+with --baseline; sizes that got slower than the tolerance are reported and
+the script exits with status 1.
+
+Usage:
+    python benchmarks/bench_metrics.py [--sizes 10 50 200] [--repeat 5]
+        [--output-json bench.json] [--baseline bench.json --tolerance 0.25]
+"""
+
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+from evaluate_model import (BoundingBox, calculate_metrics, calculate_metrics_scalar, load_annotations,
+                            load_predictions)
+
+TAGS = ["button", "input", "dropdown", "radio"]
+
+def make_boxes(count, rng, width=1920, height=1080):
+    """Generate random (tag, BoundingBox) pairs inside a width x height image"""
+    boxes = []
+    for _ in range(count):
+        w = rng.uniform(20, 300)
+        h = rng.uniform(10, 80)
+        boxes.append((rng.choice(TAGS), BoundingBox(rng.uniform(0, width - w), rng.uniform(0, height - h), w, h)))
+    return boxes
+
+def jitter(boxes, rng, amount=8.0):
+    """Copy boxes with a small random offset, like a reasonable model would predict them"""
+    return [
+        (tag, BoundingBox(box.x1 + rng.uniform(-amount, amount), box.y1 + rng.uniform(-amount, amount),
+                          box.x2 - box.x1, box.y2 - box.y1))
+        for tag, box in boxes
+    ]
+
+# (ground truth x, y, width, height, prediction x, y, width, height) with an IoU of
+# exactly 0.5 in decimal; rounding the coordinates to float32 pushes it over 0.5
+THRESHOLD_TIES = [
+    (0.1, 0.1, 100.3, 50.7, 0.1, 0.1, 200.6, 50.7),
+]
+
+def check_threshold_ties() -> bool:
+    """Score each tie from annotation/prediction files and compare with the scalar reference"""
+    identical = True
+    with tempfile.TemporaryDirectory() as directory:
+        for x, y, width, height, px, py, pwidth, pheight in THRESHOLD_TIES:
+            ann_file = Path(directory) / "tie.json"
+            pred_file = Path(directory) / "predictions_tie.json"
+            ann_file.write_text(json.dumps({"annotations": [
+                {"x": x, "y": y, "width": width, "height": height, "tag": "button"}
+            ]}))
+            pred_file.write_text(json.dumps({"predictions": [
+                {"type": "Button", "coordinates": {"x": px, "y": py, "width": pwidth, "height": pheight}}
+            ]}))
+            scalar_result = calculate_metrics_scalar([("button", BoundingBox(x, y, width, height))],
+                                                     [("button", BoundingBox(px, py, pwidth, pheight))])
+            vector_result = calculate_metrics(load_annotations(ann_file), load_predictions(pred_file))
+            if scalar_result != vector_result:
+                print(f"Threshold tie scored differently: {(x, y, width, height)} vs {(px, py, pwidth, pheight)}")
+                identical = False
+    return identical
+
+def time_call(func, repeat, *args):
+    """Best wall-clock time of `repeat` calls, in seconds"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark calculate_metrics at increasing box counts")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 50, 200, 1000])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output-json", type=Path, help="Write the timings to this file")
+    parser.add_argument("--baseline", type=Path, help="Timings file from an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Allowed slowdown against the baseline (0.25 = 25%%)")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    results = []
+    print(f"{'boxes':>8} {'scalar (ms)':>12} {'vectorized (ms)':>16} {'speedup':>8}  identical")
+    for size in args.sizes:
+        ground_truth = make_boxes(size, rng)
+        predictions = jitter(ground_truth, rng) + make_boxes(size // 4, rng)
+        rng.shuffle(predictions)
+
+        scalar_time, scalar_result = time_call(calculate_metrics_scalar, args.repeat, ground_truth, predictions)
+        vector_time, vector_result = time_call(calculate_metrics, args.repeat, ground_truth, predictions)
+        print(f"{size:>8} {scalar_time * 1000:>12.2f} {vector_time * 1000:>16.2f} "
+              f"{scalar_time / vector_time:>7.1f}x  {scalar_result == vector_result}")
+        results.append({"boxes": size, "scalar_ms": scalar_time * 1000, "vectorized_ms": vector_time * 1000,
+                        "identical": scalar_result == vector_result})
+
+    if args.output_json:
+        with open(args.output_json, "w") as f:
+            json.dump({"repeat": args.repeat, "seed": args.seed, "results": results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {entry["boxes"]: entry for entry in json.load(f)["results"]}
+        regressions = []
+        for result in results:
+            previous = baseline.get(result["boxes"])
+            if previous is None:
+                continue
+            ratio = result["vectorized_ms"] / previous["vectorized_ms"]
+            if ratio > 1 + args.tolerance:
+                regressions.append(f"{result['boxes']} boxes: {previous['vectorized_ms']:.2f} ms -> "
+                                   f"{result['vectorized_ms']:.2f} ms ({ratio:.2f}x)")
+        if regressions:
+            print("\nRegressions against the baseline:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print("\nNo regressions against the baseline")
+
+    ties_identical = check_threshold_ties()
+    print(f"\nThreshold ties identical: {ties_identical}")
+    if not ties_identical or not all(result["identical"] for result in results):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
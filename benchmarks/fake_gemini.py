@@ -0,0 +1,135 @@
+"""
+Local stand-in for google.generativeai.GenerativeModel.
+
+Used by the benchmarks to exercise /predict without network calls or API
+quota. Each call sleeps for a configurable latency, fails with a configurable
+probability and returns canned box JSON in the format Gemini produces. With
+stream=True the text is delivered in chunks spread over the latency. Responses
+carry usage metadata with a fixed prompt token count and about one output
+token per four characters, so cost reports can be exercised too.
+"""
+
+import json
+import time
+import random
+import asyncio
+from typing import Optional
+
+from google.api_core import exceptions as api_exceptions
+
+LABELS = ["Button", "Input", "Dropdown", "Radio"]
+
+
+def make_canned_response(boxes: int = 12, seed: int = 0) -> str:
+    """Build a markdown-fenced JSON list of boxes in Gemini's 0-1000 [y_min, x_min, y_max, x_max] space"""
+    rng = random.Random(seed)
+    entries = []
+    for index in range(boxes):
+        top = rng.randint(0, 900)
+        left = rng.randint(0, 850)
+        entries.append({
+            "box_2d": [top, left, top + rng.randint(20, 90), left + rng.randint(40, 150)],
+            "label": LABELS[index % len(LABELS)],
+        })
+    return "```json\n" + json.dumps(entries, indent=2) + "\n```"
+
+
+class FakeUsage:
+    def __init__(self, prompt_token_count: int, candidates_token_count: int):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+
+
+class FakeCountTokensResponse:
+    def __init__(self, total_tokens: int):
+        self.total_tokens = total_tokens
+
+
+class FakeResponse:
+    def __init__(self, text: str, usage_metadata: Optional[FakeUsage] = None):
+        self.text = text
+        self.usage_metadata = usage_metadata
+
+
+class FakeGenerativeModel:
+    """
+    Drop-in replacement for genai.GenerativeModel.
+
+    Attributes:
+        latency (float): Mean seconds per call
+        jitter (float): Latency is drawn uniformly from latency +/- jitter
+        error_rate (float): Probability that a call raises ServiceUnavailable
+        response_text (str): Text returned by successful calls
+        stream_chunks (int): Number of chunks a streamed response is split into
+        prompt_tokens (int): Prompt tokens reported per call (prompt text and image)
+        report_usage (bool): Attach usage_metadata to responses (google-generativeai 0.3.x does not)
+        calls (int): Number of calls made so far
+    """
+    def __init__(self, model_name: str = "fake", latency: float = 0.5, jitter: float = 0.0,
+                 error_rate: float = 0.0, response_text: Optional[str] = None, seed: Optional[int] = None,
+                 stream_chunks: int = 8, prompt_tokens: int = 320, report_usage: bool = True):
+        self.model_name = model_name
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.response_text = response_text if response_text is not None else make_canned_response()
+        self.stream_chunks = max(1, stream_chunks)
+        self.prompt_tokens = prompt_tokens
+        self.report_usage = report_usage
+        self.calls = 0
+        self._rng = random.Random(seed)
+
+    def _next_call(self) -> tuple:
+        """Return (delay in seconds, whether the call fails)"""
+        self.calls += 1
+        delay = max(0.0, self.latency + self._rng.uniform(-self.jitter, self.jitter))
+        return delay, self._rng.random() < self.error_rate
+
+    def _usage(self) -> Optional[FakeUsage]:
+        if not self.report_usage:
+            return None
+        return FakeUsage(self.prompt_tokens, len(self.response_text) // 4)
+
+    async def count_tokens_async(self, contents) -> FakeCountTokensResponse:
+        # Text alone is a response; anything else is the prompt with its image
+        if isinstance(contents, str):
+            return FakeCountTokensResponse(len(contents) // 4)
+        return FakeCountTokensResponse(self.prompt_tokens)
+
+    def _chunks(self) -> list:
+        size = -(-len(self.response_text) // self.stream_chunks)
+        return [self.response_text[i:i + size] for i in range(0, len(self.response_text), size)] or [""]
+
+    async def _stream_async(self, delay: float, fail: bool):
+        chunks = self._chunks()
+        for index, chunk in enumerate(chunks):
+            await asyncio.sleep(delay / len(chunks))
+            if fail:
+                raise api_exceptions.ServiceUnavailable("Fake Gemini backend error")
+            yield FakeResponse(chunk, self._usage() if index == len(chunks) - 1 else None)
+
+    def _stream(self, delay: float, fail: bool):
+        chunks = self._chunks()
+        for index, chunk in enumerate(chunks):
+            time.sleep(delay / len(chunks))
+            if fail:
+                raise api_exceptions.ServiceUnavailable("Fake Gemini backend error")
+            yield FakeResponse(chunk, self._usage() if index == len(chunks) - 1 else None)
+
+    async def generate_content_async(self, contents, generation_config=None, stream: bool = False, **kwargs):
+        delay, fail = self._next_call()
+        if stream:
+            return self._stream_async(delay, fail)
+        await asyncio.sleep(delay)
+        if fail:
+            raise api_exceptions.ServiceUnavailable("Fake Gemini backend error")
+        return FakeResponse(self.response_text, self._usage())
+
+    def generate_content(self, contents, generation_config=None, stream: bool = False, **kwargs):
+        delay, fail = self._next_call()
+        if stream:
+            return self._stream(delay, fail)
+        time.sleep(delay)
+        if fail:
+            raise api_exceptions.ServiceUnavailable("Fake Gemini backend error")
+        return FakeResponse(self.response_text, self._usage())
@@ -7,14 +7,72 @@ and F1-score metrics for each object type (tag).
 
 The script processes JSON files containing bounding box annotations and predictions,
 calculating Intersection over Union (IoU) to determine correct detections.
+
+IoU is computed with NumPy for all ground-truth/prediction pairs of an image at
+once. Matching can be done in ground-truth order (the default), in prediction
+score order, or optimally with the Hungarian algorithm (requires SciPy).
+
+With --coco the same IoU matrix also yields COCO-style AP over IoU thresholds
+0.50:0.95, per-tag precision/recall curves and a tag confusion matrix.
+
+With --incremental a manifest keeps each file pair's fingerprints and scored
+counters, so later runs only rescore the pairs whose files changed.
+
+Predictions can be run through the backend's post-processing stage (NMS,
+minimum area, aspect-ratio filters) before scoring, and --compare-postprocess
+reports the metrics with and without it.
+
+The boxes of an image are loaded into the backend's columnar BoxSet (float64
+coordinates, tag codes and optional scores), so scoring works on arrays and
+memory per box stays small. float64 keeps IoU values identical to the scalar
+reference, including boxes that sit exactly on the IoU threshold.
+BoundingBox objects are only used by the pure Python reference
+implementation.
 """
 
 import os
+import sys
+import csv
 import json
+import time
+import hashlib
+import tempfile
+import argparse
+import importlib.util
+import multiprocessing
 from pathlib import Path
-from typing import Dict, List, Tuple
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 import numpy as np
 
+# The backend modules (box store, ...) are importable from the evaluator
+sys.path.insert(0, str(Path(__file__).resolve().parent / "backend"))
+from postprocessing import PostprocessConfig, postprocess_box_set
+from box_set import BoxSet, LabelVocabulary
+
+MATCHING_MODES = ("greedy", "score", "hungarian")
+# SciPy is optional (not in backend/requirements.txt); only hungarian matching needs it
+HUNGARIAN_REQUIRES_SCIPY = "Hungarian matching requires SciPy, an optional dependency: pip install scipy"
+
+def matching_unavailable(matching: str) -> Optional[str]:
+    """Error message if the optional dependency of a matching mode is not installed, else None"""
+    if matching == "hungarian" and importlib.util.find_spec("scipy") is None:
+        return HUNGARIAN_REQUIRES_SCIPY
+    return None
+
+# Below this many ground-truth/prediction pairs the IoU matrix is computed in one block
+SMALL_MATRIX_SIZE = 4096
+# IoU thresholds and recall points used for COCO-style average precision
+COCO_IOU_THRESHOLDS = np.round(np.arange(0.5, 0.951, 0.05), 2)
+RECALL_POINTS = np.linspace(0.0, 1.0, 101)
+# Confusion matrix label for missed ground truths and unmatched predictions
+BACKGROUND = "background"
+# Number of file pairs handed to a worker process at a time
+EVALUATION_CHUNKSIZE = 16
+# Bumped when the manifest layout or the scoring changes, invalidating old manifests
+MANIFEST_VERSION = 1
+# Tags of all box sets loaded in this process, so ground truth and predictions compare by code
+TAGS = LabelVocabulary()
+
 class BoundingBox:
     """
     Represents a bounding box with coordinates and dimensions.
@@ -24,12 +82,16 @@ class BoundingBox:
         y1 (float): Top coordinate of the box
         x2 (float): Right coordinate of the box
         y2 (float): Bottom coordinate of the box
+        score (float): Confidence of a predicted box (1.0 when unknown)
     """
-    def __init__(self, x: float, y: float, width: float, height: float):
+    __slots__ = ("x1", "y1", "x2", "y2", "score")
+
+    def __init__(self, x: float, y: float, width: float, height: float, score: float = 1.0):
         self.x1 = x
         self.y1 = y
         self.x2 = x + width
         self.y2 = y + height
+        self.score = score
 
 def calculate_iou(box1: BoundingBox, box2: BoundingBox) -> float:
     """Calculate Intersection over Union between two bounding boxes"""
@@ -51,45 +113,214 @@ def calculate_iou(box1: BoundingBox, box2: BoundingBox) -> float:
     
     return intersection / union if union > 0 else 0.0
 
-def load_annotations(file_path: Path) -> List[Tuple[str, BoundingBox]]:
+def load_annotations(file_path: Path) -> BoxSet:
     """Load annotations from a JSON file"""
     with open(file_path) as f:
         data = json.load(f)
-    
-    boxes = []
-    for ann in data['annotations']:
-        tag = ann['tag'].lower()
-        box = BoundingBox(
-            ann['x'],
-            ann['y'],
-            ann['width'],
-            ann['height']
-        )
-        boxes.append((tag, box))
-    return boxes
-
-def load_predictions(file_path: Path) -> List[Tuple[str, BoundingBox]]:
+    return BoxSet.from_annotations(data['annotations'], TAGS, lowercase=True, dtype=np.float64)
+
+def load_predictions(file_path: Path) -> BoxSet:
     """Load predictions from a JSON file"""
     with open(file_path) as f:
         data = json.load(f)
+    return BoxSet.from_predictions(data['predictions'], TAGS, lowercase=True, dtype=np.float64)
+
+def as_box_set(boxes) -> BoxSet:
+    """Return boxes as a BoxSet in the TAGS vocabulary; also accepts a list of (tag, BoundingBox) pairs"""
+    if isinstance(boxes, BoxSet):
+        return boxes.recode(TAGS)
+    return BoxSet(
+        [[box.x1, box.y1, box.x2, box.y2] for _, box in boxes],
+        TAGS.encode_all(tag for tag, _ in boxes),
+        [box.score for _, box in boxes],
+        TAGS,
+        np.float64
+    )
+
+def postprocess_prediction_boxes(predictions: BoxSet, config: PostprocessConfig) -> BoxSet:
+    """
+    Apply the backend post-processing stage to one image's predictions.
+
+    The image size is not known here, so boxes are not snapped to the image bounds.
+    """
+    if not len(predictions):
+        return predictions
+    return postprocess_box_set(predictions, config)[0]
+
+def iou_matrix(boxes1: np.ndarray, boxes2: np.ndarray) -> np.ndarray:
+    """
+    Calculate the IoU of every pair of boxes in two (N, 4) and (M, 4) arrays.
+
+    Returns:
+        np.ndarray: (N, M) matrix, equal to calculate_iou for each pair
+    """
+    # IoU is computed in float64 like calculate_iou, also for float32 box sets
+    boxes1 = np.asarray(boxes1, dtype=np.float64)
+    boxes2 = np.asarray(boxes2, dtype=np.float64)
+    widths = np.minimum(boxes1[:, None, 2], boxes2[None, :, 2]) - np.maximum(boxes1[:, None, 0], boxes2[None, :, 0])
+    heights = np.minimum(boxes1[:, None, 3], boxes2[None, :, 3]) - np.maximum(boxes1[:, None, 1], boxes2[None, :, 1])
+    np.maximum(widths, 0.0, out=widths)
+    np.maximum(heights, 0.0, out=heights)
+    intersection = widths * heights
+
+    area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+    area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+    union = area1[:, None] + area2[None, :] - intersection
+
+    iou = np.zeros_like(intersection)
+    np.divide(intersection, union, out=iou, where=(intersection > 0) & (union > 0))
+    return iou
+
+def class_iou_matrix(ground_truth: BoxSet, predictions: BoxSet) -> np.ndarray:
+    """
+    IoU matrix computed only within each tag; pairs with different tags are
+    set to -1 so they never match. Both sets must share a vocabulary.
+    """
+    num_pairs = len(ground_truth) * len(predictions)
+    if num_pairs <= SMALL_MATRIX_SIZE:
+        # For typical screenshots one full matrix is cheaper than per-tag blocks
+        return np.where(ground_truth.same_label(predictions),
+                        iou_matrix(ground_truth.coords, predictions.coords), -1.0)
+
+    iou = np.full((len(ground_truth), len(predictions)), -1.0)
+    for code in np.intersect1d(ground_truth.labels, predictions.labels):
+        gt_idx = np.flatnonzero(ground_truth.labels == code)
+        pred_idx = np.flatnonzero(predictions.labels == code)
+        iou[np.ix_(gt_idx, pred_idx)] = iou_matrix(ground_truth.coords[gt_idx], predictions.coords[pred_idx])
+    return iou
+
+def match_boxes(iou: np.ndarray, iou_threshold: float = 0.5, matching: str = "greedy",
+                scores: Optional[np.ndarray] = None) -> List[Tuple[int, int]]:
+    """
+    Match ground-truth rows to prediction columns of an IoU matrix.
+
+    Args:
+        iou (np.ndarray): (N, M) IoU matrix, -1 for pairs that may not match
+        iou_threshold (float): A pair matches only if its IoU is above this value
+        matching (str): "greedy" - each ground truth in order takes its best
+            unused prediction; "score" - each prediction in descending score
+            order takes its best unused ground truth; "hungarian" - maximum
+            number of matches, then maximum total IoU
+        scores (np.ndarray): Prediction confidence scores for "score" matching
+
+    Returns:
+        list: (ground truth index, prediction index) pairs
+    """
+    num_gt, num_pred = iou.shape
+    if num_gt == 0 or num_pred == 0:
+        return []
+
+    matches = []
+    if matching == "greedy":
+        # Candidate pairs come out sorted by ground truth, then prediction index
+        gt_indices, pred_indices = np.nonzero(iou > iou_threshold)
+        values = iou[gt_indices, pred_indices].tolist()
+        used = set()
+        best_gt, best_pred, best_iou = None, None, 0.0
+        for gt_idx, pred_idx, value in zip(gt_indices.tolist(), pred_indices.tolist(), values):
+            if gt_idx != best_gt:
+                if best_pred is not None:
+                    used.add(best_pred)
+                    matches.append((best_gt, best_pred))
+                best_gt, best_pred, best_iou = gt_idx, None, 0.0
+            if pred_idx not in used and (best_pred is None or value > best_iou):
+                best_pred, best_iou = pred_idx, value
+        if best_pred is not None:
+            matches.append((best_gt, best_pred))
+    elif matching == "score":
+        if scores is None:
+            scores = np.ones(num_pred)
+        used = np.zeros(num_gt, dtype=bool)
+        for pred_idx in np.argsort(-scores, kind="stable"):
+            column = np.where(used, -1.0, iou[:, pred_idx])
+            gt_idx = int(np.argmax(column))
+            if column[gt_idx] > iou_threshold:
+                used[gt_idx] = True
+                matches.append((gt_idx, int(pred_idx)))
+        matches.sort()
+    elif matching == "hungarian":
+        try:
+            from scipy.optimize import linear_sum_assignment
+        except ImportError:
+            raise ImportError(HUNGARIAN_REQUIRES_SCIPY)
+        valid = iou > iou_threshold
+        # Every valid pair is worth more than any total IoU gain, so the
+        # number of matches is maximized first and total IoU second
+        weight = np.where(valid, min(num_gt, num_pred) + 1 + iou, 0.0)
+        rows, cols = linear_sum_assignment(weight, maximize=True)
+        matches = [(int(r), int(c)) for r, c in zip(rows, cols) if valid[r, c]]
+    else:
+        raise ValueError(f"Unknown matching mode: {matching}. Expected one of {MATCHING_MODES}")
+    return matches
+
+def count_tag_metrics(ground_truth: BoxSet, predictions: BoxSet, class_iou: np.ndarray,
+                      iou_threshold: float = 0.5, matching: str = "greedy",
+                      scores: Optional[np.ndarray] = None) -> Dict:
+    """
+    Count ground truths, predictions and true positives per tag from a
+    class-masked IoU matrix. Both sets must share a vocabulary.
+    """
+    size = len(ground_truth.vocabulary)
+    total_gt = np.bincount(ground_truth.labels, minlength=size)
+    total_pred = np.bincount(predictions.labels, minlength=size)
+    matched_gt = [gt_idx for gt_idx, _ in match_boxes(class_iou, iou_threshold, matching, scores)]
+    true_positives = np.bincount(ground_truth.labels[matched_gt], minlength=size)
+
+    tag_metrics = {}
+    for code in np.flatnonzero(total_gt + total_pred).tolist():
+        tag_metrics[ground_truth.vocabulary.labels[code]] = {
+            'total_ground_truth': int(total_gt[code]),
+            'total_predictions': int(total_pred[code]),
+            'true_positives': int(true_positives[code])
+        }
+    return tag_metrics
+
+def calculate_metrics(ground_truth: BoxSet, predictions: BoxSet, iou_threshold: float = 0.5,
+                      matching: str = "greedy", scores: Optional[np.ndarray] = None) -> Dict:
+    """
+    Calculate precision, recall, and F1-score for each tag using the vectorized IoU engine.
+
+    Ground truth and predictions are BoxSets or lists of (tag, BoundingBox) pairs.
+    """
+    ground_truth, predictions = as_box_set(ground_truth), as_box_set(predictions)
+    if scores is None:
+        scores = predictions.score_array()
+
+    iou = class_iou_matrix(ground_truth, predictions)
+    tag_metrics = count_tag_metrics(ground_truth, predictions, iou, iou_threshold, matching, scores)
+    return summarize_tag_metrics(tag_metrics)
+
+def summarize_tag_metrics(tag_metrics: Dict) -> Dict:
+    """Add precision, recall, and F1-score to per-tag counters"""
+    results = {}
+    # Sorted, so printed and saved results do not depend on which file a tag was first seen in
+    for tag, metrics in sorted(tag_metrics.items()):
+        tp = metrics['true_positives']
+        total_gt = metrics['total_ground_truth']
+        total_pred = metrics['total_predictions']
+        
+        precision = tp / total_pred if total_pred > 0 else 0
+        recall = tp / total_gt if total_gt > 0 else 0
+        f1 = 2 * (precision * recall) / (precision + recall) if (precision + recall) > 0 else 0
+        
+        results[tag] = {
+            'total_ground_truth': total_gt,
+            'total_predictions': total_pred,
+            'true_positives': tp,
+            'precision': precision,
+            'recall': recall,
+            'f1_score': f1
+        }
     
-    boxes = []
-    for pred in data['predictions']:
-        tag = pred['type'].lower()
-        coords = pred['coordinates']
-        box = BoundingBox(
-            coords['x'],
-            coords['y'],
-            coords['width'],
-            coords['height']
-        )
-        boxes.append((tag, box))
-    return boxes
-
-def calculate_metrics(ground_truth: List[Tuple[str, BoundingBox]], 
-                     predictions: List[Tuple[str, BoundingBox]], 
-                     iou_threshold: float = 0.5) -> Dict:
-    """Calculate precision, recall, and F1-score for each tag"""
+    return results
+
+def calculate_metrics_scalar(ground_truth: List[Tuple[str, BoundingBox]], 
+                             predictions: List[Tuple[str, BoundingBox]], 
+                             iou_threshold: float = 0.5) -> Dict:
+    """
+    Calculate precision, recall, and F1-score for each tag with pure Python
+    loops over calculate_iou. Kept as the reference for calculate_metrics.
+    """
     # Initialize counters for each tag
     tag_metrics = {}
     
@@ -136,88 +367,637 @@ def calculate_metrics(ground_truth: List[Tuple[str, BoundingBox]],
             tag_metrics[gt_tag]['true_positives'] += 1
     
     # Calculate precision, recall, and F1-score for each tag
-    results = {}
-    for tag, metrics in tag_metrics.items():
-        tp = metrics['true_positives']
-        total_gt = metrics['total_ground_truth']
-        total_pred = metrics['total_predictions']
-        
-        precision = tp / total_pred if total_pred > 0 else 0
-        recall = tp / total_gt if total_gt > 0 else 0
-        f1 = 2 * (precision * recall) / (precision + recall) if (precision + recall) > 0 else 0
-        
-        results[tag] = {
-            'total_ground_truth': total_gt,
-            'total_predictions': total_pred,
-            'true_positives': tp,
-            'precision': precision,
-            'recall': recall,
-            'f1_score': f1
+    return summarize_tag_metrics(tag_metrics)
+
+def coco_image_stats(gt_tags: List[str], pred_tags: List[str], scores: np.ndarray, iou: np.ndarray,
+                     same_tag: np.ndarray, thresholds: np.ndarray = COCO_IOU_THRESHOLDS,
+                     confusion_threshold: float = 0.5) -> Dict:
+    """
+    Derive COCO-style matches for every IoU threshold and the tag confusion
+    counts of one image from a single IoU matrix.
+
+    For each threshold, predictions are visited in descending score order and
+    take the unused same-tag ground truth with the highest IoU (>= threshold).
+    The confusion counts pair boxes regardless of tag (highest IoU first,
+    IoU >= confusion_threshold); unpaired boxes count against BACKGROUND.
+
+    Args:
+        gt_tags (list): Ground truth tags (N)
+        pred_tags (list): Prediction tags (M)
+        scores (np.ndarray): Prediction scores (M)
+        iou (np.ndarray): (N, M) IoU matrix over all pairs, regardless of tag
+        same_tag (np.ndarray): (N, M) boolean matrix of pairs sharing a tag
+        thresholds (np.ndarray): IoU thresholds (T)
+        confusion_threshold (float): IoU threshold for the confusion counts
+
+    Returns:
+        dict: {"num_gt": {tag: count}, "pred_tags": [...], "scores": (M,),
+               "matched": (M, T) bool, "confusion": {(gt tag, pred tag): count}}
+    """
+    num_gt, num_pred = len(gt_tags), len(pred_tags)
+    class_iou = np.where(same_tag, iou, -1.0)
+    order = np.argsort(-scores, kind="stable")
+
+    matched = np.zeros((num_pred, len(thresholds)), dtype=bool)
+    for t_idx, threshold in enumerate(thresholds if num_gt > 0 else []):
+        used = np.zeros(num_gt, dtype=bool)
+        for pred_idx in order:
+            column = np.where(used, -1.0, class_iou[:, pred_idx])
+            gt_idx = int(np.argmax(column))
+            if column[gt_idx] >= threshold:
+                used[gt_idx] = True
+                matched[pred_idx, t_idx] = True
+
+    confusion = {}
+    gt_paired = np.zeros(num_gt, dtype=bool)
+    pred_paired = np.zeros(num_pred, dtype=bool)
+    gt_indices, pred_indices = np.nonzero(iou >= confusion_threshold)
+    for k in np.argsort(-iou[gt_indices, pred_indices], kind="stable"):
+        gt_idx, pred_idx = gt_indices[k], pred_indices[k]
+        if gt_paired[gt_idx] or pred_paired[pred_idx]:
+            continue
+        gt_paired[gt_idx] = pred_paired[pred_idx] = True
+        key = (gt_tags[gt_idx], pred_tags[pred_idx])
+        confusion[key] = confusion.get(key, 0) + 1
+    for gt_idx in np.flatnonzero(~gt_paired):
+        key = (gt_tags[gt_idx], BACKGROUND)
+        confusion[key] = confusion.get(key, 0) + 1
+    for pred_idx in np.flatnonzero(~pred_paired):
+        key = (BACKGROUND, pred_tags[pred_idx])
+        confusion[key] = confusion.get(key, 0) + 1
+
+    num_gt_per_tag = {}
+    for tag in gt_tags:
+        num_gt_per_tag[tag] = num_gt_per_tag.get(tag, 0) + 1
+
+    return {
+        "num_gt": num_gt_per_tag,
+        "pred_tags": list(pred_tags),
+        "scores": np.asarray(scores, dtype=np.float64),
+        "matched": matched,
+        "confusion": confusion,
+    }
+
+def average_precision(scores: np.ndarray, matched: np.ndarray, num_gt: int) -> Tuple[float, np.ndarray]:
+    """
+    COCO 101-point interpolated average precision for one tag and threshold.
+
+    Returns:
+        tuple: (AP, interpolated precision at each of the RECALL_POINTS)
+    """
+    if num_gt == 0:
+        return float("nan"), np.zeros(len(RECALL_POINTS))
+    order = np.argsort(-scores, kind="stable")
+    tp = np.cumsum(matched[order])
+    fp = np.cumsum(~matched[order])
+    recall = tp / num_gt
+    precision = tp / np.maximum(tp + fp, np.finfo(np.float64).eps)
+    # Make precision monotonically decreasing, as COCO does
+    precision = np.maximum.accumulate(precision[::-1])[::-1] if precision.size else precision
+
+    interpolated = np.zeros(len(RECALL_POINTS))
+    indices = np.searchsorted(recall, RECALL_POINTS, side="left")
+    valid = indices < len(recall)
+    interpolated[valid] = precision[indices[valid]]
+    return float(interpolated.mean()), interpolated
+
+class CocoAccumulator:
+    """
+    Collects per-image COCO statistics and summarizes them into AP at every
+    IoU threshold, per-tag PR curves and a tag confusion matrix.
+    """
+    def __init__(self, thresholds: np.ndarray = COCO_IOU_THRESHOLDS):
+        self.thresholds = thresholds
+        self.num_gt = {}
+        self.scores = {}
+        self.matched = {}
+        self.confusion = {}
+
+    def add(self, image_stats: Dict, name: str = ""):
+        """
+        Add one image's statistics. Images are ranked in name order, so
+        predictions with tied scores give the same AP whatever order worker
+        processes return them in.
+        """
+        for tag, count in image_stats["num_gt"].items():
+            self.num_gt[tag] = self.num_gt.get(tag, 0) + count
+        pred_tags = np.array(image_stats["pred_tags"], dtype=object)
+        for tag in set(image_stats["pred_tags"]):
+            rows = pred_tags == tag
+            self.scores.setdefault(tag, []).append((name, image_stats["scores"][rows]))
+            self.matched.setdefault(tag, []).append((name, image_stats["matched"][rows]))
+        for key, count in image_stats["confusion"].items():
+            self.confusion[key] = self.confusion.get(key, 0) + count
+
+    def summarize(self) -> Dict:
+        """
+        Returns:
+            dict: {"per_tag": {tag: {"AP", "AP50", "AP75", "AP_per_threshold",
+                   "pr_curve"}}, "mAP", "mAP50", "mAP75", "thresholds",
+                   "confusion_matrix": {gt tag: {pred tag: count}}}
+        """
+        per_tag = {}
+        for tag in sorted(set(self.num_gt) | set(self.scores)):
+            scores = np.concatenate([chunk for _, chunk in sorted(self.scores.get(tag, []), key=lambda item: item[0])]
+                                    or [np.zeros(0)])
+            matched = np.concatenate([chunk for _, chunk in sorted(self.matched.get(tag, []), key=lambda item: item[0])]
+                                     or [np.zeros((0, len(self.thresholds)), dtype=bool)])
+            num_gt = self.num_gt.get(tag, 0)
+            ap_per_threshold = []
+            pr_curve = None
+            for t_idx, threshold in enumerate(self.thresholds):
+                ap, interpolated = average_precision(scores, matched[:, t_idx], num_gt)
+                ap_per_threshold.append(ap)
+                if t_idx == 0:
+                    pr_curve = {"recall": RECALL_POINTS.tolist(), "precision": interpolated.tolist(),
+                                "iou_threshold": float(threshold)}
+            per_tag[tag] = {
+                "num_ground_truth": num_gt,
+                "num_predictions": int(scores.size),
+                "AP": float(np.mean(ap_per_threshold)),
+                "AP50": self._ap_at(ap_per_threshold, 0.5),
+                "AP75": self._ap_at(ap_per_threshold, 0.75),
+                "AP_per_threshold": {f"{t:.2f}": ap for t, ap in zip(self.thresholds, ap_per_threshold)},
+                "pr_curve": pr_curve,
+            }
+
+        def mean_over_tags(key):
+            values = [m[key] for m in per_tag.values() if not np.isnan(m[key])]
+            return float(np.mean(values)) if values else float("nan")
+
+        confusion_matrix = {}
+        for (gt_tag, pred_tag), count in sorted(self.confusion.items()):
+            confusion_matrix.setdefault(gt_tag, {})[pred_tag] = count
+
+        return {
+            "thresholds": [float(t) for t in self.thresholds],
+            "mAP": mean_over_tags("AP"),
+            "mAP50": mean_over_tags("AP50"),
+            "mAP75": mean_over_tags("AP75"),
+            "per_tag": per_tag,
+            "confusion_matrix": confusion_matrix,
         }
-    
-    return results
 
-def main():
-    # Paths to the annotation and prediction folders
-    annotations_dir = Path("./backend/annotations")
-    predictions_dir = Path("./backend/predictions")
-    
-    # Initialize overall metrics
-    overall_metrics = {}
-    total_files = 0
-    
-    # Process each annotation file
-    for ann_file in annotations_dir.glob("*.json"):
+    def _ap_at(self, ap_per_threshold: List[float], threshold: float) -> float:
+        matches = np.flatnonzero(np.isclose(self.thresholds, threshold))
+        return ap_per_threshold[matches[0]] if matches.size else float("nan")
+
+def evaluate_image(ground_truth: BoxSet, predictions: BoxSet, iou_threshold: float = 0.5, matching: str = "greedy",
+                   coco: bool = False) -> Tuple[Dict, Optional[Dict]]:
+    """
+    Score one image: per-tag counters at iou_threshold and, in COCO mode,
+    the statistics for all COCO thresholds, all from one IoU matrix.
+
+    Returns:
+        tuple: (per-tag counters, coco_image_stats result or None)
+    """
+    if not coco:
+        return calculate_metrics(ground_truth, predictions, iou_threshold, matching), None
+
+    ground_truth, predictions = as_box_set(ground_truth), as_box_set(predictions)
+    scores = predictions.score_array().astype(np.float64)
+
+    iou = iou_matrix(ground_truth.coords, predictions.coords)
+    same_tag = ground_truth.same_label(predictions)
+    class_iou = np.where(same_tag, iou, -1.0)
+
+    tag_metrics = count_tag_metrics(ground_truth, predictions, class_iou, iou_threshold, matching, scores)
+    return tag_metrics, coco_image_stats(ground_truth.tags(), predictions.tags(), scores, iou, same_tag)
+
+def print_coco_summary(summary: Dict):
+    """Print AP per tag and the tag confusion matrix"""
+    print("\n=== COCO-style Results ===")
+    print(f"IoU thresholds: {summary['thresholds'][0]:.2f}:{summary['thresholds'][-1]:.2f}")
+    print(f"mAP@[.5:.95]: {summary['mAP']:.3f}  mAP@.5: {summary['mAP50']:.3f}  mAP@.75: {summary['mAP75']:.3f}\n")
+    print(f"{'tag':<12} {'AP':>6} {'AP50':>6} {'AP75':>6}")
+    for tag, metrics in sorted(summary["per_tag"].items()):
+        print(f"{tag:<12} {metrics['AP']:>6.3f} {metrics['AP50']:>6.3f} {metrics['AP75']:>6.3f}")
+
+    confusion = summary["confusion_matrix"]
+    tags = sorted({tag for row in confusion.values() for tag in row} | set(confusion))
+    print("\nConfusion matrix (rows: ground truth, columns: prediction)")
+    print(f"{'':<12}" + "".join(f"{tag:>12}" for tag in tags))
+    for gt_tag in tags:
+        row = confusion.get(gt_tag, {})
+        print(f"{gt_tag:<12}" + "".join(f"{row.get(pred_tag, 0):>12}" for pred_tag in tags))
+
+def find_file_pairs(annotations_dir: Path, predictions_dir: Path) -> Iterator[Tuple[Path, Path]]:
+    """Yield (annotation file, prediction file) pairs matched by the predictions_{name} convention"""
+    for ann_file in sorted(annotations_dir.glob("*.json")):
         # Find corresponding prediction file
         pred_file = predictions_dir / f"predictions_{ann_file.name}"
         if not pred_file.exists():
             print(f"Warning: No prediction file found for {ann_file.name}")
             continue
+        yield ann_file, pred_file
+
+def iter_store_pairs(store_path: Path, model: Optional[str] = None,
+                     prompt_version: Optional[str] = None) -> Iterator[Tuple[str, List, List]]:
+    """
+    Yield (image filename, ground truth, predictions) box sets from the SQLite
+    box store written by the backend (STORAGE_FORMAT=sqlite), using its bulk query API.
+    """
+    from box_store import BoxStore
+
+    def to_boxes(rows):
+        scores = [1.0 if row[5] is None else row[5] for row in rows]
+        return BoxSet.from_xywh([row[0].lower() for row in rows], [row[1:5] for row in rows],
+                                scores if any(row[5] is not None for row in rows) else None, TAGS, np.float64)
+
+    store = BoxStore(str(store_path))
+    try:
+        for filename, ground_truth, predictions in store.iter_evaluation_pairs(model, prompt_version):
+            yield filename, to_boxes(ground_truth), to_boxes(predictions)
+    finally:
+        store.close()
+
+def evaluate_file_pair(task: Tuple) -> Tuple[str, Dict[str, Tuple[int, int, int]], Optional[Dict]]:
+    """
+    Score one annotation/prediction pair (runs inside a worker process).
+
+    The task is (annotation file, prediction file, iou_threshold, matching, coco,
+    postprocess) or, for boxes already loaded from the box store,
+    (name, ground truth BoxSet, predicted BoxSet, iou_threshold, matching, coco,
+    postprocess), where postprocess is a PostprocessConfig or None.
+
+    Returns:
+        tuple: (annotation file name, {tag: (ground truth, predictions, true positives)},
+                coco_image_stats result or None)
+    """
+    if len(task) == 7:
+        name, ground_truth, predictions, iou_threshold, matching, coco, postprocess = task
+    else:
+        ann_file, pred_file, iou_threshold, matching, coco, postprocess = task
+        name, ground_truth, predictions = ann_file.name, load_annotations(ann_file), load_predictions(pred_file)
+    if postprocess is not None:
+        predictions = postprocess_prediction_boxes(predictions, postprocess)
+    metrics, coco_stats = evaluate_image(ground_truth, predictions, iou_threshold, matching, coco)
+    counters = {
+        tag: (m['total_ground_truth'], m['total_predictions'], m['true_positives'])
+        for tag, m in metrics.items()
+    }
+    return name, counters, coco_stats
+
+def accumulate_counters(overall_metrics: Dict, counters: Dict[str, Tuple[int, int, int]]):
+    """Add per-file tag counters to the running totals"""
+    for tag, (total_gt, total_pred, tp) in counters.items():
+        if tag not in overall_metrics:
+            overall_metrics[tag] = {
+                'total_ground_truth': 0,
+                'total_predictions': 0,
+                'true_positives': 0
+            }
         
-        print(f"\nProcessing {ann_file.name}...")
-        
-        # Load annotations and predictions
-        ground_truth = load_annotations(ann_file)
-        predictions = load_predictions(pred_file)
-        
-        # Calculate metrics for this file
-        metrics = calculate_metrics(ground_truth, predictions)
-        
-        # Accumulate metrics
-        for tag, tag_metrics in metrics.items():
-            if tag not in overall_metrics:
-                overall_metrics[tag] = {
-                    'total_ground_truth': 0,
-                    'total_predictions': 0,
-                    'true_positives': 0
-                }
-            
-            overall_metrics[tag]['total_ground_truth'] += tag_metrics['total_ground_truth']
-            overall_metrics[tag]['total_predictions'] += tag_metrics['total_predictions']
-            overall_metrics[tag]['true_positives'] += tag_metrics['true_positives']
-        
-        total_files += 1
+        overall_metrics[tag]['total_ground_truth'] += total_gt
+        overall_metrics[tag]['total_predictions'] += total_pred
+        overall_metrics[tag]['true_positives'] += tp
+
+def evaluate_dataset(pairs: Iterable[Tuple[Path, Path]], iou_threshold: float = 0.5, matching: str = "greedy",
+                     workers: int = 1, on_file_result: Optional[Callable] = None,
+                     coco: Optional[CocoAccumulator] = None,
+                     postprocess: Optional[PostprocessConfig] = None) -> Tuple[Dict, int]:
+    """
+    Score annotation/prediction pairs, in parallel when workers > 1.
+
+    Pairs are streamed to the workers and each worker only returns compact
+    per-tag counters, which are reduced here, so memory does not grow with
+    the number of files. Results are reduced (and on_file_result called) in
+    pair order, so the output does not depend on the number of workers.
+
+    Args:
+        pairs (iterable): (annotation file, prediction file) pairs, or
+            (name, ground truth BoxSet, predicted BoxSet) triples
+        iou_threshold (float): Minimum IoU for a true positive
+        matching (str): Matching mode, see match_boxes
+        workers (int): Number of worker processes (1 = evaluate in this process)
+        on_file_result (callable): Called with (file name, counters, coco stats or None)
+            for each scored file
+        coco (CocoAccumulator): If given, COCO statistics are computed in the same pass and added to it
+        postprocess (PostprocessConfig): If given, predictions are post-processed before scoring
+
+    Returns:
+        tuple: (overall per-tag counters, number of files processed)
+    """
+    tasks = (tuple(pair) + (iou_threshold, matching, coco is not None, postprocess) for pair in pairs)
+    overall_metrics = {}
+    total_files = 0
+
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap(evaluate_file_pair, tasks, chunksize=EVALUATION_CHUNKSIZE)
+    else:
+        pool = None
+        results = map(evaluate_file_pair, tasks)
+
+    try:
+        for name, counters, coco_stats in results:
+            accumulate_counters(overall_metrics, counters)
+            if coco is not None:
+                coco.add(coco_stats, name)
+            total_files += 1
+            if on_file_result is not None:
+                on_file_result(name, counters, coco_stats)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return overall_metrics, total_files
+
+def file_fingerprint(path: Path, previous: Optional[Dict] = None) -> Dict:
+    """
+    Return {"size", "mtime_ns", "sha256"} for a file.
+
+    The content is only hashed when size or mtime differ from the previous
+    fingerprint, so unchanged files cost one stat call.
+    """
+    stat = path.stat()
+    if previous is not None and previous["size"] == stat.st_size and previous["mtime_ns"] == stat.st_mtime_ns:
+        return previous
+    with open(path, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest}
+
+def coco_stats_to_json(coco_stats: Dict) -> Dict:
+    """Compact JSON form of coco_image_stats: matches are stored as one bitmask per prediction"""
+    weights = 1 << np.arange(coco_stats["matched"].shape[1], dtype=np.int64)
+    return {
+        "num_gt": coco_stats["num_gt"],
+        "pred_tags": coco_stats["pred_tags"],
+        "scores": coco_stats["scores"].tolist(),
+        "matched": (coco_stats["matched"] * weights).sum(axis=1).tolist(),
+        "confusion": [[gt_tag, pred_tag, count] for (gt_tag, pred_tag), count in coco_stats["confusion"].items()],
+    }
+
+def coco_stats_from_json(data: Dict, num_thresholds: int = len(COCO_IOU_THRESHOLDS)) -> Dict:
+    masks = np.array(data["matched"], dtype=np.int64).reshape(-1, 1)
+    return {
+        "num_gt": data["num_gt"],
+        "pred_tags": data["pred_tags"],
+        "scores": np.array(data["scores"], dtype=np.float64),
+        "matched": (masks >> np.arange(num_thresholds, dtype=np.int64)) & 1 == 1,
+        "confusion": {(gt_tag, pred_tag): count for gt_tag, pred_tag, count in data["confusion"]},
+    }
+
+def load_manifest(manifest_path: Path, settings: Dict) -> Dict:
+    """Load the per-file manifest; an unreadable or differently configured manifest starts empty"""
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if manifest.get("version") != MANIFEST_VERSION or manifest.get("settings") != settings:
+        print("Evaluation settings changed, rescoring every file", file=sys.stderr)
+        return {}
+    return manifest.get("files", {})
+
+def save_manifest(manifest_path: Path, settings: Dict, files: Dict):
+    """Write the manifest atomically so an interrupted run never leaves a truncated file"""
+    directory = manifest_path.parent
+    directory.mkdir(parents=True, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump({"version": MANIFEST_VERSION, "settings": settings, "files": files}, f)
+        os.replace(temp_path, manifest_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def evaluate_incremental(pairs: List[Tuple[Path, Path]], manifest_path: Path, iou_threshold: float = 0.5,
+                         matching: str = "greedy", workers: int = 1, on_file_result: Optional[Callable] = None,
+                         coco: Optional[CocoAccumulator] = None,
+                         postprocess: Optional[PostprocessConfig] = None) -> Tuple[Dict, int, int]:
+    """
+    Like evaluate_dataset, but only rescore the pairs whose annotation or
+    prediction file changed since the manifest was written; the counters of
+    the other pairs are taken from the manifest. Pairs whose files are gone
+    are dropped from the manifest.
+
+    Returns:
+        tuple: (overall per-tag counters, number of files, number of files rescored)
+    """
+    settings = {"iou_threshold": iou_threshold, "matching": matching, "coco": coco is not None,
+                "postprocess": postprocess.as_dict() if postprocess is not None else None}
+    previous = load_manifest(manifest_path, settings)
+    files = {}
+    changed = []
+    for ann_file, pred_file in pairs:
+        entry = previous.get(ann_file.name, {})
+        annotation = file_fingerprint(ann_file, entry.get("annotation"))
+        prediction = file_fingerprint(pred_file, entry.get("prediction"))
+        if entry and entry["annotation"]["sha256"] == annotation["sha256"] \
+                and entry["prediction"]["sha256"] == prediction["sha256"]:
+            files[ann_file.name] = {**entry, "annotation": annotation, "prediction": prediction}
+        else:
+            files[ann_file.name] = {"annotation": annotation, "prediction": prediction}
+            changed.append((ann_file, pred_file))
+
+    def on_rescored(name, counters, coco_stats):
+        files[name]["counters"] = counters
+        files[name]["coco"] = coco_stats_to_json(coco_stats) if coco_stats is not None else None
+        if on_file_result is not None:
+            on_file_result(name, counters, coco_stats)
+
+    # Starting worker processes costs more than scoring a handful of pairs
+    workers = max(1, min(workers, len(changed)))
+    overall_metrics, _ = evaluate_dataset(changed, iou_threshold, matching, workers, on_rescored, coco, postprocess)
+
+    rescored = {ann_file.name for ann_file, _ in changed}
+    for name, entry in files.items():
+        if name in rescored:
+            continue
+        counters = {tag: tuple(values) for tag, values in entry["counters"].items()}
+        coco_stats = coco_stats_from_json(entry["coco"]) if coco is not None else None
+        accumulate_counters(overall_metrics, counters)
+        if coco is not None:
+            coco.add(coco_stats, name)
+        if on_file_result is not None:
+            on_file_result(name, counters, coco_stats)
+
+    save_manifest(manifest_path, settings, files)
+    return overall_metrics, len(files), len(changed)
+
+class ProgressReporter:
+    """Prints how many files have been scored, at most once per interval"""
+    def __init__(self, total: int, interval: float = 1.0):
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.start_time = time.perf_counter()
+        self._last_report = 0.0
+
+    def update(self):
+        self.done += 1
+        now = time.perf_counter()
+        if now - self._last_report >= self.interval or self.done == self.total:
+            self._last_report = now
+            elapsed = now - self.start_time
+            rate = self.done / elapsed if elapsed > 0 else 0.0
+            print(f"Processed {self.done}/{self.total} files ({rate:.1f} files/s)", file=sys.stderr)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Evaluate predictions against ground truth annotations")
+    parser.add_argument("--annotations-dir", type=Path, default=Path("./backend/annotations"),
+                        help="Directory containing ground truth annotation files")
+    parser.add_argument("--predictions-dir", type=Path, default=Path("./backend/predictions"),
+                        help="Directory containing predictions_*.json files")
+    parser.add_argument("--store", type=Path,
+                        help="Read annotations and predictions from this SQLite box store instead of JSON files")
+    parser.add_argument("--model", help="With --store, only use predictions from this model")
+    parser.add_argument("--prompt-version", help="With --store, only use predictions from this prompt version")
+    parser.add_argument("--iou-threshold", type=float, default=0.5,
+                        help="Minimum IoU for a prediction to count as a true positive")
+    parser.add_argument("--matching", choices=MATCHING_MODES, default="greedy",
+                        help="How ground truth and predicted boxes are paired")
+    parser.add_argument("--coco", action="store_true",
+                        help="Also compute AP@[.5:.95], per-tag PR curves and a tag confusion matrix")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Number of worker processes (1 evaluates in the main process)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only rescore files that changed since the last --incremental run")
+    parser.add_argument("--manifest", type=Path, default=Path("./backend/evaluation_manifest.json"),
+                        help="Manifest of file fingerprints and cached counters used by --incremental")
+    parser.add_argument("--nms-iou", type=float,
+                        help="Post-process predictions with per-tag NMS at this IoU before scoring")
+    parser.add_argument("--cross-class-iou", type=float,
+                        help="Post-process predictions with NMS across tags at this IoU before scoring")
+    parser.add_argument("--min-area", type=float, help="Drop predictions smaller than this many square pixels")
+    parser.add_argument("--min-aspect", type=float, help="Drop predictions with width / height below this")
+    parser.add_argument("--max-aspect", type=float, help="Drop predictions with width / height above this")
+    parser.add_argument("--compare-postprocess", action="store_true",
+                        help="Also score the raw predictions and report the effect of post-processing "
+                             "(uses the backend defaults unless post-processing options are given)")
+    parser.add_argument("--output-json", type=Path,
+                        help="Write the overall results as JSON to this file")
+    parser.add_argument("--output-csv", type=Path,
+                        help="Write per-file, per-tag counters as CSV to this file")
+    args = parser.parse_args()
+    if matching_unavailable(args.matching):
+        parser.error(matching_unavailable(args.matching))
+    if args.incremental and args.store:
+        parser.error("--incremental works on JSON files and cannot be combined with --store")
+    if args.incremental and args.compare_postprocess:
+        parser.error("--compare-postprocess cannot be combined with --incremental")
+    return args
+
+def postprocess_config_from_args(args) -> Optional[PostprocessConfig]:
+    """Post-processing requested on the command line, or None to score the raw predictions"""
+    options = (args.nms_iou, args.cross_class_iou, args.min_area, args.min_aspect, args.max_aspect)
+    if all(option is None for option in options):
+        return PostprocessConfig.from_env() if args.compare_postprocess else None
+    # Only the given options are applied; the backend's NMS default is not implied
+    return PostprocessConfig(*(option or 0.0 for option in options), clip=False)
+
+def print_postprocess_comparison(before: Dict, after: Dict):
+    """Print per-tag prediction counts and metrics without and with post-processing"""
+    print("\n=== Post-processing Effect (raw -> post-processed) ===")
+    for tag in sorted(set(before) | set(after)):
+        raw, processed = before.get(tag), after.get(tag)
+        if raw is None or processed is None:
+            continue
+        print(f"{tag.upper()}: predictions {raw['total_predictions']} -> {processed['total_predictions']}, "
+              f"precision {raw['precision']:.3f} -> {processed['precision']:.3f}, "
+              f"recall {raw['recall']:.3f} -> {processed['recall']:.3f}, "
+              f"F1 {raw['f1_score']:.3f} -> {processed['f1_score']:.3f}")
+
+def main():
+    args = parse_args()
+
+    # Paths to the annotation and prediction folders
+    annotations_dir = args.annotations_dir
+    predictions_dir = args.predictions_dir
+    
+    if args.store:
+        # Boxes come from the store's bulk query; pairs are counted with one COUNT
+        # query and then streamed rather than materialized
+        from box_store import BoxStore
+        store = BoxStore(str(args.store))
+        total = store.count_evaluation_pairs(args.model, args.prompt_version)
+        store.close()
+        pairs = iter_store_pairs(args.store, args.model, args.prompt_version)
+    else:
+        pairs = list(find_file_pairs(annotations_dir, predictions_dir))
+        total = len(pairs)
+    progress = ProgressReporter(total)
+    start_time = time.perf_counter()
+
+    # Per-file rows are streamed to the CSV file instead of being kept in memory
+    csv_file = open(args.output_csv, "w", newline="") if args.output_csv else None
+    csv_writer = None
+    if csv_file is not None:
+        csv_writer = csv.writer(csv_file)
+        csv_writer.writerow(["file", "tag", "total_ground_truth", "total_predictions", "true_positives"])
+
+    def on_file_result(name, counters, coco_stats):
+        if csv_writer is not None:
+            for tag, (total_gt, total_pred, tp) in sorted(counters.items()):
+                csv_writer.writerow([name, tag, total_gt, total_pred, tp])
+        progress.update()
+
+    postprocess = postprocess_config_from_args(args)
+    before_results = None
+    if args.compare_postprocess:
+        raw_pairs = iter_store_pairs(args.store, args.model, args.prompt_version) if args.store else pairs
+        raw_metrics, _ = evaluate_dataset(raw_pairs, args.iou_threshold, args.matching, max(1, args.workers))
+        before_results = summarize_tag_metrics(raw_metrics)
+
+    coco = CocoAccumulator() if args.coco else None
+    try:
+        if args.incremental:
+            overall_metrics, total_files, rescored = evaluate_incremental(
+                pairs, args.manifest, args.iou_threshold, args.matching, max(1, args.workers), on_file_result, coco,
+                postprocess
+            )
+            print(f"Rescored {rescored} changed files, reused {total_files - rescored} from {args.manifest}",
+                  file=sys.stderr)
+        else:
+            overall_metrics, total_files = evaluate_dataset(
+                pairs, args.iou_threshold, args.matching, max(1, args.workers), on_file_result, coco, postprocess
+            )
+    finally:
+        if csv_file is not None:
+            csv_file.close()
+
+    elapsed = time.perf_counter() - start_time
+    results = summarize_tag_metrics(overall_metrics)
+    coco_summary = coco.summarize() if coco is not None else None
+
+    if args.output_json:
+        output = {
+            "total_files": total_files,
+            "iou_threshold": args.iou_threshold,
+            "matching": args.matching,
+            "elapsed_seconds": elapsed,
+            "metrics": results
+        }
+        if coco_summary is not None:
+            output["coco"] = coco_summary
+        if postprocess is not None:
+            output["postprocess"] = postprocess.as_dict()
+        if before_results is not None:
+            output["metrics_without_postprocess"] = before_results
+        with open(args.output_json, "w") as f:
+            json.dump(output, f, indent=2)
     
     # Calculate and print final metrics
     print("\n=== Final Evaluation Results ===")
     print(f"Total files processed: {total_files}\n")
     
-    for tag, metrics in overall_metrics.items():
-        tp = metrics['true_positives']
-        total_gt = metrics['total_ground_truth']
-        total_pred = metrics['total_predictions']
-        
-        precision = tp / total_pred if total_pred > 0 else 0
-        recall = tp / total_gt if total_gt > 0 else 0
-        f1 = 2 * (precision * recall) / (precision + recall) if (precision + recall) > 0 else 0
-        
+    for tag, metrics in sorted(results.items()):
         print(f"\nMetrics for {tag.upper()}:")
-        print(f"  Total ground truth boxes: {total_gt}")
-        print(f"  Total predictions: {total_pred}")
-        print(f"  True positives (Number of correctly predicted boxes): {tp}")
-        print(f"  Precision: {precision:.3f}")
-        print(f"  Recall: {recall:.3f}")
-        print(f"  F1-score: {f1:.3f}")
+        print(f"  Total ground truth boxes: {metrics['total_ground_truth']}")
+        print(f"  Total predictions: {metrics['total_predictions']}")
+        print(f"  True positives (Number of correctly predicted boxes): {metrics['true_positives']}")
+        print(f"  Precision: {metrics['precision']:.3f}")
+        print(f"  Recall: {metrics['recall']:.3f}")
+        print(f"  F1-score: {metrics['f1_score']:.3f}")
+
+    if coco_summary is not None:
+        print_coco_summary(coco_summary)
+    if before_results is not None:
+        print_postprocess_comparison(before_results, results)
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
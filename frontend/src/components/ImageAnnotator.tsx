@@ -14,6 +14,9 @@ interface Annotation {
 
 interface UploadResponse {
   filename: string;
+  width: number;
+  height: number;
+  previewUrl: string;
   status: string;
 }
 
@@ -47,6 +50,8 @@ const tagColors: { [key: string]: string } = {
 
 const ImageAnnotator = () => {
   const [image, setImage] = useState<HTMLImageElement | null>(null);
+  // Original image dimensions; the displayed image may be a downscaled preview
+  const [imageSize, setImageSize] = useState({ width: 0, height: 0 });
   const [annotations, setAnnotations] = useState<Annotation[]>([]);
   const [selectedId, setSelectedId] = useState<string | null>(null);
   const [isDrawing, setIsDrawing] = useState(false);
@@ -94,14 +99,23 @@ const ImageAnnotator = () => {
     try {
       const response = await axios.post<UploadResponse>('http://localhost:8000/upload', formData);
       if (response.data.status === 'success') {
-        // Load the image
+        const { width, height } = response.data;
+        // Load the downscaled preview; it is drawn at the original size so
+        // annotation coordinates stay in original pixels
         const img = new window.Image();
-        img.src = URL.createObjectURL(file);
+        img.crossOrigin = 'anonymous';
         img.onload = () => {
           setImage(img);
-          setScale(calculateScale(img.width, img.height));
+          setImageSize({ width, height });
+          setScale(calculateScale(width, height));
           setAnnotations([]); // Clear existing annotations for new image
         };
+        img.onerror = () => {
+          // Fall back to the local file if the preview is unavailable
+          img.onerror = null;
+          img.src = URL.createObjectURL(file);
+        };
+        img.src = `http://localhost:8000${response.data.previewUrl}`;
       }
     } catch (error) {
       console.error('Error uploading image:', error);
@@ -213,8 +227,8 @@ const ImageAnnotator = () => {
       const response = await axios.post<SaveResponse>('http://localhost:8000/save-annotations', {
         filename: originalFileName,  // Send the original image filename
         annotations: annotations.filter(ann => !ann.id.startsWith('temp-')),
-        imageWidth: image?.width,
-        imageHeight: image?.height,
+        imageWidth: imageSize.width,
+        imageHeight: imageSize.height,
       });
       
       if (response.data.status === 'success') {
@@ -291,13 +305,13 @@ const ImageAnnotator = () => {
     // Update scale when window is resized
     const handleResize = () => {
       if (image) {
-        setScale(calculateScale(image.width, image.height));
+        setScale(calculateScale(imageSize.width, imageSize.height));
       }
     };
 
     window.addEventListener('resize', handleResize);
     return () => window.removeEventListener('resize', handleResize);
-  }, [image]);
+  }, [image, imageSize]);
 
   return (
     <div className="image-annotator">
@@ -315,8 +329,8 @@ const ImageAnnotator = () => {
         <div className="canvas-container">
           {image ? (
             <Stage
-              width={image.width * scale}
-              height={image.height * scale}
+              width={imageSize.width * scale}
+              height={imageSize.height * scale}
               onMouseDown={handleMouseDown}
               onMouseMove={handleMouseMove}
               onMouseUp={handleMouseUp}
@@ -327,8 +341,8 @@ const ImageAnnotator = () => {
               <Layer>
                 <Image 
                   image={image}
-                  width={image.width}
-                  height={image.height}
+                  width={imageSize.width}
+                  height={imageSize.height}
                 />
                 {annotations.map((annotation) => (
                   <React.Fragment key={annotation.id}>
@@ -5,103 +5,222 @@ This script processes a directory of images through an object detection API endp
 It handles image uploading, tracks processing statistics, and provides a summary
 of the processing results including success rates and timing information.
 
+Images are sent concurrently through a bounded worker pool whose threads reuse
+keep-alive HTTP sessions. Rate-limit (429) and server (5xx) errors are retried with
+exponential backoff, and images that already have a prediction file can be
+skipped so an interrupted run can be resumed.
+
 The script supports multiple image formats (jpg, jpeg, png) and includes error
 handling for API communication and file processing.
 """
 
 import os
+import argparse
+import math
+import mimetypes
+import random
+import threading
 import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 import time
 
 # Configuration
 API_URL = "http://localhost:8000/predict"  # Your FastAPI endpoint
 DATASET_DIR = "Datasets"  # Source directory containing images
+PREDICTIONS_DIR = "backend/predictions"  # Where the backend writes predictions_*.json
 SUPPORTED_EXTENSIONS = {'.jpg', '.jpeg', '.png'}  # Supported image formats
+DEFAULT_CONCURRENCY = 4  # Number of images in flight at once
+DEFAULT_MAX_RETRIES = 3  # Retries per image on 429/5xx responses
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+BACKOFF_BASE_SECONDS = 1.0
+
+_thread_local = threading.local()
+
+def get_session():
+    """
+    Return the HTTP session for the current worker thread.
 
-def process_image(image_path):
+    Each worker keeps its own session (requests.Session is not thread-safe),
+    and each session keeps its connection alive between images.
+    """
+    session = getattr(_thread_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        _thread_local.session = session
+    return session
+
+def process_image(image_path, api_url=API_URL, max_retries=DEFAULT_MAX_RETRIES, backend=None):
     """
     Process a single image through the prediction API.
-    
+
     Args:
         image_path (Path): Path object pointing to the image file
-        
+        api_url (str): Prediction endpoint to post the image to
+        max_retries (int): Number of retries on 429/5xx responses and connection errors
+        backend (str): Detector backend to request (None for the server default)
+
     Returns:
-        dict: API response containing prediction results if successful, None otherwise
-        
-    Raises:
-        requests.exceptions.RequestException: If API request fails
-        Exception: For unexpected errors during processing
+        tuple: (API response dict if successful or None, latency in seconds, number of attempts)
     """
+    content_type = mimetypes.guess_type(image_path.name)[0] or 'application/octet-stream'
     try:
-        # Open the image file
         with open(image_path, 'rb') as img_file:
-            # Create the files payload
+            payload = img_file.read()
+    except OSError as e:
+        print(f"Unexpected error processing {image_path.name}: {str(e)}")
+        return None, 0.0, 0
+
+    session = get_session()
+    start_time = time.perf_counter()
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            # Create the files payload and make the API request
             files = {
-                'file': (image_path.name, img_file, 'image/jpeg')  # Adjust content-type as needed
+                'file': (image_path.name, payload, content_type)
             }
-            
-            # Make the API request
-            response = requests.post(API_URL, files=files)
-            
+            response = session.post(api_url, files=files, params={'backend': backend} if backend else None)
+
+            if response.status_code in RETRY_STATUS_CODES and attempt <= max_retries:
+                retry_after = response.headers.get('Retry-After')
+                delay = float(retry_after) if retry_after and retry_after.isdigit() else \
+                    BACKOFF_BASE_SECONDS * 2 ** (attempt - 1) + random.uniform(0, BACKOFF_BASE_SECONDS)
+                print(f"{image_path.name}: HTTP {response.status_code}, retrying in {delay:.1f}s "
+                      f"(attempt {attempt}/{max_retries})")
+                time.sleep(delay)
+                continue
+
             # Check if request was successful
             response.raise_for_status()
-            
-            print(f"Successfully processed {image_path.name}")
-            return response.json()
-            
-    except requests.exceptions.RequestException as e:
-        print(f"Error processing {image_path.name}: {str(e)}")
-        return None
-    except Exception as e:
-        print(f"Unexpected error processing {image_path.name}: {str(e)}")
-        return None
+
+            latency = time.perf_counter() - start_time
+            print(f"Successfully processed {image_path.name} in {latency:.2f}s")
+            return response.json(), latency, attempt
+
+        except requests.exceptions.ConnectionError as e:
+            if attempt <= max_retries:
+                delay = BACKOFF_BASE_SECONDS * 2 ** (attempt - 1)
+                print(f"{image_path.name}: connection error, retrying in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+            print(f"Error processing {image_path.name}: {str(e)}")
+        except requests.exceptions.RequestException as e:
+            print(f"Error processing {image_path.name}: {str(e)}")
+        except Exception as e:
+            print(f"Unexpected error processing {image_path.name}: {str(e)}")
+        return None, time.perf_counter() - start_time, attempt
+
+def has_prediction(image_path, predictions_dir=PREDICTIONS_DIR, backend=None):
+    """Check whether an image already has a predictions_*.json file"""
+    # Backends other than gemini write to a subdirectory named after the backend
+    if backend and backend != "gemini":
+        predictions_dir = Path(predictions_dir) / backend
+    return (Path(predictions_dir) / f"predictions_{image_path.stem}.json").exists()
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Send every image in a dataset directory to the prediction API")
+    parser.add_argument("--dataset-dir", default=DATASET_DIR, help="Directory containing the images")
+    parser.add_argument("--api-url", default=API_URL, help="Prediction endpoint")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help="Maximum number of images in flight at once")
+    parser.add_argument("--max-retries", type=int, default=DEFAULT_MAX_RETRIES,
+                        help="Retries per image on 429/5xx responses")
+    parser.add_argument("--predictions-dir", default=PREDICTIONS_DIR,
+                        help="Prediction directory checked when resuming")
+    parser.add_argument("--backend", help="Detector backend to use, e.g. gemini or onnx (default: server default)")
+    parser.add_argument("--no-resume", action="store_true",
+                        help="Re-process images that already have a prediction file")
+    return parser.parse_args()
 
 def main():
     """
     Main function that orchestrates the dataset processing workflow.
-    
+
     - Validates the dataset directory
-    - Processes all supported image files
+    - Skips images that already have predictions (unless --no-resume)
+    - Processes the remaining images concurrently
     - Tracks processing statistics
     - Prints a summary of results
     """
+    args = parse_args()
+    concurrency = max(1, args.concurrency)
+
     # Create Path object for dataset directory
-    dataset_path = Path(DATASET_DIR)
-    
+    dataset_path = Path(args.dataset_dir)
+
     # Check if directory exists
     if not dataset_path.exists():
-        print(f"Error: Directory '{DATASET_DIR}' not found!")
+        print(f"Error: Directory '{args.dataset_dir}' not found!")
         return
-    
+
+    # Collect images with a supported extension
+    image_paths = sorted(
+        path for path in dataset_path.iterdir()
+        if path.suffix.lower() in SUPPORTED_EXTENSIONS
+    )
+    skipped_images = 0
+    if not args.no_resume:
+        pending = [path for path in image_paths if not has_prediction(path, args.predictions_dir, args.backend)]
+        skipped_images = len(image_paths) - len(pending)
+        image_paths = pending
+
     # Counter for processed images
-    total_images = 0
+    total_images = len(image_paths)
     successful_predictions = 0
-    
+    total_retries = 0
+    latencies = []
+    reused = {'hit': 0, 'near_duplicate': 0}  # Answered by the server without a model call
+
+    print(f"Processing {total_images} images with concurrency {concurrency} "
+          f"({skipped_images} skipped, already predicted)")
+
     # Start time
-    start_time = time.time()
-    
-    # Process all images in directory
-    for image_path in dataset_path.iterdir():
-        # Check if file is an image with supported extension
-        if image_path.suffix.lower() in SUPPORTED_EXTENSIONS:
-            total_images += 1
-            print(f"\nProcessing {image_path.name}...")
-            
-            result = process_image(image_path)
+    start_time = time.perf_counter()
+
+    # Process all images through a bounded worker pool
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {
+            executor.submit(process_image, path, args.api_url, args.max_retries, args.backend): path
+            for path in image_paths
+        }
+        for future in as_completed(futures):
+            result, latency, attempts = future.result()
+            total_retries += max(0, attempts - 1)
             if result and result.get('status') == 'success':
                 successful_predictions += 1
-    
+                latencies.append(latency)
+                if result.get('cache') in reused:
+                    reused[result['cache']] += 1
+
     # Calculate processing time
-    processing_time = time.time() - start_time
-    
+    processing_time = time.perf_counter() - start_time
+    latencies.sort()
+
     # Print summary
     print("\n=== Processing Summary ===")
     print(f"Total images processed: {total_images}")
+    print(f"Skipped (already predicted): {skipped_images}")
     print(f"Successful predictions: {successful_predictions}")
     print(f"Failed predictions: {total_images - successful_predictions}")
+    print(f"Retries: {total_retries}")
+    print(f"Reused predictions: {reused['hit']} cache hits, {reused['near_duplicate']} near-duplicates")
     print(f"Total processing time: {processing_time:.2f} seconds")
-    print(f"Average time per image: {processing_time/total_images:.2f} seconds")
+    if total_images > 0:
+        print(f"Average time per image: {processing_time/total_images:.2f} seconds")
+        print(f"Throughput: {total_images/processing_time:.2f} images/second")
+    if latencies:
+        print(f"Latency p50: {percentile(latencies, 50):.2f}s  "
+              f"p95: {percentile(latencies, 95):.2f}s  "
+              f"p99: {percentile(latencies, 99):.2f}s")
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
@@ -0,0 +1,363 @@
+"""
+Prompt and Model Experiment Runner
+
+This script compares detection prompt, model and temperature variants on a
+dataset. Every combination of the given --prompt, --model, --temperature and
+--samples options is one variant. All images of all variants are predicted
+concurrently in-process with the backend's Gemini detector, preprocessing and
+post-processing, then each variant is scored against the ground truth
+annotations with the evaluator.
+
+Each variant's predictions are written to OUTPUT_DIR/<variant key>/, where the
+key is a hash of every setting that changes the predictions. Re-running the
+script only calls the model for images whose prediction is missing or stale,
+so a grid can be extended one variant at a time.
+
+With --samples above 1 a variant is an ensemble: every image is sampled that
+many times and the responses are merged with weighted box fusion, which costs
+that many model calls per image.
+
+The summary table reports per-variant precision/recall/F1, latency
+percentiles, token usage and the estimated cost (see --price). The pinned
+google-generativeai SDK does not return token usage with responses, so tokens
+are measured with count_tokens after each image (not included in the latency)
+unless --no-count-tokens is given; tokens and cost are then shown as "-".
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import hashlib
+import argparse
+import itertools
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+ROOT_DIR = Path(__file__).resolve().parent
+BACKEND_DIR = ROOT_DIR / "backend"
+sys.path.insert(0, str(BACKEND_DIR))
+
+from evaluate_model import MATCHING_MODES, evaluate_dataset, matching_unavailable, summarize_tag_metrics
+from process_datasets import SUPPORTED_EXTENSIONS, percentile
+from storage import atomic_write_json
+
+DATASET_DIR = ROOT_DIR / "Datasets"
+ANNOTATIONS_DIR = BACKEND_DIR / "annotations"
+OUTPUT_DIR = BACKEND_DIR / "experiments"
+DEFAULT_CONCURRENCY = 8  # Images in flight at once, over all variants
+# USD per million (input, output) tokens; override or add models with --price
+DEFAULT_PRICES = {
+    "gemini-2.5-flash": (0.30, 2.50),
+    "gemini-2.5-flash-lite": (0.10, 0.40),
+    "gemini-2.5-pro": (1.25, 10.00),
+}
+
+class Variant:
+    """
+    One point of the experiment grid.
+
+    Attributes:
+        prompt_name (str): Short name of the prompt shown in the results
+        detector (GeminiDetector): Detector configured with the variant's settings
+        key (str): Hash of the settings that change the predictions; names the output directory
+        directory (Path): Where the variant's predictions are written
+    """
+    def __init__(self, prompt_name: str, detector, settings: Dict, output_dir: Path):
+        self.prompt_name = prompt_name
+        self.detector = detector
+        self.settings = settings
+        self.key = hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:12]
+        self.directory = output_dir / self.key
+
+    @property
+    def label(self) -> str:
+        generation = self.detector.generation_config
+        return (f"{self.prompt_name}/{self.detector.model_name}/t={generation['temperature']:g}"
+                f"/n={self.detector.samples}")
+
+def load_prompts(specs: List[str], default_prompt: str) -> List[Tuple[str, str]]:
+    """Return (name, text) of each --prompt [NAME=]PATH option; the backend prompt when none are given"""
+    if not specs:
+        return [("default", default_prompt)]
+    prompts = []
+    for spec in specs:
+        name, _, path = spec.rpartition("=")
+        path = Path(path)
+        prompts.append((name or path.stem, path.read_text()))
+    return prompts
+
+def parse_prices(specs: List[str]) -> Dict[str, Tuple[float, float]]:
+    """Merge --price MODEL=INPUT,OUTPUT options into the default price table"""
+    prices = dict(DEFAULT_PRICES)
+    for spec in specs:
+        model_name, _, values = spec.partition("=")
+        input_price, _, output_price = values.partition(",")
+        prices[model_name] = (float(input_price), float(output_price or 0))
+    return prices
+
+def build_variants(backend, args) -> List[Variant]:
+    """Create a variant for every combination of prompt, model, temperature and sample count"""
+    prompts = load_prompts(args.prompt, backend.DETECTION_PROMPT)
+    models = args.model or [backend.MODEL_NAME]
+    temperatures = args.temperature or [backend.GENERATION_CONFIG["temperature"]]
+    samples_options = args.samples or [1]
+    variants = []
+    for (prompt_name, prompt), model_name, temperature, samples in itertools.product(
+            prompts, models, temperatures, samples_options):
+        detector = backend.GeminiDetector(
+            model_name, prompt, {**backend.GENERATION_CONFIG, "temperature": temperature}, samples,
+            args.ensemble_iou, args.min_votes, count_tokens=not args.no_count_tokens
+        )
+        prompt_text, _, settings = detector.cache_identity(backend.PREPROCESS_CONFIG)
+        settings = {
+            "prompt": prompt_text.strip(),
+            "model": model_name,
+            **settings,
+            "postprocess": backend.POSTPROCESS_CONFIG.as_dict(),
+        }
+        variants.append(Variant(prompt_name, detector, settings, args.output_dir))
+    keys = [variant.key for variant in variants]
+    if len(set(keys)) != len(keys):
+        raise SystemExit("Error: the grid contains the same variant more than once")
+    return variants
+
+async def predict_variant_image(backend, variant: Variant, image_path: Path, use_cache: bool,
+                                semaphore: asyncio.Semaphore) -> Tuple[Optional[Dict], bool]:
+    """
+    Predict one image with one variant, reusing its saved prediction when it
+    matches the image and the variant settings.
+
+    Returns:
+        tuple: (prediction document or None on failure, whether it came from the cache)
+    """
+    filepath = variant.directory / f"predictions_{image_path.stem}.json"
+    async with semaphore:
+        content = image_path.read_bytes()
+        trace = backend.start_trace("experiment")
+        image, cache_key = await asyncio.to_thread(
+            backend.load_image, content, variant.detector, backend.PREPROCESS_CONFIG,
+            backend.POSTPROCESS_CONFIG, trace
+        )
+        if use_cache and filepath.exists():
+            try:
+                document = json.loads(filepath.read_text())
+            except ValueError:
+                document = None
+            if document is not None and document.get("cacheKey") == cache_key:
+                return document, True
+
+        image_size = {"width": image.width, "height": image.height}
+        start_time = time.perf_counter()
+        try:
+            annotations, stats = await variant.detector.detect(image, backend.PREPROCESS_CONFIG, trace)
+        except backend.PredictionError as e:
+            print(f"{variant.label} {image_path.name}: {e}")
+            return None, False
+        annotations, _ = backend.postprocess_predictions(annotations, backend.POSTPROCESS_CONFIG, image_size)
+        # Token counting calls are not part of the prediction latency
+        latency = time.perf_counter() - start_time - stats.get("usage", {}).get("count_ms", 0) / 1000
+
+    document = {
+        "filename": image_path.name,
+        "predictions": annotations,
+        "timestamp": datetime.now().strftime("%Y%m%d_%H%M%S"),
+        "imageSize": image_size,
+        "cacheKey": cache_key,
+        "model": variant.detector.model_name,
+        "promptVersion": variant.detector.prompt_version,
+        "variant": variant.key,
+        "latencySeconds": latency,
+        "usage": stats.get("usage", {}),
+    }
+    await asyncio.to_thread(atomic_write_json, str(filepath), document)
+    return document, False
+
+async def run_predictions(backend, variants: List[Variant], image_paths: List[Path], concurrency: int,
+                          use_cache: bool) -> Dict[str, List[Dict]]:
+    """Predict every image with every variant concurrently; returns the documents per variant key"""
+    for variant in variants:
+        variant.directory.mkdir(parents=True, exist_ok=True)
+        atomic_write_json(str(variant.directory / "variant.json"), {"key": variant.key, **variant.settings})
+
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = [
+        (variant, predict_variant_image(backend, variant, path, use_cache, semaphore))
+        for variant in variants for path in image_paths
+    ]
+    results = await asyncio.gather(*(task for _, task in tasks))
+
+    documents = {variant.key: [] for variant in variants}
+    cached = 0
+    for (variant, _), (document, from_cache) in zip(tasks, results):
+        if document is not None:
+            documents[variant.key].append(document)
+            cached += from_cache
+    failed = sum(document is None for document, _ in results)
+    print(f"Predicted {len(results) - cached - failed} images, reused {cached} cached predictions, "
+          f"{failed} failed")
+    return documents
+
+def summarize_variant(variant: Variant, documents: List[Dict], annotations_dir: Path, iou_threshold: float,
+                      matching: str, prices: Dict[str, Tuple[float, float]]) -> Dict:
+    """Score a variant's predictions and total its latency, token usage and cost"""
+    pairs = []
+    for document in documents:
+        stem = Path(document["filename"]).stem
+        ann_file = annotations_dir / f"{stem}.json"
+        if ann_file.exists():
+            pairs.append((ann_file, variant.directory / f"predictions_{stem}.json"))
+    overall_metrics, total_files = evaluate_dataset(pairs, iou_threshold, matching)
+
+    totals = [sum(m[field] for m in overall_metrics.values())
+              for field in ("total_ground_truth", "total_predictions", "true_positives")]
+    total_gt, total_pred, tp = totals
+    precision = tp / total_pred if total_pred > 0 else 0
+    recall = tp / total_gt if total_gt > 0 else 0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0
+
+    latencies = sorted(document["latencySeconds"] for document in documents)
+    usage = {"model_calls": sum(document["usage"].get("model_calls", 0) for document in documents)}
+    for field in ("prompt_tokens", "output_tokens"):
+        # Unknown (None) when any prediction was made without token usage
+        counts = [document["usage"].get(field) for document in documents]
+        usage[field] = sum(counts) if all(count is not None for count in counts) else None
+    price = prices.get(variant.detector.model_name)
+    cost = None
+    if price is not None and usage["prompt_tokens"] is not None:
+        cost = (usage["prompt_tokens"] * price[0] + usage["output_tokens"] * price[1]) / 1_000_000
+
+    return {
+        "variant": variant.key,
+        "label": variant.label,
+        "prompt": variant.prompt_name,
+        "model": variant.detector.model_name,
+        "temperature": variant.detector.generation_config["temperature"],
+        "samples": variant.detector.samples,
+        "images": len(documents),
+        "evaluated_files": total_files,
+        "precision": precision,
+        "recall": recall,
+        "f1_score": f1,
+        "metrics": summarize_tag_metrics(overall_metrics),
+        "latency_seconds": {f"p{pct}": percentile(latencies, pct) for pct in (50, 95)},
+        "usage": usage,
+        "cost_usd": cost,
+    }
+
+def print_results(results: List[Dict]):
+    """Print the overall comparison table and the per-tag F1 of every variant"""
+    width = max(len(result["label"]) for result in results)
+    print("\n=== Experiment Results ===")
+    print(f"{'variant':<{width}} {'key':<12} {'images':>6} {'P':>6} {'R':>6} {'F1':>6} {'p50 s':>7} "
+          f"{'p95 s':>7} {'calls':>6} {'tokens in':>10} {'tokens out':>10} {'cost $':>9}")
+    for result in sorted(results, key=lambda result: -result["f1_score"]):
+        usage = result["usage"]
+        cost = f"{result['cost_usd']:.4f}" if result["cost_usd"] is not None else "-"
+        tokens = ["-" if usage[field] is None else usage[field] for field in ("prompt_tokens", "output_tokens")]
+        print(f"{result['label']:<{width}} {result['variant']:<12} {result['images']:>6} "
+              f"{result['precision']:>6.3f} {result['recall']:>6.3f} {result['f1_score']:>6.3f} "
+              f"{result['latency_seconds']['p50']:>7.2f} {result['latency_seconds']['p95']:>7.2f} "
+              f"{usage['model_calls']:>6} {tokens[0]:>10} {tokens[1]:>10} {cost:>9}")
+
+    tags = sorted({tag for result in results for tag in result["metrics"]})
+    print("\n=== Per-tag F1 (precision / recall) ===")
+    print(f"{'variant':<{width}} " + " ".join(f"{tag.upper():>19}" for tag in tags))
+    for result in results:
+        cells = []
+        for tag in tags:
+            metrics = result["metrics"].get(tag)
+            cells.append(f"{metrics['f1_score']:.3f} ({metrics['precision']:.2f}/{metrics['recall']:.2f})"
+                         if metrics else "-")
+        print(f"{result['label']:<{width}} " + " ".join(f"{cell:>19}" for cell in cells))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compare prompt, model and temperature variants on a dataset")
+    parser.add_argument("--prompt", action="append", default=[], metavar="[NAME=]PATH",
+                        help="Prompt file to try (repeatable; default: the backend prompt)")
+    parser.add_argument("--model", action="append", default=[],
+                        help="Gemini model to try (repeatable; default: the backend model)")
+    parser.add_argument("--temperature", action="append", type=float, default=[],
+                        help="Sampling temperature to try (repeatable; default: the backend temperature)")
+    parser.add_argument("--samples", action="append", type=int, default=[],
+                        help="Responses fused per image (repeatable; above 1 runs an ensemble; default: 1)")
+    parser.add_argument("--ensemble-iou", type=float, default=0.55,
+                        help="IoU above which boxes of different samples are fused")
+    parser.add_argument("--min-votes", type=int, default=0,
+                        help="Drop fused boxes found by fewer samples (0 = a majority)")
+    parser.add_argument("--dataset-dir", type=Path, default=DATASET_DIR, help="Directory containing the images")
+    parser.add_argument("--annotations-dir", type=Path, default=ANNOTATIONS_DIR,
+                        help="Directory containing ground truth annotation files")
+    parser.add_argument("--output-dir", type=Path, default=OUTPUT_DIR,
+                        help="Directory the per-variant predictions are written to")
+    parser.add_argument("--limit", type=int, help="Only use the first N images of the dataset")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help="Maximum number of images in flight at once, over all variants")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Call the model even for images with an up-to-date prediction")
+    parser.add_argument("--iou-threshold", type=float, default=0.5,
+                        help="Minimum IoU for a prediction to count as a true positive")
+    parser.add_argument("--matching", choices=MATCHING_MODES, default="greedy",
+                        help="How ground truth and predicted boxes are paired")
+    parser.add_argument("--price", action="append", default=[], metavar="MODEL=INPUT,OUTPUT",
+                        help="USD per million input and output tokens of a model (repeatable)")
+    parser.add_argument("--no-count-tokens", action="store_true",
+                        help="Do not measure tokens with count_tokens when responses carry no usage "
+                             "(tokens and cost are reported as unknown)")
+    parser.add_argument("--output-json", type=Path, help="Write the results as JSON to this file")
+    args = parser.parse_args()
+    if any(samples < 1 for samples in args.samples):
+        parser.error("--samples must be at least 1")
+    if matching_unavailable(args.matching):
+        # Checked before any model call is made
+        parser.error(matching_unavailable(args.matching))
+    # The backend resolves its settings and .env relative to its own directory
+    for name in ("dataset_dir", "annotations_dir", "output_dir", "output_json"):
+        if getattr(args, name) is not None:
+            setattr(args, name, getattr(args, name).resolve())
+    args.prompt = [
+        f"{name}={Path(path).resolve()}" if name else str(Path(path).resolve())
+        for name, _, path in (spec.rpartition("=") for spec in args.prompt)
+    ]
+    return args
+
+def main():
+    args = parse_args()
+    if not args.dataset_dir.exists():
+        print(f"Error: Directory '{args.dataset_dir}' not found!")
+        return
+    image_paths = sorted(
+        path for path in args.dataset_dir.iterdir()
+        if path.suffix.lower() in SUPPORTED_EXTENSIONS
+    )[:args.limit]
+
+    os.chdir(BACKEND_DIR)
+    import main as backend
+
+    variants = build_variants(backend, args)
+    prices = parse_prices(args.price)
+    print(f"Running {len(variants)} variants on {len(image_paths)} images with concurrency {args.concurrency}")
+    for variant in variants:
+        print(f"  {variant.key}  {variant.label}")
+
+    start_time = time.perf_counter()
+    documents = asyncio.run(run_predictions(
+        backend, variants, image_paths, max(1, args.concurrency), not args.no_cache
+    ))
+    print(f"Predictions finished in {time.perf_counter() - start_time:.2f} seconds")
+
+    results = [
+        summarize_variant(variant, documents[variant.key], args.annotations_dir, args.iou_threshold,
+                          args.matching, prices)
+        for variant in variants
+    ]
+    print_results(results)
+    if args.output_json:
+        with open(args.output_json, "w") as f:
+            json.dump({"iou_threshold": args.iou_threshold, "matching": args.matching, "variants": results},
+                      f, indent=2)
+
+if __name__ == "__main__":
+    main()